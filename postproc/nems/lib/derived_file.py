@@ -0,0 +1,173 @@
+"""
+Data derived from a file (e.g. the catalogue of a GriB file, the arrays of a
+track file), saved next to it so that it is only computed once, not once
+per run.
+
+A DerivedFile subclass says how to compute the data from the file (build())
+and how to write and read the saved copy. The copy is saved as
+.<file name><suffix> (or in another directory) along with the version of
+its format and the size and mtime of the file, and is reused as long as they
+do not change. DerivedFileMemo also memoizes the objects in the process.
+
+atomic_write() is how the copies (and other state files) are written: to a
+temporary file next to the destination that is then renamed, so the
+destination is either missing or complete, even with concurrent writers.
+"""
+
+import os
+import logging
+import contextlib
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='derived_file'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w"):
+    """
+    Context manager giving a file object opened (with `mode') on a temporary
+    file, which is renamed to `path' if the block succeeds and removed if it
+    fails
+    """
+    tempPath = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with open(tempPath, mode) as f:
+            yield f
+        os.rename(tempPath, path)
+    except BaseException:
+        if os.path.exists(tempPath):
+            os.unlink(tempPath)
+        raise
+
+def get_saved_path(path, suffix, saveDir=None):
+    """
+    @return where the data derived from `path' are saved: .<file name><suffix>
+            next to it, or in `saveDir'
+    """
+    (dirName, baseName) = os.path.split(os.path.abspath(path))
+    if saveDir is not None:
+        dirName = saveDir
+    return os.path.join(dirName, "." + baseName + suffix)
+
+
+class DerivedFile(object):
+    """
+    Data derived from a file, from the saved copy if it is up to date or
+    else by building them. See module docstring.
+    Subclasses set VERSION (bump it when the saved data change), SUFFIX and
+    BINARY and implement build(), write_saved() and read_saved(). The data
+    are in the `data' attribute.
+    """
+    VERSION = None
+    SUFFIX = None
+    BINARY = False
+
+    def __init__(self, path, saveDir=None, persist=True, log=None):
+        '''
+        @param path File the data are derived from
+        @param saveDir Where to save the data (default: next to the file)
+        @param persist Load and save the data. Set to False for temporary
+               files
+        '''
+        self._log = log if log is not None else _default_log()
+        self.path = path
+        st = os.stat(path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.saved_path = get_saved_path(path, self.SUFFIX, saveDir)
+        self.data = None
+        if persist:
+            self.data = self._load()
+        if self.data is None:
+            self.data = self.build()
+            if persist:
+                self._save()
+
+    def build(self):
+        """ @return the data, computed from the file """
+        raise NotImplementedError()
+
+    def write_saved(self, f, stamp, data):
+        """
+        Write the `data' and the `stamp' (dictionary of version, size and
+        mtime) to the file object `f'
+        """
+        raise NotImplementedError()
+
+    def read_saved(self, f):
+        """
+        @return (stamp, data) as written by write_saved(), read from the
+                file object `f'
+        """
+        raise NotImplementedError()
+
+    def stamp(self):
+        """ @return what the saved data must match to be reused """
+        return dict(version=self.VERSION, size=self.size, mtime=self.mtime)
+
+    def _load(self):
+        """ @return the saved data, or None if missing or stale """
+        try:
+            with open(self.saved_path, "rb" if self.BINARY else "r") as f:
+                (stamp, data) = self.read_saved(f)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        if stamp != self.stamp():
+            return None
+        return data
+
+    def _save(self):
+        """
+        Save the data. Failures are only logged (e.g. read-only directory),
+        since the data are then just built again next time
+        """
+        try:
+            with atomic_write(self.saved_path,
+                              "wb" if self.BINARY else "w") as f:
+                self.write_saved(f, self.stamp(), self.data)
+        except (IOError, OSError) as e:
+            self._log.debug("Unable to save {0}: {1}".format(self.saved_path,
+                                                             e))
+
+    def is_current(self):
+        """ @return True if the file has not changed since it was read """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_size == self.size and st.st_mtime == self.mtime
+
+
+class DerivedFileMemo(object):
+    """
+    The DerivedFile objects built in this process, by file, rebuilt when
+    their file changes
+    """
+    def __init__(self, factory):
+        '''
+        @param factory Called with the path and the keyword arguments of
+               get() to build the object, e.g. a DerivedFile subclass
+        '''
+        self._factory = factory
+        self._objects = {}
+
+    def get(self, path, **kwargs):
+        """ @return the object of `path' """
+        key = os.path.abspath(path)
+        obj = self._objects.get(key)
+        if obj is None or not obj.is_current():
+            obj = self._factory(path, **kwargs)
+            self._objects[key] = obj
+        return obj
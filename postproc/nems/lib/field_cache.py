@@ -0,0 +1,86 @@
+"""
+Content-keyed cache of derived GriB data (e.g. the regridded tracker
+fields), so that reruns with mostly the same inputs only compute what
+changed.
+
+The caller builds the key from everything the data depends on (source file
+size/mtime and message offset, target grid, ...) with make_key(); entries
+are files named after the key's SHA-1 in the cache directory, spread over
+256 subdirectories. Entries are written atomically, so concurrent processes
+can share a cache. Nothing is ever evicted: remove the directory to clear
+it.
+"""
+
+import os
+import hashlib
+import logging
+
+from derived_file import atomic_write
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='field_cache'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+def make_key(*parts):
+    """
+    @return the cache key of `parts', which must have a stable repr()
+            (strings, numbers, tuples...)
+    """
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+class FieldCache(object):
+    """
+    Directory of cached data, by key. See module docstring.
+    """
+    def __init__(self, cacheDir, suffix=".grb2", log=None):
+        self._log = log if log is not None else _default_log()
+        self.cache_dir = cacheDir
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def get(self, key):
+        """ @return the data cached under `key', or None """
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """
+        Cache `data' under `key'. Failures are only logged, e.g. if the
+        directory is not writable
+        """
+        path = self._path(key)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # created by another process in the meantime
+                    if not os.path.isdir(os.path.dirname(path)):
+                        raise
+            with atomic_write(path, "wb") as f:
+                f.write(data)
+        except (IOError, OSError) as e:
+            self._log.debug("Unable to cache {0}: {1}".format(key, e))
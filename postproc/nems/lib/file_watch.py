@@ -0,0 +1,186 @@
+"""
+Waiting for the files written by another program while it runs, e.g. the
+UPP output during the forecast:
+ - DirectoryWatcher blocks until something changes in a directory tree,
+   with inotify (pyinotify) if it is available, otherwise by sleeping for
+   the poll interval.
+ - StableFiles tells when files are complete, i.e. they exist, are not
+   empty and their size and mtime have not changed for some time. This
+   does not rely on inotify, which does not see writes made on other nodes
+   of a parallel file system.
+ - ProgressState records what has been done in a JSON file, so that a
+   restarted watcher does not redo it.
+"""
+
+import os
+import json
+import time
+import logging
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from derived_file import atomic_write
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='file_watch'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class DirectoryWatcher(object):
+    """
+    Wait for changes in a directory tree. See module docstring.
+    """
+    def __init__(self, directory, pollInterval=30, useInotify=True, log=None):
+        '''
+        @param directory Directory to watch (recursively). It does not need
+               to exist yet
+        @param pollInterval Maximum time to wait (s) in wait()
+        @param useInotify Set to False to always poll
+        '''
+        self._log = log if log is not None else _default_log()
+        self.directory = directory
+        self.poll_interval = pollInterval
+        self.use_inotify = useInotify and pyinotify is not None
+        self._notifier = None
+        if useInotify and pyinotify is None:
+            self._log.info("pyinotify is not available. Will poll {0} every "
+                           "{1}s".format(directory, pollInterval))
+
+    def _start_inotify(self):
+        """ Watch the directory with inotify, once it exists """
+        if not os.path.isdir(self.directory):
+            return
+        try:
+            wm = pyinotify.WatchManager()
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO \
+                   | pyinotify.IN_CREATE
+            wm.add_watch(self.directory, mask, rec=True, auto_add=True,
+                         quiet=False)
+            self._notifier = pyinotify.Notifier(wm,
+                                                default_proc_fun=lambda e: None)
+            self._log.debug("Watching {0} with inotify".format(self.directory))
+        except (pyinotify.WatchManagerError, OSError) as e:
+            self._log.warn("Unable to watch {0} with inotify ({1}). Will poll "
+                           "it".format(self.directory, e))
+            self.use_inotify = False
+
+    def wait(self, timeout=None):
+        """
+        Wait until something is written in the directory or `timeout'
+        seconds (default: the poll interval) have passed
+        @return True if a change was seen, False if it timed out or cannot
+                tell (polling)
+        """
+        if timeout is None:
+            timeout = self.poll_interval
+        if self.use_inotify and self._notifier is None:
+            self._start_inotify()
+        if self._notifier is None:
+            time.sleep(timeout)
+            return False
+        if not self._notifier.check_events(int(timeout * 1000)):
+            return False
+        self._notifier.read_events()
+        self._notifier.process_events()
+        return True
+
+    def close(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+
+class StableFiles(object):
+    """
+    Tell when files are complete. See module docstring.
+    """
+    def __init__(self, settleTime=60):
+        '''
+        @param settleTime Time (s) for which the size and mtime of a file
+               must not change for it to be considered complete
+        '''
+        self.settle_time = settleTime
+        # path -> ((size, mtime), time first seen with them)
+        self._seen = {}
+
+    def is_stable(self, path, now=None):
+        """ @return True if the file `path' is complete """
+        if now is None:
+            now = time.time()
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._seen.pop(path, None)
+            return False
+        key = (st.st_size, st.st_mtime)
+        seen = self._seen.get(path)
+        if seen is None or seen[0] != key:
+            self._seen[path] = (key, now)
+            # e.g. files written before a restart
+            return st.st_size > 0 and now - st.st_mtime >= self.settle_time
+        return st.st_size > 0 and now - seen[1] >= self.settle_time
+
+    def all_stable(self, paths, now=None):
+        """ @return True if all the files of `paths' are complete """
+        if now is None:
+            now = time.time()
+        # check them all, to start timing each one as soon as possible
+        stable = [self.is_stable(path, now) for path in paths]
+        return all(stable)
+
+    def forget(self, paths):
+        """ Stop tracking `paths' """
+        for path in paths:
+            self._seen.pop(path, None)
+
+
+class ProgressState(object):
+    """
+    Items done so far, saved in a JSON file. See module docstring.
+    """
+    def __init__(self, path, runKey, log=None):
+        '''
+        @param path State file
+        @param runKey String identifying the run (e.g. its start date). A
+               state file saved for another run is ignored
+        '''
+        self._log = log if log is not None else _default_log()
+        self.path = path
+        self.run_key = runKey
+        self.done = {}
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            saved = {}
+        if saved.get("run") == runKey:
+            self.done = saved.get("done", {})
+            if self.done:
+                self._log.info("Resuming: {0} items already done according "
+                               "to {1}".format(len(self.done), path))
+        elif saved:
+            self._log.info("Ignoring state file {0} of another run"
+                           .format(path))
+
+    def is_done(self, name):
+        return str(name) in self.done
+
+    def mark_done(self, name, value=True):
+        """ Record that `name' is done and save the state atomically """
+        self.done[str(name)] = value
+        with atomic_write(self.path) as f:
+            json.dump(dict(run=self.run_key, done=self.done), f, indent=1)
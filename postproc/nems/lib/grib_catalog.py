@@ -0,0 +1,369 @@
+"""
+Byte-offset catalogue of the messages in GriB 2 files.
+
+Finding a field in a UPP file used to take a `wgrib2 -s | grep | tail'
+pipeline per field, i.e. the same file was inventoried again for every
+field and every check. A GribCatalog reads the file once, mmap'ed, looking
+only at the section headers (no data is decoded):
+ - section 0 for the length of each message,
+ - section 1 for the reference date,
+ - section 4 for the parameter, level and forecast time of each field.
+Each entry (GribMessage) has the offset and length of its message, so the
+bytes of a field can be sliced out of the file directly (read(), copy()).
+
+The catalogue of each file is saved next to it (as .<file name>.gcat, or in
+`indexDir') and reused as long as the size and mtime of the file do not
+change, so each file is scanned once, not once per run (see
+derived_file.py). Catalogues are also memoized in the process by
+get_catalog().
+
+The inventory lines (inventory(), GribMessage.inventory_line()) follow the
+format of `wgrib2 -s', e.g.
+    12:345678:d=2006090400:HGT:850 mb:165 hour fcst:
+so the field strings used with `grep -E' (e.g. "HGT:850", "UGRD:10 m ")
+work with grep(), and the lines can be passed to `wgrib2 -i'.
+Only common NCEP parameter names are known (see PARAMETER_NAMES); others are
+named var<discipline>_<category>_<number>.
+"""
+
+import os
+import re
+import mmap
+import json
+import struct
+import logging
+import collections
+
+from derived_file import DerivedFile, DerivedFileMemo, get_saved_path
+
+CATALOG_VERSION = 1
+CATALOG_SUFFIX = ".gcat"
+
+# (discipline, parameter category, parameter number) -> name used by wgrib2
+PARAMETER_NAMES = {
+    (0, 0, 0): "TMP", (0, 0, 2): "POT", (0, 0, 6): "DPT",
+    (0, 1, 0): "SPFH", (0, 1, 1): "RH", (0, 1, 7): "PRATE", (0, 1, 8): "APCP",
+    (0, 1, 13): "WEASD", (0, 1, 22): "CLWMR", (0, 1, 82): "CICE",
+    (0, 2, 2): "UGRD", (0, 2, 3): "VGRD", (0, 2, 8): "VVEL", (0, 2, 9): "DZDT",
+    (0, 2, 10): "ABSV", (0, 2, 22): "GUST",
+    (0, 3, 0): "PRES", (0, 3, 1): "PRMSL", (0, 3, 5): "HGT",
+    (0, 3, 192): "MSLET",
+    (0, 7, 6): "CAPE", (0, 7, 7): "CIN",
+    (2, 0, 0): "LAND", (2, 0, 4): "VEG",
+}
+
+# Fixed surface type -> (name, unit, multiplier of the value). Layers are
+# shown as "<top>-<bottom> <unit>"
+_LEVEL_TYPES = {
+    1: ("surface", None, None), 2: ("cloud base", None, None),
+    3: ("cloud top", None, None), 4: ("0C isotherm", None, None),
+    7: ("tropopause", None, None),
+    8: ("nominal top of the atmosphere", None, None),
+    10: ("entire atmosphere", None, None),
+    100: (None, "mb", 0.01), 101: ("mean sea level", None, None),
+    102: (None, "m above mean sea level", 1.), 103: (None, "m above ground", 1.),
+    104: (None, "sigma level", 1.), 105: (None, "hybrid level", 1.),
+    106: (None, "m below ground", 1.), 108: (None, "mb above ground", 0.01),
+    200: ("entire atmosphere (considered as a single layer)", None, None),
+}
+
+# Unit of time range (code table 4.4) -> minutes
+_TIME_UNITS = {0: 1, 1: 60, 2: 1440, 10: 180, 11: 360, 12: 720}
+_TIME_UNIT_NAMES = {0: "min", 1: "hour", 2: "day"}
+# Statistical process (code table 4.10) for the product templates that have
+# one -> name used by wgrib2
+_STAT_NAMES = {0: "ave", 1: "acc", 2: "max", 3: "min"}
+# Product templates with the statistical processing at octet 47 (4.8) or
+# 4.11 at octet 50
+_STAT_OFFSETS = {8: 46, 11: 49}
+
+_MISSING = 0xffffffff
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='grib_catalog'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class GribMessage(collections.namedtuple("GribMessage",
+                  ["num", "submsg", "offset", "length", "discipline",
+                   "category", "number", "name", "level_type", "level_value",
+                   "level", "ref_date", "fcst_minutes", "ftime"])):
+    """
+    One field of a GriB 2 file:
+     - num, submsg: number of the message (from 1) and of the field in it
+     - offset, length: where the (whole) message is in the file
+     - discipline, category, number, name: the parameter
+     - level_type, level_value: first fixed surface (value in the units of
+       the file, e.g. Pa; None if missing) and `level', its description
+       (e.g. "850 mb")
+     - ref_date: reference time, as YYYYMMDDHH
+     - fcst_minutes: forecast time (end of the interval for statistically
+       processed fields) in minutes, or None if it is not in minutes/hours/
+       days; `ftime' is its description (e.g. "165 hour fcst")
+    """
+    __slots__ = ()
+
+    def inventory_line(self):
+        """ @return the line `wgrib2 -s' prints for this field """
+        num = str(self.num) if self.submsg == 1 else \
+              "{0}.{1}".format(self.num, self.submsg)
+        return "{0}:{1}:d={2}:{3}:{4}:{5}:".format(num, self.offset,
+                                                   self.ref_date, self.name,
+                                                   self.level, self.ftime)
+
+
+def _scaled_value(data, pos):
+    """
+    @return value of the fixed surface whose scale factor is at `pos', or
+            None if missing
+    """
+    (factor, value) = struct.unpack_from(">BI", data, pos)
+    if value == _MISSING or factor == 0xff:
+        return None
+    # sign and magnitude
+    if factor & 0x80:
+        factor = -(factor & 0x7f)
+    if value & 0x80000000:
+        value = -(value & 0x7fffffff)
+    return value * 10 ** -factor
+
+def _format_number(value):
+    return "{0:g}".format(value)
+
+def _describe_level(levelType, value, secondType, secondValue):
+    """ @return the level as `wgrib2 -s' shows it """
+    (name, unit, mult) = _LEVEL_TYPES.get(levelType, (None, None, None))
+    if name is not None:
+        return name
+    if unit is None or value is None:
+        return "level type {0}".format(levelType)
+    if secondType == levelType and secondValue is not None:
+        return "{0}-{1} {2}".format(_format_number(value * mult),
+                                    _format_number(secondValue * mult), unit)
+    return "{0} {1}".format(_format_number(value * mult), unit)
+
+def _describe_time(unit, start, length, stat):
+    """
+    @return (forecast minutes, description as `wgrib2 -s' shows it)
+    """
+    minutes = _TIME_UNITS.get(unit)
+    unitName = _TIME_UNIT_NAMES.get(unit, "unit{0}".format(unit))
+    if stat is None:
+        if start == 0:
+            return (0, "anl")
+        return (start * minutes if minutes else None,
+                "{0} {1} fcst".format(start, unitName))
+    end = start + length
+    return (end * minutes if minutes else None,
+            "{0}-{1} {2} {3} fcst".format(start, end, unitName,
+                                          _STAT_NAMES.get(stat, "stat")))
+
+def _parse_product(data, pos, sectionLength):
+    """
+    Parse a section 4 at `pos' (product templates 4.0 to 4.15, which share
+    the first 34 octets)
+    @return dict of the GribMessage fields it defines
+    """
+    (template,) = struct.unpack_from(">H", data, pos + 7)
+    (category, number) = struct.unpack_from(">BB", data, pos + 9)
+    (unit, start, levelType) = struct.unpack_from(">BIB", data, pos + 17)
+    levelValue = _scaled_value(data, pos + 23)
+    (secondType,) = struct.unpack_from(">B", data, pos + 28)
+    secondValue = _scaled_value(data, pos + 29)
+    (stat, length) = (None, 0)
+    statPos = _STAT_OFFSETS.get(template)
+    if statPos is not None and sectionLength >= statPos + 8:
+        (stat, _, rangeUnit, length) = struct.unpack_from(">BBBI", data,
+                                                          pos + statPos)
+        if rangeUnit != unit:
+            length = length * _TIME_UNITS.get(rangeUnit, 0) // \
+                     _TIME_UNITS.get(unit, 1)
+    (fcstMinutes, ftime) = _describe_time(unit, start, length, stat)
+    return dict(category=category, number=number, level_type=levelType,
+                level_value=levelValue,
+                level=_describe_level(levelType, levelValue, secondType,
+                                      secondValue),
+                fcst_minutes=fcstMinutes, ftime=ftime)
+
+def scan_grib2(path, log=None):
+    """
+    Read the headers of the GriB 2 messages in `path'
+    @return list of GribMessage, in file order
+    @raise Exception if a message is truncated or malformed
+    """
+    if log is None:
+        log = _default_log()
+    messages = []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return messages
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fileSize = len(data)
+            pos = data.find(b"GRIB")
+            num = 0
+            while 0 <= pos < fileSize:
+                (edition,) = struct.unpack_from(">B", data, pos + 7)
+                if edition != 2:
+                    (length,) = struct.unpack_from(">I", b"\0" + data[pos+4:pos+7])
+                    log.warn("Skipping GriB {0} message at byte {1} of {2}"
+                             .format(edition, pos, path))
+                    pos = data.find(b"GRIB", pos + max(length, 4))
+                    continue
+                (discipline,) = struct.unpack_from(">B", data, pos + 6)
+                (length,) = struct.unpack_from(">Q", data, pos + 8)
+                end = pos + length
+                if end > fileSize or data[end-4:end] != b"7777":
+                    raise Exception("Truncated or malformed GriB message at "
+                                    "byte {0} of {1}".format(pos, path))
+                num += 1
+                submsg = 0
+                refDate = None
+                secPos = pos + 16
+                while secPos < end - 4:
+                    (secLength, secNum) = struct.unpack_from(">IB", data,
+                                                             secPos)
+                    if secLength < 5:
+                        raise Exception("Bad section length at byte {0} of "
+                                        "{1}".format(secPos, path))
+                    if secNum == 1:
+                        (year, month, day, hour) = struct.unpack_from(
+                                                       ">HBBB", data, secPos + 12)
+                        refDate = "{0:04d}{1:02d}{2:02d}{3:02d}".format(
+                                      year, month, day, hour)
+                    elif secNum == 4:
+                        submsg += 1
+                        fields = _parse_product(data, secPos, secLength)
+                        fields.update(num=num, submsg=submsg, offset=pos,
+                                      length=length, discipline=discipline,
+                                      ref_date=refDate,
+                                      name=PARAMETER_NAMES.get(
+                                          (discipline, fields["category"],
+                                           fields["number"]),
+                                          "var{0}_{1}_{2}".format(
+                                              discipline, fields["category"],
+                                              fields["number"])))
+                        messages.append(GribMessage(**fields))
+                    secPos += secLength
+                pos = data.find(b"GRIB", end)
+        finally:
+            data.close()
+    return messages
+
+
+def get_catalog_path(path, indexDir=None):
+    """ @return where the catalogue of `path' is saved """
+    return get_saved_path(path, CATALOG_SUFFIX, indexDir)
+
+
+class GribCatalog(DerivedFile):
+    """
+    The messages of a GriB 2 file, from its saved catalogue if it is up to
+    date or else by scanning it. See module docstring.
+    """
+    VERSION = CATALOG_VERSION
+    SUFFIX = CATALOG_SUFFIX
+
+    def __init__(self, path, indexDir=None, persist=True, log=None):
+        '''
+        @param path GriB 2 file
+        @param indexDir Where to save the catalogue (default: next to the
+               file)
+        @param persist Load and save the catalogue. Set to False for
+               temporary files
+        '''
+        DerivedFile.__init__(self, path, saveDir=indexDir, persist=persist,
+                             log=log if log is not None else _default_log())
+        self.catalog_path = self.saved_path
+        self.messages = self.data
+
+    def build(self):
+        return scan_grib2(self.path, self._log)
+
+    def write_saved(self, f, stamp, data):
+        saved = dict(stamp, messages=[list(m) for m in data])
+        json.dump(saved, f)
+
+    def read_saved(self, f):
+        saved = json.load(f)
+        stamp = dict((k, saved.get(k)) for k in ("version", "size", "mtime"))
+        return (stamp, [GribMessage(*entry) for entry in saved["messages"]])
+
+    def inventory(self):
+        """ @return list of the `wgrib2 -s' lines of the messages """
+        return [m.inventory_line() for m in self.messages]
+
+    def grep(self, pattern):
+        """
+        @return the messages whose inventory line matches the regular
+                expression `pattern' (like `wgrib2 -s | grep -E pattern')
+        """
+        regex = re.compile(pattern)
+        return [m for m in self.messages if regex.search(m.inventory_line())]
+
+    def find(self, name=None, level=None, fcstMinutes=None):
+        """
+        @return the messages with the given parameter `name', `level'
+                description (e.g. "850 mb") and forecast time; None matches
+                anything
+        """
+        return [m for m in self.messages
+                if (name is None or m.name == name)
+                and (level is None or m.level == level)
+                and (fcstMinutes is None or m.fcst_minutes == fcstMinutes)]
+
+    def read(self, message):
+        """ @return the bytes of the (whole) message of `message' """
+        with open(self.path, "rb") as f:
+            f.seek(message.offset)
+            return f.read(message.length)
+
+    def read_messages(self, messages):
+        """
+        Read the (whole) messages of `messages' in a single pass over the
+        file, in file order
+        @return list of their bytes, in the order of `messages'
+        """
+        data = {}
+        with open(self.path, "rb") as f:
+            for message in sorted(messages, key=lambda m: m.offset):
+                if message.offset not in data:
+                    f.seek(message.offset)
+                    data[message.offset] = f.read(message.length)
+        return [data[m.offset] for m in messages]
+
+    def copy(self, messages, fileObj):
+        """
+        Write the bytes of `messages' to `fileObj', in the given order. A
+        message with several fields is written once, with all its fields.
+        @return number of bytes written
+        """
+        written = set()
+        nbytes = 0
+        with open(self.path, "rb") as f:
+            for message in messages:
+                if message.offset in written:
+                    continue
+                written.add(message.offset)
+                f.seek(message.offset)
+                fileObj.write(f.read(message.length))
+                nbytes += message.length
+        return nbytes
+
+
+_catalogs = DerivedFileMemo(GribCatalog)
+
+def get_catalog(path, indexDir=None, persist=True, log=None):
+    """ @return the (memoized) GribCatalog of the GriB file `path' """
+    return _catalogs.get(path, indexDir=indexDir, persist=persist, log=log)
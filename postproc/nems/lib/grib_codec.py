@@ -0,0 +1,260 @@
+"""
+Decode and encode the fields of GriB 2 messages with NumPy, for the
+postprocessing tools that transform fields in-process instead of through
+wgrib2 (see regrid.py).
+
+Decoding needs the grid (section 3) and the data (sections 5 to 7):
+ - Grids: regular (template 3.0) and rotated (3.1) lat/lon grids. Other
+   grids raise UnsupportedGribError.
+ - Data: simple packing (template 5.0) is unpacked here. Other packings
+   (e.g. JPEG 2000, which UPP uses by default) are decoded with pygrib if it
+   is installed, otherwise they raise UnsupportedGribError too.
+Bitmaps are supported; missing points are NaN.
+
+Encoding writes a message on a regular lat/lon grid (template 3.0), with
+the identification (section 1) and product definition (section 4) of the
+source field and the values in simple packing (16 bits, with a bitmap if
+there are missing points).
+"""
+
+import math
+import struct
+import collections
+
+import numpy as np
+
+try:
+    import pygrib
+except ImportError:
+    pygrib = None
+
+# Bits used by encode_field()
+PACKING_BITS = 16
+
+_MISSING4 = 0xffffffff
+
+
+class UnsupportedGribError(Exception):
+    """ The grid or packing of a field cannot be handled here """
+    pass
+
+
+# A lat/lon grid, from section 3. Angles are in degrees; pole_lat, pole_lon
+# and rotation are only set for rotated grids (template 3.1)
+GridSpec = collections.namedtuple("GridSpec",
+               ["template", "ni", "nj", "la1", "lo1", "di", "dj", "scan",
+                "grid_relative_winds", "pole_lat", "pole_lon", "rotation"])
+
+# A decoded field: `values' has shape (nj, ni), in the scanning order of
+# `grid'. section1 and section4 are the raw bytes of those sections
+Field = collections.namedtuple("Field", ["discipline", "grid", "values",
+                                         "section1", "section4"])
+
+
+def _signed(value, nbits):
+    """ @return the value of a GriB sign-and-magnitude integer """
+    sign = 1 << (nbits - 1)
+    return -(value & (sign - 1)) if value & sign else value
+
+def _encode_signed(value, nbits):
+    """ @return the GriB sign-and-magnitude representation of `value' """
+    return (1 << (nbits - 1)) | -value if value < 0 else value
+
+def iter_fields(buf):
+    """
+    Generator of the fields of the GriB 2 message `buf': for each one, a
+    dictionary mapping the section numbers to (offset, length) of the
+    sections in effect for it (sections 2 to 7 can repeat in a message)
+    """
+    if buf[:4] != b"GRIB" or struct.unpack_from(">B", buf, 7)[0] != 2:
+        raise UnsupportedGribError("Not a GriB 2 message")
+    (length,) = struct.unpack_from(">Q", buf, 8)
+    end = length - 4
+    pos = 16
+    sections = {}
+    bitmap = None
+    while pos < end:
+        (secLength, secNum) = struct.unpack_from(">IB", buf, pos)
+        sections[secNum] = (pos, secLength)
+        if secNum == 6:
+            (indicator,) = struct.unpack_from(">B", buf, pos + 5)
+            if indicator == 0:
+                bitmap = (pos, secLength)
+            elif indicator == 254:
+                # previously defined bitmap
+                if bitmap is None:
+                    raise UnsupportedGribError("Reference to a missing bitmap")
+                sections[6] = bitmap
+        elif secNum == 7:
+            yield dict(sections)
+        pos += secLength
+
+def parse_grid(buf, pos):
+    """ @return GridSpec of the section 3 at `pos' """
+    (template,) = struct.unpack_from(">H", buf, pos + 12)
+    if template not in (0, 1):
+        raise UnsupportedGribError("Grid template 3.{0} is not supported"
+                                   .format(template))
+    (ni, nj, basicAngle, subdivisions) = struct.unpack_from(">IIII", buf,
+                                                            pos + 30)
+    (la1, lo1, resFlags, la2, lo2, di, dj, scan) = struct.unpack_from(
+                                                       ">IIBIIIIB", buf, pos + 46)
+    if scan & 0x30:
+        raise UnsupportedGribError("Scanning mode {0:#x} is not supported"
+                                   .format(scan))
+    unit = 1e-6
+    if basicAngle not in (0, _MISSING4) and subdivisions not in (0, _MISSING4):
+        unit = float(basicAngle) / subdivisions
+    (poleLat, poleLon, rotation) = (None, None, None)
+    if template == 1:
+        (poleLat, poleLon) = struct.unpack_from(">II", buf, pos + 72)
+        (rotation,) = struct.unpack_from(">f", buf, pos + 80)
+        (poleLat, poleLon) = (_signed(poleLat, 32) * unit,
+                              _signed(poleLon, 32) * unit)
+    return GridSpec(template=template, ni=ni, nj=nj,
+                    la1=_signed(la1, 32) * unit, lo1=_signed(lo1, 32) * unit,
+                    di=di * unit, dj=dj * unit, scan=scan,
+                    grid_relative_winds=bool(resFlags & 0x08),
+                    pole_lat=poleLat, pole_lon=poleLon, rotation=rotation)
+
+def _unpack_bits(data, nbits, count):
+    """ @return array of the `count' `nbits'-bit unsigned integers in `data' """
+    if nbits in (8, 16, 32):
+        return np.frombuffer(data, dtype=">u{0}".format(nbits // 8),
+                             count=count).astype(np.float64)
+    values = np.empty(count, dtype=np.float64)
+    weights = 2. ** np.arange(nbits - 1, -1, -1)
+    raw = np.frombuffer(data, dtype=np.uint8)
+    # a chunk of values starting on a byte boundary
+    chunk = 8 * 1024 * 1024 // nbits * 8
+    for start in range(0, count, chunk):
+        num = min(chunk, count - start)
+        firstByte = start * nbits // 8
+        nbytes = (num * nbits + 7) // 8
+        bits = np.unpackbits(raw[firstByte:firstByte + nbytes])
+        values[start:start+num] = bits[:num * nbits].reshape(num, nbits) \
+                                  .dot(weights)
+    return values
+
+def _decode_simple(buf, sections, numValues):
+    """ @return the values packed with template 5.0 """
+    (pos5, len5) = sections[5]
+    (ref,) = struct.unpack_from(">f", buf, pos5 + 11)
+    (binScale, decScale, nbits) = struct.unpack_from(">HHB", buf, pos5 + 15)
+    (binScale, decScale) = (_signed(binScale, 16), _signed(decScale, 16))
+    if nbits == 0:
+        return np.zeros(numValues) + ref / 10. ** decScale
+    (pos7, len7) = sections[7]
+    packed = _unpack_bits(buf[pos7 + 5:pos7 + len7], nbits, numValues)
+    return (ref + packed * 2. ** binScale) / 10. ** decScale
+
+def _decode_pygrib(buf, numFields):
+    """ @return the values of the first field of `buf', decoded by pygrib """
+    if pygrib is None:
+        raise UnsupportedGribError("Decoding this packing requires pygrib")
+    if numFields > 1:
+        raise UnsupportedGribError("pygrib only decodes the first field of "
+                                   "a message")
+    values = pygrib.fromstring(bytes(buf)).values
+    return np.ma.filled(np.ma.asarray(values, dtype=np.float64),
+                        np.nan).ravel()
+
+def decode_field(buf, submsg=1):
+    """
+    Decode field number `submsg' (from 1) of the GriB 2 message `buf'
+    @return a Field
+    @raise UnsupportedGribError if the grid or packing is not supported
+    """
+    fields = list(iter_fields(buf))
+    sections = fields[submsg - 1]
+    (discipline,) = struct.unpack_from(">B", buf, 6)
+    grid = parse_grid(buf, sections[3][0])
+    numPoints = grid.ni * grid.nj
+    (pos5, len5) = sections[5]
+    (numValues, template) = struct.unpack_from(">IH", buf, pos5 + 5)
+    bitmap = None
+    if 6 in sections:
+        (pos6, len6) = sections[6]
+        if struct.unpack_from(">B", buf, pos6 + 5)[0] == 0:
+            bitmap = np.unpackbits(np.frombuffer(buf[pos6 + 6:pos6 + len6],
+                                                 dtype=np.uint8))[:numPoints]
+            bitmap = bitmap.astype(bool)
+    if template == 0:
+        values = _decode_simple(buf, sections, numValues)
+        if bitmap is not None:
+            full = np.empty(numPoints)
+            full.fill(np.nan)
+            full[bitmap] = values
+            values = full
+    else:
+        # pygrib applies the bitmap
+        values = _decode_pygrib(buf, len(fields))
+    if values.size != numPoints:
+        raise UnsupportedGribError("Got {0} values for a {1}x{2} grid"
+                                   .format(values.size, grid.ni, grid.nj))
+    section = lambda num: buf[sections[num][0]:sum(sections[num])]
+    return Field(discipline=discipline, grid=grid,
+                 values=values.reshape(grid.nj, grid.ni),
+                 section1=section(1), section4=section(4))
+
+
+def _latlon_section(lat0, nlat, dlat, lon0, nlon, dlon):
+    """ @return section 3 of a regular lat/lon grid scanning from the SW """
+    micro = lambda deg: int(round(deg * 1e6))
+    latEnd = lat0 + (nlat - 1) * dlat
+    lonEnd = lon0 + (nlon - 1) * dlon
+    body = struct.pack(">BIBBH", 0, nlat * nlon, 0, 0, 0)
+    body += struct.pack(">BBIBIBI", 6, 0, 0, 0, 0, 0, 0)
+    body += struct.pack(">IIII", nlon, nlat, 0, _MISSING4)
+    body += struct.pack(">IIBIIIIB", _encode_signed(micro(lat0), 32),
+                        micro(lon0 % 360), 0x30,
+                        _encode_signed(micro(latEnd), 32), micro(lonEnd % 360),
+                        micro(dlon), micro(dlat), 0x40)
+    return struct.pack(">IB", 5 + len(body), 3) + body
+
+def _simple_packing(values):
+    """
+    @return (section 5, section 6, section 7) with the `values' (NaN for
+            missing) in simple packing
+    """
+    valid = ~np.isnan(values)
+    data = values[valid].astype(np.float64)
+    binScale = 0
+    nbits = 0
+    ref = np.float32(0)
+    packed = b""
+    if data.size:
+        (vmin, vmax) = (data.min(), data.max())
+        ref = np.float32(vmin)
+        if ref > vmin:
+            ref = np.nextafter(ref, np.float32(-np.inf))
+        if vmax > vmin:
+            nbits = PACKING_BITS
+            maxInt = 2 ** nbits - 1
+            binScale = int(math.ceil(math.log((vmax - float(ref)) / maxInt, 2)))
+            ints = np.round((data - float(ref)) / 2. ** binScale)
+            packed = np.clip(ints, 0, maxInt).astype(">u2").tobytes()
+    body5 = struct.pack(">IH", int(valid.sum()), 0) + struct.pack(">f", ref) + \
+            struct.pack(">HHBB", _encode_signed(binScale, 16), 0, nbits, 0)
+    if valid.all():
+        body6 = struct.pack(">B", 255)
+    else:
+        body6 = struct.pack(">B", 0) + np.packbits(valid).tobytes()
+    sec = lambda num, body: struct.pack(">IB", 5 + len(body), num) + body
+    return (sec(5, body5), sec(6, body6), sec(7, packed))
+
+def encode_field(field, values, lat0, dlat, lon0, dlon):
+    """
+    @param field Field whose identification and product definition are
+           used
+    @param values Array of shape (nlat, nlon) on the regular lat/lon grid
+           starting at (lat0, lon0), south to north and west to east
+    @return the bytes of the GriB 2 message
+    """
+    (nlat, nlon) = values.shape
+    body = field.section1 + _latlon_section(lat0, nlat, dlat, lon0, nlon,
+                                            dlon) + \
+           field.section4 + b"".join(_simple_packing(values.ravel()))
+    total = 16 + len(body) + 4
+    return b"GRIB" + struct.pack(">HBBQ", 0, field.discipline, 2, total) + \
+           body + b"7777"
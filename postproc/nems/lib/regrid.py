@@ -0,0 +1,252 @@
+"""
+Bilinear regridding of GriB 2 fields to a storm-centred lat/lon box, with
+NumPy instead of `wgrib2 -new_grid'.
+
+All the fields of a forecast offset share the source grid and the target
+box, so the interpolation weights (the 4 source points around each target
+point and their weights) and, for rotated source grids, the angles to turn
+grid-relative winds into earth-relative ones are computed once by
+RegridWeights and applied to every field. get_weights() keeps the weights
+of the last few (source grid, target box) pairs. regrid_messages_multi()
+cuts several boxes (e.g. one per storm) from each decoded field.
+
+The source fields are decoded and the result encoded with grib_codec.py, so
+only regular and rotated lat/lon source grids are supported (others raise
+grib_codec.UnsupportedGribError). Target points outside of the source grid
+are missing, as are points next to missing source points.
+As with `wgrib2 -new_grid_winds grid' to a lat/lon grid, winds come out
+earth-relative.
+"""
+
+import logging
+
+import numpy as np
+
+from grib_codec import decode_field, encode_field
+
+# Number of RegridWeights kept by get_weights()
+MAX_CACHED_WEIGHTS = 4
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='regrid'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class LatLonGrid(object):
+    """
+    Regular lat/lon target grid of `nlat' x `nlon' points, starting at
+    (`lat0', `lon0') and going north and east by `dlat' and `dlon' degrees
+    """
+    def __init__(self, lat0, nlat, dlat, lon0, nlon, dlon):
+        self.lat0 = lat0
+        self.nlat = nlat
+        self.dlat = dlat
+        self.lon0 = lon0
+        self.nlon = nlon
+        self.dlon = dlon
+
+    def key(self):
+        return (self.lat0, self.nlat, self.dlat, self.lon0, self.nlon,
+                self.dlon)
+
+    def latlons(self):
+        """ @return (lats, lons) arrays of shape (nlat, nlon) """
+        lats = self.lat0 + np.arange(self.nlat) * self.dlat
+        lons = self.lon0 + np.arange(self.nlon) * self.dlon
+        return np.meshgrid(lats, lons, indexing="ij")
+
+    def wgrib2_args(self):
+        """ @return (lon, lat) arguments of `wgrib2 -new_grid latlon' """
+        return ("{0}:{1}:{2}".format(self.lon0, self.nlon, self.dlon),
+                "{0}:{1}:{2}".format(self.lat0, self.nlat, self.dlat))
+
+
+def geographic_to_rotated(lats, lons, poleLat, poleLon, rotation=0.):
+    """
+    @return (lats, lons) in the rotated lat/lon system whose southern pole
+            is at (`poleLat', `poleLon'), as in GriB template 3.1
+    """
+    (phi, lam) = (np.radians(lats), np.radians(lons - poleLon))
+    theta = np.radians(90. + poleLat)
+    x = np.cos(phi) * np.cos(lam)
+    y = np.cos(phi) * np.sin(lam)
+    z = np.sin(phi)
+    xr = np.cos(theta) * x + np.sin(theta) * z
+    zr = -np.sin(theta) * x + np.cos(theta) * z
+    return (np.degrees(np.arcsin(np.clip(zr, -1., 1.))),
+            np.degrees(np.arctan2(y, xr)) - rotation)
+
+def rotated_to_geographic(lats, lons, poleLat, poleLon, rotation=0.):
+    """ Inverse of geographic_to_rotated() """
+    (phi, lam) = (np.radians(lats), np.radians(lons + rotation))
+    theta = np.radians(90. + poleLat)
+    xr = np.cos(phi) * np.cos(lam)
+    y = np.cos(phi) * np.sin(lam)
+    zr = np.sin(phi)
+    x = np.cos(theta) * xr - np.sin(theta) * zr
+    z = np.sin(theta) * xr + np.cos(theta) * zr
+    return (np.degrees(np.arcsin(np.clip(z, -1., 1.))),
+            np.degrees(np.arctan2(y, x)) + poleLon)
+
+
+class RegridWeights(object):
+    """
+    Bilinear interpolation weights from a source grid (grib_codec.GridSpec)
+    to a LatLonGrid. See module docstring.
+    """
+    def __init__(self, srcGrid, targetGrid):
+        self.src_grid = srcGrid
+        self.target_grid = targetGrid
+        (lats, lons) = targetGrid.latlons()
+        rotated = srcGrid.template == 1
+        if rotated:
+            (lats, lons) = geographic_to_rotated(lats, lons, srcGrid.pole_lat,
+                                                 srcGrid.pole_lon,
+                                                 srcGrid.rotation)
+        (ni, nj) = (srcGrid.ni, srcGrid.nj)
+        # fractional indices of the target points in the source grid
+        iSign = -1. if srcGrid.scan & 0x80 else 1.
+        jSign = 1. if srcGrid.scan & 0x40 else -1.
+        fi = ((lons - srcGrid.lo1) * iSign) % 360. / srcGrid.di
+        fj = (lats - srcGrid.la1) * jSign / srcGrid.dj
+        isGlobal = abs(ni * srcGrid.di - 360.) < srcGrid.di / 2.
+        valid = (fj >= 0) & (fj <= nj - 1)
+        if isGlobal:
+            i0 = np.floor(fi).astype(np.int64)
+            i1 = (i0 + 1) % ni
+        else:
+            valid &= fi <= ni - 1
+            i0 = np.clip(np.floor(fi).astype(np.int64), 0, max(ni - 2, 0))
+            i1 = np.minimum(i0 + 1, ni - 1)
+        j0 = np.clip(np.floor(fj).astype(np.int64), 0, max(nj - 2, 0))
+        j1 = np.minimum(j0 + 1, nj - 1)
+        wi = fi - i0
+        wj = fj - j0
+        self.valid = valid.ravel()
+        self.indices = np.array([j0 * ni + i0, j0 * ni + i1,
+                                 j1 * ni + i0, j1 * ni + i1]).reshape(4, -1)
+        self.weights = np.array([(1 - wi) * (1 - wj), wi * (1 - wj),
+                                 (1 - wi) * wj, wi * wj]).reshape(4, -1)
+        self.shape = (targetGrid.nlat, targetGrid.nlon)
+        # angle from true north to the grid's "north", to make
+        # grid-relative winds earth-relative
+        self.wind_angle = None
+        if rotated and srcGrid.grid_relative_winds:
+            (tLats, tLons) = targetGrid.latlons()
+            eps = 0.01
+            (nLats, nLons) = rotated_to_geographic(lats + eps, lons,
+                                                   srcGrid.pole_lat,
+                                                   srcGrid.pole_lon,
+                                                   srcGrid.rotation)
+            dLon = (nLons - tLons + 180.) % 360. - 180.
+            self.wind_angle = np.arctan2(dLon * np.cos(np.radians(tLats)),
+                                         nLats - tLats)
+
+    def interpolate(self, values):
+        """
+        @param values Array of shape (nj, ni) on the source grid
+        @return array of shape (nlat, nlon) on the target grid (NaN where
+                missing)
+        """
+        values = values.ravel()
+        out = (values[self.indices] * self.weights).sum(axis=0)
+        out[~self.valid] = np.nan
+        return out.reshape(self.shape)
+
+    def rotate_winds(self, u, v):
+        """
+        @param u,v Interpolated wind components, relative to the source grid
+        @return (u, v) relative to the earth
+        """
+        if self.wind_angle is None:
+            return (u, v)
+        (cos, sin) = (np.cos(self.wind_angle), np.sin(self.wind_angle))
+        return (u * cos + v * sin, -u * sin + v * cos)
+
+
+_weights = []
+
+def get_weights(srcGrid, targetGrid):
+    """
+    @return the RegridWeights from `srcGrid' to `targetGrid', reusing the
+            ones computed for the same grids recently
+    """
+    key = (srcGrid, targetGrid.key())
+    for (cachedKey, weights) in _weights:
+        if cachedKey == key:
+            return weights
+    weights = RegridWeights(srcGrid, targetGrid)
+    _weights.insert(0, (key, weights))
+    del _weights[MAX_CACHED_WEIGHTS:]
+    return weights
+
+def regrid_messages(messages, targetGrid, log=None):
+    """
+    Regrid GriB 2 fields to `targetGrid'
+    @param messages List of (message bytes, field number in the message,
+           parameter name). A "UGRD" must be followed by its "VGRD"
+    @return list of the bytes of the regridded messages, in the same order
+    @raise grib_codec.UnsupportedGribError if a grid or packing is not
+           supported
+    """
+    return regrid_messages_multi(messages, [targetGrid], log=log)[0]
+
+def regrid_messages_multi(messages, targetGrids, log=None):
+    """
+    Regrid GriB 2 fields to each of `targetGrids' (e.g. the boxes of several
+    storms), decoding each field only once
+    @param messages As for regrid_messages()
+    @return list with, for each target grid, the list of the bytes of the
+            regridded messages
+    @raise grib_codec.UnsupportedGribError if a grid or packing is not
+           supported
+    """
+    if log is None:
+        log = _default_log()
+    outs = [[] for targetGrid in targetGrids]
+    # weights by (source grid, target index), so that more target grids
+    # than MAX_CACHED_WEIGHTS do not thrash get_weights()
+    allWeights = {}
+    pending = None
+    for (buf, submsg, name) in messages:
+        field = decode_field(buf, submsg)
+        if name != "VGRD" and pending is not None:
+            raise Exception("UGRD is not followed by its VGRD")
+        for (idx, targetGrid) in enumerate(targetGrids):
+            key = (field.grid, idx)
+            if key not in allWeights:
+                allWeights[key] = get_weights(field.grid, targetGrid)
+            weights = allWeights[key]
+            values = weights.interpolate(field.values)
+            if name == "UGRD":
+                if pending is None:
+                    pending = (field, [])
+                pending[1].append(values)
+                continue
+            if name == "VGRD" and pending is not None:
+                (uField, uValues) = pending
+                (u, values) = weights.rotate_winds(uValues[idx], values)
+                outs[idx].append(_encode(uField, u, targetGrid))
+            outs[idx].append(_encode(field, values, targetGrid))
+        if name != "UGRD":
+            pending = None
+    if pending is not None:
+        raise Exception("UGRD is not followed by its VGRD")
+    log.debug("Regridded {0} fields to {1} grids".format(len(messages),
+                                                        len(targetGrids)))
+    return outs
+
+def _encode(field, values, targetGrid):
+    return encode_field(field, values, targetGrid.lat0, targetGrid.dlat,
+                        targetGrid.lon0, targetGrid.dlon)
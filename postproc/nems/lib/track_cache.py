@@ -0,0 +1,226 @@
+"""
+Storm tracks (TC vitals, ATCF or fort.69 files) as columns: sorted arrays of
+time, lat, lon, MSLP and maximum wind, for looking up the storm centre at
+any date and for plotting/comparing tracks.
+
+The files are parsed by pycane (trkutils.get_track_data()) once into a
+StormTrack, whose arrays are saved next to the file (as
+.<file name>.trk.npz) and reused as long as the size and mtime of the file
+do not change (see derived_file.py). Tracks are also memoized in the process
+by get_track().
+
+centre() finds the fixes around a date with a binary search and
+interpolates linearly between them (across the date line too), so dates
+between fixes (e.g. sub-hourly forecast offsets) get a smoothly moving
+centre instead of the one of the nearest fix. select() and resample()
+return the columns (TrackSeries) within a time window, the latter at
+regular times, interpolated between fixes; missing fixes (gaps in the
+file) are interpolated over or, if longer than `maxGap', left as NaN.
+"""
+
+import calendar
+import logging
+import collections
+from datetime import datetime as dtime
+
+import numpy as np
+
+from derived_file import DerivedFile, DerivedFileMemo, get_saved_path
+
+# Bump when the saved arrays change
+TRACK_VERSION = 2
+TRACK_SUFFIX = ".trk.npz"
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='track_cache'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+# Columns of a track, or part of it. `times' are in seconds since the epoch
+TrackSeries = collections.namedtuple("TrackSeries", ["times", "lats", "lons",
+                                                     "mslps", "maxwinds"])
+
+def to_seconds(date):
+    """ @return the (UTC) datetime `date' in seconds since the epoch """
+    return calendar.timegm(date.utctimetuple()) + date.microsecond * 1e-6
+
+def to_datetimes(times):
+    """ @return list of the datetimes of `times' (seconds since the epoch) """
+    return [dtime.utcfromtimestamp(t) for t in times]
+
+def _wrap_lons(lons, negative):
+    """
+    @return `lons' in -180..180 if `negative', else in 0..360
+    """
+    if negative:
+        return (lons + 180.) % 360. - 180.
+    return lons % 360.
+
+def _entry_value(entry, attr):
+    """ @return attribute `attr' of `entry' as a float (NaN if not set) """
+    value = getattr(entry, attr, None)
+    return np.nan if value is None else float(value)
+
+def parse_track(path):
+    """
+    Parse the track file `path' with pycane
+    @return TrackSeries of all the fixes, sorted by time
+    """
+    from pycane.postproc.tracker import utils as trkutils
+    trk = trkutils.get_track_data(path)
+    # maps forecast dates to pycane.postproc.tracker.objects.TrackerEntry
+    entries = sorted(trk.fcst_date_dict.items())
+    times = np.array([to_seconds(fdate) for (fdate, entry) in entries],
+                     dtype=np.float64)
+    lats = np.array([entry.lat for (fdate, entry) in entries],
+                    dtype=np.float64)
+    lons = np.array([entry.lon for (fdate, entry) in entries],
+                    dtype=np.float64)
+    mslps = np.array([_entry_value(entry, "mslp_value")
+                      for (fdate, entry) in entries])
+    maxwinds = np.array([_entry_value(entry, "maxwind_value")
+                         for (fdate, entry) in entries])
+    return TrackSeries(times, lats, lons, mslps, maxwinds)
+
+def get_track_path(path):
+    """ @return where the arrays of the track file `path' are saved """
+    return get_saved_path(path, TRACK_SUFFIX)
+
+
+class StormTrack(DerivedFile):
+    """
+    The fixes of a track file, from its saved arrays if they are up to date
+    or else by parsing it. See module docstring.
+    """
+    VERSION = TRACK_VERSION
+    SUFFIX = TRACK_SUFFIX
+    BINARY = True
+
+    def __init__(self, path, persist=True, log=None):
+        '''
+        @param path TC vitals or ATCF file
+        @param persist Load and save the parsed arrays
+        '''
+        DerivedFile.__init__(self, path, persist=persist,
+                             log=log if log is not None else _default_log())
+        self.track_path = self.saved_path
+        (self.times, self.lats, self.lons, self.mslps, self.maxwinds) = \
+            self.data
+        if len(self.times) == 0:
+            raise Exception("No fixes in track file {0}".format(path))
+
+    def build(self):
+        self._log.debug("Parsing track file {0}".format(self.path))
+        return parse_track(self.path)
+
+    def write_saved(self, f, stamp, data):
+        np.savez(f, **dict(stamp, **data._asdict()))
+
+    def read_saved(self, f):
+        saved = np.load(f)
+        stamp = dict(version=int(saved["version"]), size=int(saved["size"]),
+                     mtime=float(saved["mtime"]))
+        return (stamp, TrackSeries(*[saved[name]
+                                     for name in TrackSeries._fields]))
+
+    def covers(self, fdate):
+        """ @return True if `fdate' is between the first and last fixes """
+        t = to_seconds(fdate)
+        return self.times[0] <= t <= self.times[-1]
+
+    def centre(self, fdate, findNearest=False):
+        """
+        @param fdate datetime to get the storm centre at
+        @param findNearest If `fdate' is before the first or after the last
+               fix, use that fix instead of failing
+        @return (lat, lon) of the storm at `fdate', interpolated linearly
+                between the fixes around it
+        """
+        t = to_seconds(fdate)
+        idx = int(np.searchsorted(self.times, t))
+        if idx < len(self.times) and self.times[idx] == t:
+            return (float(self.lats[idx]), float(self.lons[idx]))
+        if idx == 0 or idx == len(self.times):
+            if not findNearest:
+                raise Exception("Date {0} is not within the track in {1}"
+                                .format(fdate, self.path))
+            idx = min(idx, len(self.times) - 1)
+            self._log.info("Date {0} is not within the track. Using the "
+                           "nearest fix".format(fdate))
+            return (float(self.lats[idx]), float(self.lons[idx]))
+        (t0, t1) = (self.times[idx - 1], self.times[idx])
+        w = (t - t0) / (t1 - t0)
+        lat = (1. - w) * self.lats[idx - 1] + w * self.lats[idx]
+        (lon0, lon1) = (self.lons[idx - 1], self.lons[idx])
+        # shortest way across the date line
+        lon1 = lon0 + (lon1 - lon0 + 180.) % 360. - 180.
+        lon = (1. - w) * lon0 + w * lon1
+        # keep the convention of the file (-180..180 or 0..360)
+        lon = _wrap_lons(lon, self.lons.min() < 0)
+        return (float(lat), float(lon))
+
+    def series(self):
+        """ @return TrackSeries of all the fixes """
+        return TrackSeries(self.times, self.lats, self.lons, self.mslps,
+                           self.maxwinds)
+
+    def select(self, startDate=None, endDate=None):
+        """
+        @return TrackSeries of the fixes from `startDate' (inclusive) to
+                `endDate' (exclusive); None means no limit
+        """
+        mask = np.ones(len(self.times), dtype=bool)
+        if startDate is not None:
+            mask &= self.times >= to_seconds(startDate)
+        if endDate is not None:
+            mask &= self.times < to_seconds(endDate)
+        return TrackSeries(*[column[mask] for column in self.series()])
+
+    def resample(self, startDate, endDate, interval, maxGap=None):
+        """
+        @param interval timedelta between the times of the result
+        @param maxGap timedelta; times between fixes further apart than it
+               are NaN (default: interpolate across any gap)
+        @return TrackSeries at `startDate', `startDate' + `interval', ...
+                until `endDate' (exclusive), interpolated linearly between
+                the fixes. Times outside of the track are NaN
+        """
+        t0 = to_seconds(startDate)
+        times = t0 + np.arange(0., to_seconds(endDate) - t0,
+                               interval.total_seconds())
+        interp = lambda values: np.interp(times, self.times, values,
+                                          left=np.nan, right=np.nan)
+        # interpolate the longitudes the shortest way across the date line
+        lons = np.degrees(np.unwrap(np.radians(self.lons)))
+        lons = _wrap_lons(interp(lons), self.lons.min() < 0)
+        series = TrackSeries(times, interp(self.lats), lons,
+                             interp(self.mslps), interp(self.maxwinds))
+        if maxGap is not None and len(self.times) > 1:
+            after = np.clip(np.searchsorted(self.times, times), 1,
+                            len(self.times) - 1)
+            gaps = self.times[after] - self.times[after - 1]
+            nearest = np.clip(np.searchsorted(self.times, times), 0,
+                              len(self.times) - 1)
+            onFix = self.times[nearest] == times
+            inGap = (gaps > maxGap.total_seconds()) & ~onFix
+            for column in series[1:]:
+                column[inGap] = np.nan
+        return series
+
+
+_tracks = DerivedFileMemo(StormTrack)
+
+def get_track(path, persist=True, log=None):
+    """ @return the (memoized) StormTrack of the track file `path' """
+    return _tracks.get(path, persist=persist, log=log)
@@ -0,0 +1,175 @@
+"""
+Figures comparing storm tracks: the tracks on a map, their MSLP and maximum
+wind against time, and a scatter plot of maximum wind vs MSLP.
+
+The tracks are loaded once with load_series() (from the arrays saved next to
+each file, see track_cache.py) and resampled to common times. Each figure is
+then drawn by render_figure(), from the series and the styling of each track
+passed as arguments, so render_figures() can draw them in parallel, each in
+its own process.
+
+matplotlib's backend (e.g. Agg) must be selected before this is imported.
+"""
+
+import logging
+import functools
+import importlib
+import multiprocessing
+
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.dates as mpl_dates
+from nwpy.viz.map import bling
+
+from track_cache import get_track, to_datetimes
+
+# Module with the plot_track() used for the track map
+TRACK_PLOTTER = "pycane.postproc.viz.tcv.track_plotter"
+# metric -> (TrackSeries column, y axis label, output file)
+METRICS = dict(mslp_value=("mslps", "MSLP (hPa)", "mslp.png"),
+               maxwind_value=("maxwinds", "Max 10m Wind (kts)", "maxwind.png"))
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='track_figures'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+def load_series(paths, startDate, endDate, interval, maxGap=None, log=None):
+    """
+    @param paths TC vitals or ATCF files
+    @param maxGap Missing fixes are interpolated over if the fixes around
+           them are at most this far apart (timedelta), else left as NaN
+    @return list of the track_cache.TrackSeries of each file, at
+            `startDate', `startDate' + `interval', ... until `endDate'
+    """
+    if log is None:
+        log = _default_log()
+    allSeries = []
+    for path in paths:
+        log.info("Loading track {0}".format(path))
+        allSeries.append(get_track(path, log=log).resample(
+                             startDate, endDate, interval, maxGap=maxGap))
+    return allSeries
+
+def render_tracks(allSeries, names, colors, lineWidths, extents,
+                  trackPlotter=TRACK_PLOTTER):
+    """
+    Plot all the tracks on one map, drawn and decorated once
+    @param trackPlotter Name of the module with plot_track()
+    @return the output file
+    """
+    track_plotter = importlib.import_module(trackPlotter)
+    plt.figure("tracks")
+    for (series, label, color, lineWidth) in zip(allSeries, names, colors,
+                                                 lineWidths):
+        valid = ~np.isnan(series.lats)
+        #day_idc = [ idx for idx,val in enumerate(fhrs) if val%TIME_MARKER_INTERVAL == 0 ]
+        m = track_plotter.plot_track(series.lats[valid].tolist(),
+                                 series.lons[valid].tolist(),
+                                 #windspeeds=maxwinds,
+                                 #indicator_freq=day_idc,
+                                 line_color=color, ns_gridline_freq=10, we_gridline_freq=10,
+                                 #flagged_idc=flagged_idc,
+                                 label=label,
+                                 extents=extents,
+                                 line_width=lineWidth)
+    bling.decorate_map(m)
+    # options worth testing: water_color='#99ffff',lake_color='#99ffff',
+    #continent_color='#cc9966'
+
+    # plot legend. The skip_duplicates arg must be True since the plot_track()
+    # function actually plots multiple lines for each track in order to vary
+    # the intensity of the color based on the max wind value
+    bling.create_simple_legend(skip_duplicates=True, position='upper right')
+
+    plt.savefig('tracks.png')
+    plt.close("tracks")
+    return 'tracks.png'
+
+def render_metric(metric, allSeries, names, colors, lineWidths):
+    """
+    Plot the `metric' (a key of METRICS) of the tracks against time
+    @return the output file
+    """
+    (column, yLabel, outfile) = METRICS[metric]
+    plt.figure(metric)
+    for (series, label, color, lineWidth) in zip(allSeries, names, colors,
+                                                 lineWidths):
+        times = mpl_dates.date2num(to_datetimes(series.times))
+        plt.plot(times, getattr(series, column), label=label, color=color,
+                 lw=lineWidth)
+    plt.gca().xaxis_date()
+    plt.gcf().autofmt_xdate()
+    plt.ylabel(yLabel)
+    plt.legend(loc='best')
+    plt.savefig(outfile)
+    plt.close(metric)
+    return outfile
+
+def render_scatter(allSeries, names, colors, markers):
+    """
+    Scatter plot of maxwind vs mslp
+    @return the output file
+    """
+    plt.figure("scatter")
+    for (series, label, color, marker) in zip(allSeries, names, colors,
+                                              markers):
+        valid = ~np.isnan(series.lats)
+        plt.scatter(series.maxwinds[valid], series.mslps[valid], label=label,
+                    color=color, marker=marker)
+    plt.legend(loc='best')
+    plt.xlabel("Max 10m wind speed (kts)")
+    plt.ylabel("MSLP (hPa)")
+    plt.savefig("scatter.png")
+    plt.close("scatter")
+    return "scatter.png"
+
+def render_figure(figure, allSeries, names, colors, lineWidths, extents=None,
+                  markers=None, trackPlotter=TRACK_PLOTTER):
+    """
+    Draw `figure': "tracks", "scatter" or a key of METRICS
+    @param allSeries list of the TrackSeries of each track (see
+           load_series())
+    @param names, colors, lineWidths, markers Label, color, line width and
+           scatter marker of each track, in the order of `allSeries'
+    @param extents Map extents of the "tracks" figure
+    @return the output file
+    """
+    if figure == "tracks":
+        return render_tracks(allSeries, names, colors, lineWidths, extents,
+                             trackPlotter)
+    elif figure == "scatter":
+        return render_scatter(allSeries, names, colors, markers)
+    return render_metric(figure, allSeries, names, colors, lineWidths)
+
+def render_figures(figures, allSeries, names, colors, lineWidths,
+                   extents=None, markers=None, trackPlotter=TRACK_PLOTTER,
+                   numWorkers=1):
+    """
+    Draw the `figures' (see render_figure() for the other arguments) with
+    up to `numWorkers' processes
+    @return list of the output files, in the order of `figures'
+    """
+    render = functools.partial(render_figure, allSeries=allSeries,
+                               names=names, colors=colors,
+                               lineWidths=lineWidths, extents=extents,
+                               markers=markers, trackPlotter=trackPlotter)
+    if numWorkers <= 1:
+        return [render(figure) for figure in figures]
+    pool = multiprocessing.Pool(min(numWorkers, len(figures)))
+    try:
+        return pool.map(render, figures)
+    finally:
+        pool.close()
+        pool.join()
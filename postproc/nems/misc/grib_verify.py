@@ -7,14 +7,27 @@ HOW TO USE
  b. Set `fields' according to field_lev_type:[fields] expected
  c. Ensure the other dictionaries are ok
 2. Run it
+
+The files are inventoried with their catalogue (see lib/grib_catalog.py),
+which is saved next to them, in parallel by `num_workers' processes. For
+each file, the number of messages, the set of levels (no duplicates, as
+many as expected), the parameter and the forecast time are checked.
+The results are cached in `cache_path' by file and level type (a file may
+be checked under several level types) with the file size and mtime, so only
+new or changed files are checked again when this is rerun, and all of them
+are written to the JSON report `report_path'; the problems are also printed.
 """
 
 import os
-import subprocess
+import json
+import multiprocessing
 from datetime import datetime as dtime
 from datetime import timedelta as tdelta
 import numpy as np
 
+from grib_catalog import get_catalog
+from derived_file import atomic_write
+
 #
 # SETTINGS
 #
@@ -36,7 +49,7 @@ fields = dict(
               sfc1=[ "PRES", "HGT", "POT", "SPFH", "TMP", "WEASD", "CAPE", "CIN", "VEG", "LAND"],
               hgt10=["UGRD", "VGRD", "SPFH", "POT"],
               hgt2 =["TMP", "SPFH", "DPT", "RH", "PRES"],
-              msl = ["PRMSL", "MSLET"] 
+              msl = ["PRMSL", "MSLET"],
               hyb=["DPT", "HGT", "POT", "PRES", "RH", "SPFH", "TMP", "VVEL"]
              )
 # How many level values are expected for each level type?
@@ -54,31 +67,170 @@ file_patterns = dict(prs="nmbprs_" + suffix_pattern,
                     )
 
 
+# Number of files checked in parallel
+num_workers = 8
+# Results of the previous runs, by file
+cache_path = "grib_verify_cache.json"
+# Summary of this run
+report_path = "grib_verify_report.json"
+
+# Bump when the checks change
+CHECKS_VERSION = 1
+
 ##
 # LOGIC
 ##
-for levType,fieldList in fields.iteritems():
-    for field in fieldList: 
-        numTimesteps =  ( (duration.total_seconds()-first_fhr*3600) / interval.total_seconds()) + 1
-        for fcstOffset in np.linspace(first_fhr*3600, duration.total_seconds(), 
-                                      numTimesteps):
-        #for fhr in range(first_fhr, duration_hrs+1, interval_hrs):
+def get_checks():
+    """
+    @return list of (file name, level type, field, fhr, fmin) to check
+    """
+    checks = []
+    numTimesteps =  ( (duration.total_seconds()-first_fhr*3600) / interval.total_seconds()) + 1
+    for levType,fieldList in fields.iteritems():
+        for field in fieldList: 
+            for fcstOffset in np.linspace(first_fhr*3600, duration.total_seconds(), 
+                                          numTimesteps):
                 fhr = int(fcstOffset / 3600)
-                #fhr = (fcstOffset / 3600).astype(np.int32)
                 fmin = int(( fcstOffset / 60 ) % 60)
-            #for fmin in minute_intervals:
                 args = dict(pname=field, init_date=init_date, fhr=fhr, fmin=fmin)
                 filename = file_patterns[levType].format(**args)
                 filename = os.path.join(files_topdir, filename)
-                wgrib_cmd = ["wgrib2", "-s", filename]
-                try:
-                    p = subprocess.check_call(wgrib_cmd) # ensure no errors first
-                    p = subprocess.Popen(wgrib_cmd, stdout=subprocess.PIPE)
-                    output = p.communicate()[0].strip()
-                    num_gribs = output.count("\n") + 1
-                    if num_gribs > expected_num_entries[levType]:
-                        print filename, ": expected:", expected_num_entries[levType], " ; found:", num_gribs
-                    elif num_gribs < expected_num_entries[levType]:
-                        print "PROBLEM: Less gribs than expected in", filename, "expected:", expected_num_entries[levType], " ; found:", num_gribs
-                except:
-                    print "Exception querying file: ", filename
+                checks.append((filename, levType, field, fhr, fmin))
+    return checks
+
+def get_signature(check):
+    """ @return what the result of `check' depends on, besides the file """
+    (filename, levType, field, fhr, fmin) = check
+    return [CHECKS_VERSION, levType, field, fhr, fmin,
+            expected_num_entries[levType]]
+
+def verify_file(check):
+    """
+    Check one file
+    @param check (file name, level type, field, fhr, fmin)
+    @return dictionary of the result: the file, its size and mtime, the
+            number of messages, its levels and the list of problems found
+    """
+    (filename, levType, field, fhr, fmin) = check
+    result = dict(file=filename, signature=get_signature(check),
+                  lev_type=levType, field=field, fhr=fhr, fmin=fmin,
+                  size=None, mtime=None, num_messages=None, levels=None,
+                  problems=[])
+    problems = result["problems"]
+    try:
+        st = os.stat(filename)
+    except OSError:
+        problems.append("missing")
+        return result
+    (result["size"], result["mtime"]) = (st.st_size, st.st_mtime)
+    try:
+        messages = get_catalog(filename).messages
+    except Exception as e:
+        problems.append("unreadable: {0}".format(e))
+        return result
+    expected = expected_num_entries[levType]
+    levels = [m.level for m in messages]
+    result["num_messages"] = len(messages)
+    result["levels"] = sorted(set(levels))
+    if len(messages) > expected:
+        problems.append("more messages than expected: {0} > {1}"
+                        .format(len(messages), expected))
+    elif len(messages) < expected:
+        problems.append("less messages than expected: {0} < {1}"
+                        .format(len(messages), expected))
+    if len(set(levels)) != len(levels):
+        duplicates = sorted(set(l for l in levels if levels.count(l) > 1))
+        problems.append("duplicate levels: {0}".format(", ".join(duplicates)))
+    if len(set(levels)) != expected:
+        problems.append("{0} distinct levels instead of {1}"
+                        .format(len(set(levels)), expected))
+    # names of unknown parameters are var<discipline>_<category>_<number>
+    names = set(m.name for m in messages if not m.name.startswith("var"))
+    if names - set([field]):
+        problems.append("unexpected parameters: {0}"
+                        .format(", ".join(sorted(names - set([field])))))
+    fcstMinutes = fhr * 60 + fmin
+    ftimes = set(m.ftime for m in messages
+                 if m.fcst_minutes is not None and m.fcst_minutes != fcstMinutes)
+    if ftimes:
+        problems.append("unexpected forecast times: {0}"
+                        .format(", ".join(sorted(ftimes))))
+    return result
+
+def _verify_file_safe(check):
+    """ verify_file() for the worker processes """
+    try:
+        return verify_file(check)
+    except Exception as e:
+        return dict(file=check[0], signature=get_signature(check),
+                    lev_type=check[1], size=None, mtime=None, problems=["error: {0}".format(e)])
+
+def get_cache_key(filename, levType):
+    """ @return the key of the result of checking `filename' as `levType' """
+    return "{0}|{1}".format(filename, levType)
+
+def load_cache():
+    """ @return the results of the previous runs, by get_cache_key() """
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_cache(cache):
+    with atomic_write(cache_path) as f:
+        json.dump(cache, f)
+
+def get_cached_result(cache, check):
+    """
+    @return the cached result of `check' if the file has not changed since,
+            or None
+    """
+    result = cache.get(get_cache_key(check[0], check[1]))
+    if result is None or result.get("size") is None \
+            or result.get("signature") != get_signature(check):
+        return None
+    try:
+        st = os.stat(check[0])
+    except OSError:
+        return None
+    if st.st_size != result["size"] or st.st_mtime != result["mtime"]:
+        return None
+    return result
+
+if __name__ == "__main__":
+    checks = get_checks()
+    cache = load_cache()
+    results = []
+    toCheck = []
+    for check in checks:
+        result = get_cached_result(cache, check)
+        if result is None:
+            toCheck.append(check)
+        else:
+            results.append(result)
+    print "Checking", len(toCheck), "files;", len(results), "unchanged since the last run"
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for result in pool.imap_unordered(_verify_file_safe, toCheck,
+                                          chunksize=16):
+            results.append(result)
+            # missing files are checked again next time
+            if result["size"] is not None:
+                cache[get_cache_key(result["file"], result["lev_type"])] = result
+    finally:
+        pool.close()
+        pool.join()
+    save_cache(cache)
+    results.sort(key=lambda r: (r["file"], r["lev_type"]))
+    problems = [r for r in results if r["problems"]]
+    for result in problems:
+        print "PROBLEM:", result["file"], "(" + result["lev_type"] + "):", \
+              "; ".join(result["problems"])
+    with open(report_path, "w") as f:
+        json.dump(dict(files_topdir=files_topdir, num_files=len(results),
+                       num_checked=len(toCheck), num_problems=len(problems),
+                       missing=sorted(set(r["file"] for r in problems
+                                          if r["problems"] == ["missing"])),
+                       results=results), f, indent=1)
+    print len(problems), "of", len(results), "files have problems. See", report_path
@@ -5,3 +5,6 @@ source /home/Javier.Delgado/apps/pycane_dist/master/etc/env.sh
 
 # need produtil from HWRF for file locking
 export PYTHONPATH=$PYTHONPATH:/home/Javier.Delgado/scratch/apps_tmp/pyhwrf/emc/dist/trunk/ush/
+
+# nr_utils postprocessing libraries (grib_catalog, ...)
+export PYTHONPATH=$PYTHONPATH:$(cd $(dirname ${BASH_SOURCE[0]:-$0})/../lib && pwd)
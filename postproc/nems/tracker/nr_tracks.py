@@ -15,12 +15,8 @@ import matplotlib.pyplot as plt
 import logging as log
 from datetime import datetime as dtime
 from datetime import timedelta as tdelta
-import copy
-import matplotlib.dates as mpl_dates
 
-from nwpy.viz.map import bling 
-from pycane.postproc.tracker import utils as trkutils 
-from pycane.postproc.viz.tcv import tcv_plot_helper, track_plotter 
+from track_figures import load_series, render_figures
 
 if __name__ == '__main__':
 
@@ -55,6 +51,9 @@ if __name__ == '__main__':
     #end_date = dtime(year=2006, month=9, day=12, hour=3) # g5nr ends 9/12@3z
     end_date = dtime(year=2006, month=9, day=11, hour=12) # ...and has gap @ 9/11@23z
     interval = tdelta(hours=1)
+    # Missing fixes (e.g. the g5nr gap @ 9/11@23z) are interpolated over if
+    # the fixes around them are at most this far apart, else left out
+    max_gap = tdelta(hours=6)
 
     # Set the "initialization" dates, which will be used to calculate the 
     # absolute dates.
@@ -64,66 +63,16 @@ if __name__ == '__main__':
     #paths[1].start_date = dtime(year=2006, month=9, day=4, hour=0) # set for gfdltrk too
     # how frequently to mark the line showing the track
     TIME_MARKER_INTERVAL = 6
+    # Number of figures rendered in parallel, each in its own process
+    num_workers = 3
 
     log.basicConfig(level=log.DEBUG)
 
-    for i,label in enumerate(names):
-        log.info("processing %s @ %s" %(names[i], paths[i]))
-        forecast_track = trkutils.get_track_data(paths[i])
-        times = []
-        datedict = forecast_track.fcst_date_dict
-        trkdata_filtered = []
-        currdate = copy.copy(start_date)
-        while currdate < end_date:
-            trkdata = datedict[currdate]
-            trkdata_filtered.append(trkdata)
-            times.append(mpl_dates.date2num(currdate))
-            currdate += interval
-        forecast_track.tracker_entries = trkdata_filtered
-        #day_idc = [ idx for idx,val in enumerate(fhrs) if val%TIME_MARKER_INTERVAL == 0 ]
-        plt.figure("tracks")
-        #(lats,lons) = [(trkentry.lat,trkentry.lon) for trkentry in forecast_track.tracker_entries]
-        lats = [trkentry.lat for trkentry in forecast_track.tracker_entries]
-        lons = [trkentry.lon for trkentry in forecast_track.tracker_entries]
-        m = track_plotter.plot_track(lats, lons, 
-                                 #windspeeds=maxwinds, 
-                                 #indicator_freq=day_idc,
-                                 line_color=colors[i], ns_gridline_freq=10, we_gridline_freq=10,
-                                 #flagged_idc=flagged_idc,
-                                 label=label, 
-                                 extents=extents,
-                                 line_width=line_widths[i])
-        #plt.figure("mslp")
-        #plt.plot(mslp_values, color=colors[i], lw=line_width, label=label)
-        for metric,yLabel in zip(["mslp_value","maxwind_value"], 
-                                 ["MSLP (hPa)", "Max 10m Wind (kts)"]):
-            # NOTE : Passing x_label messes up x axis formatting                                
-            plt.figure(metric)
-            tcv_plot_helper.plot_tcv_metric_vs_fhr(forecast_track, metric, y_label=yLabel,
-                                               time_axis_parameter="epoch_zeta",
-                                               label=label, color=colors[i],
-                                               lw=line_widths[i])
-        #plt.legend()
-        #plt.figure("maxwind_value")
-        #plt.plot(maxwinds, color=colors[i], lw=line_width, label=label)
-        #plt.legend()
-    plt.figure("tracks")
-    bling.decorate_map(m)
-    # options worth testing: water_color='#99ffff',lake_color='#99ffff', 
-    #continent_color='#cc9966'
-    
-    # plot legend. The skip_duplicates arg must be True since the plot_track()
-    # function actually plots multiple lines for each track in order to vary 
-    # the intensity of the color based on the max wind value
-    bling.create_simple_legend(skip_duplicates=True, position='upper right')
-    
-    plt.savefig('tracks.png')
-
-    plt.figure("mslp_value")
-    plt.legend(loc='best')
-    plt.savefig("mslp.png")
-
-    plt.figure("maxwind_value")
-    plt.legend(loc='best')
-    plt.savefig("maxwind.png")
-
+    # The tracks are loaded once (see lib/track_figures.py), then each
+    # figure is drawn in its own process
+    all_series = load_series(paths, start_date, end_date, interval,
+                             maxGap=max_gap)
+    outfiles = render_figures(["tracks", "mslp_value", "maxwind_value"],
+                              all_series, names, colors, line_widths,
+                              extents=extents, numWorkers=num_workers)
+    log.info("Created %s" % ", ".join(outfiles))
@@ -4,6 +4,8 @@ Sets up the environment from running the GFDL vortex tracker.
 
 import os
 import copy
+import logging
+from multiprocessing.pool import ThreadPool
 from datetime import datetime as dtime
 from datetime import timedelta as tdelta
 import subprocess
@@ -61,37 +63,99 @@ tracker_link_pattern = confget("tracker_link_pattern")
 tracker_util_path = confget("tracker_util_path")
 grbindex_exe = confget("grbindex_exe")
 tracker_exe = confget("tracker_exe")
+# Number of grbindex processes run in parallel
+num_workers = 1
+if conf.has_option("DEFAULT", "num_workers"):
+    num_workers = int(confget("num_workers"))
 
+def _default_log(log2stdout=logging.INFO, name='prepare_tracker_dir'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+_logger=None
+log = _default_log()
+
+
+def index_is_current(link):
+    """
+    @return True if the grbindex index of `link' exists and is newer than
+            the GriB 1 file it points to
+    """
+    try:
+        ixStat = os.stat(link + ".ix")
+        grbStat = os.stat(link)
+    except OSError:
+        return False
+    return ixStat.st_size > 0 and ixStat.st_mtime >= grbStat.st_mtime
+
+def create_index(link):
+    """
+    Index `link' with grbindex. The index is written to a temporary file
+    first, so an interrupted run does not leave an index that looks current
+    """
+    tmpIndex = link + ".ix.tmp"
+    subprocess.check_call([grbindex_exe, link, tmpIndex])
+    os.rename(tmpIndex, link + ".ix")
+    return link
 
 def create_links_and_index_files():
-    start_ymdh = "{0:%Y%m%d%H}".format(start_date)
-    pfx = gmodname + "." + gmodname
     """
-    for currfile in os.listdir(TRACKER_INPUTS_PATH):
-        if not currfile.startswith(pfx): continue
-        if currfile.endswith("ix"): continue
-        if not "fmin" in TRACKER_INPUT_FILE_PATTERN:
-            log.info("Assuming minutes not in tracker input files, setting to 0")
-            fmin = 0
+    Link the tracker input files of every forecast offset (including
+    sub-hourly ones) to the names the tracker expects and index them with
+    grbindex, with `num_workers' in parallel.
+    Links that are already correct are kept, and only the links whose index
+    is missing or older than the input file are (re)indexed, so rerunning
+    after new inputs are created only processes those. Inputs that do not
+    exist (yet) are skipped.
+    @return number of files indexed
     """
-    duration_hours = int(duration.total_seconds() / 3600)
-    duration_minutes = (duration.total_seconds() / 3600.) % 60  
-    freq_hours = int(input_frequency.total_seconds() / 3600)
+    duration_minutes = int(duration.total_seconds() / 60)
+    interval_mins = int(input_frequency.total_seconds() / 60)
     inp_args = dict(gmodname=gmodname, rundescr=rundescr, atcfname=atcf_name,
                     start_date=start_date )
-    for fhr in range(first_fhr, duration_hours+1, freq_hours):
-        # TODO : minutes
-        fmin = 0
-        #import pdb ; pdb.set_trace()
+    toIndex = []
+    missing = []
+    for totalMinutes in range(first_fhr*60, duration_minutes + 1, interval_mins):
+        (fhr, fmin) = divmod(totalMinutes, 60)
         inp_args.update({"fhr":fhr, "fmin":fmin})
-        infile = tracker_input_file_pattern.format(**inp_args)
-        fmin_5dig = (fhr * 60) + fmin
+        infile = os.path.join(tracker_inputs_path,
+                              tracker_input_file_pattern.format(**inp_args))
         lnk_args = copy.copy(inp_args)
-        lnk_args.update({"fmin":fmin_5dig})
+        lnk_args.update({"fmin":totalMinutes})
         link = tracker_link_pattern.format(**lnk_args)
+        if not os.path.exists(infile):
+            missing.append(infile)
+            continue
+        if os.path.islink(link) and os.readlink(link) == infile \
+                and index_is_current(link):
+            continue
         if os.path.islink(link): os.unlink(link)
         os.symlink(infile, link)
-        subprocess.check_call([grbindex_exe, link, link+".ix"])
+        toIndex.append(link)
+    if missing:
+        log.warn("{0} tracker input files do not exist, e.g. {1}"
+                 .format(len(missing), missing[0]))
+    log.info("Indexing {0} files with {1} workers".format(len(toIndex),
+                                                          num_workers))
+    if num_workers <= 1:
+        for link in toIndex:
+            create_index(link)
+    else:
+        pool = ThreadPool(num_workers)
+        try:
+            pool.map(create_index, toIndex)
+        finally:
+            pool.close()
+            pool.join()
+    return len(toIndex)
 
 def create_fort15():
     #import pdb ; pdb.set_trace()
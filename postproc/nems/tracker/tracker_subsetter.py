@@ -16,17 +16,26 @@ from datetime import datetime as dtime
 from datetime import timedelta as tdelta
 import logging
 import shutil
+import time
+import tempfile
+import multiprocessing
 import numpy as np
 from distutils.util import strtobool
 from ConfigParser import ConfigParser
 
 from  nwpy.dataproc.specdata import objects as specdata_objects
 from nwpy.dataproc.specdata.objects import SpecifiedForecastDataset as SpecData
-from pycane.postproc.tracker import utils as trkutils
-import produtil
 from produtil.cd import TempDir
 from produtil.run import mpirun, mpi, openmp, checkrun, bigexe
 
+from grib_catalog import get_catalog
+from grib_codec import UnsupportedGribError
+from regrid import LatLonGrid, regrid_messages_multi
+from track_cache import get_track
+from field_cache import FieldCache, make_key
+from file_watch import DirectoryWatcher, StableFiles, ProgressState
+from derived_file import atomic_write
+
 # The VGRD entries are automatically added to the UGRD during
 # processing since they must be regridded together
 # NOTE That this will put fields in a different order than HWRF
@@ -90,6 +99,14 @@ storm_number = int(confget("storm_number"))
 storm_basin = confget("storm_basin")
 storm_id = "{0:02d}{1}".format(storm_number, storm_basin)
 find_nearest_fdate = strtobool(confget("find_nearest_fdate"))
+# Multi-storm mode: subset the boxes of all the storms of `storm_ids' (e.g.
+# "08L, 09L") from each decoded field, writing each storm's files to a
+# subdirectory named after it
+multi_storm = conf.has_option("DEFAULT", "storm_ids")
+storm_ids = [storm_id]
+if multi_storm:
+    storm_ids = [s.strip() for s in confget("storm_ids").split(",")
+                 if s.strip()]
 
 ## The following 4 parameters determine the size and resolution of the output 
 nlats = int(confget("num_latitude_grid_points"))
@@ -99,6 +116,35 @@ dy = float(confget("dy"))
 make_grib1 = strtobool(confget("make_grib1"))
 grib2_to_grib1_exe = confget("grib2_to_grib1_exe")
 tmpdir = confget("temp_directory")
+# How fields are regridded: "numpy" (in-process, see lib/regrid.py; falls
+# back to wgrib2 for unsupported grids/packings) or "wgrib2"
+regrid_engine = "numpy"
+if conf.has_option("DEFAULT", "regrid_engine"):
+    regrid_engine = confget("regrid_engine")
+# Number of forecast offsets processed in parallel (1: serially)
+num_workers = 1
+if conf.has_option("DEFAULT", "num_workers"):
+    num_workers = int(confget("num_workers"))
+# Directory where the regridded fields are cached, keyed by their source
+# message and the target grid, so that reruns only regrid what changed (see
+# lib/field_cache.py). Not set or empty: no cache
+field_cache = None
+if conf.has_option("DEFAULT", "field_cache_dir") \
+        and confget("field_cache_dir").strip():
+    field_cache = FieldCache(confget("field_cache_dir").strip())
+# Bump when the regridded fields change for the same inputs
+FIELD_CACHE_VERSION = 1
+# Watch mode: process each forecast offset as soon as its UPP files are
+# complete (their size has not changed for watch_settle_seconds), while the
+# forecast runs. Progress is saved in watch_state_file so it can restart
+watch = False
+if conf.has_option("DEFAULT", "watch"):
+    watch = strtobool(confget("watch"))
+if watch:
+    watch_poll_seconds = float(confget("watch_poll_seconds"))
+    watch_settle_seconds = float(confget("watch_settle_seconds"))
+    watch_timeout_hours = float(confget("watch_timeout_hours"))
+    watch_state_file = confget("watch_state_file")
 
 def _default_log(log2stdout=logging.INFO, log2file=None, name='el_default'):
     global _logger
@@ -122,153 +168,397 @@ def _default_log(log2stdout=logging.INFO, log2file=None, name='el_default'):
     return _logger
 _logger=None
 
-def cat_file(src, dest):
-    """
-    Move a file from src path to dest path. If dest path exists, concatenate
-    it. This is a thread-safe operation, although it uses a rudimentary 
-    locking mechanism.
-    """
-    lock_file = os.path.join(os.path.dirname(dest), 
-                             ".lock_" + os.path.basename(dest))
-    with produtil.locking.LockFile(filename=lock_file, logger=log, max_tries=10) as lock:    
-        if os.path.exists(dest):
-            log.info("Destination file '{0}' exists. Will concatenate to it"
-                     .format(dest))
-            srcObj = open(src, "rb")
-            destObj = open(dest, 'ab')
-            shutil.copyfileobj(srcObj, destObj, 65536) # last arg=buff size
-            srcObj.close()
-            destObj.close()       
-        else:
-            log.debug("Moving file {0}->{1}".format(src, dest))
-            shutil.move(src, dest)
-    if not os.path.exists(lock_file):
-        log.warn("jza33 lock file {0} does not exist!".format(lock_file))
-    else:
-        os.unlink(lock_file)
+def write_messages(buffers, dest):
+    """
+    Write the GriB messages `buffers' to `dest' in one go, atomically (see
+    derived_file.atomic_write()), so `dest' is either missing or complete
+    """
+    with atomic_write(dest, "wb") as f:
+        for buf in buffers:
+            f.write(buf)
+    log.debug("Wrote {0} messages to {1}".format(len(buffers), dest))
 
-def get_cen_latlon(curr_fdate, find_nearest_fdate=False):
+def get_storm_track(curr_fdate, stormId=None):
     """
-    Using the TC vitals path for the storm, determine the center lat and lon
-    If find_nearest_fdate is True and the `curr_fdate' is not in the vitals,
-    find the nearest date
-    :returns: 2-tuple consisting of center lat and lon
+    @return the track_cache.StormTrack of the TC vitals of storm `stormId'
+            (default: storm_id)
     """
-    args = dict(fdate=curr_fdate, stormId=storm_id)
+    if stormId is None:
+        stormId = storm_id
+    args = dict(fdate=curr_fdate, stormId=stormId)
     path = tc_vitals_path.format(**args)
-    trk = trkutils.get_track_data(path)
-    # map forecast dates to pycane.postproc.tracker.objects.TrackerEntry objects
-    trk_fdates = trk.fcst_date_dict 
+    return get_track(path, log=log)
 
-    if curr_fdate in trk_fdates:
-        nearest = curr_fdate
-    elif find_nearest_fdate:
-        nearest = min(trk_fdates.keys(), key=lambda d: abs(d - curr_fdate) )
-        log.info("Current forecast date {0} is not in tc vitals. Using "
-                 " nearest date: {1}".format(curr_fdate, nearest))
-    else:
-        raise Exception("Current forecast date {0} is not in tc vitals"
-                        .format(curr_fdate))
-    cenlat = trk_fdates[nearest].lat
-    cenlon = trk_fdates[nearest].lon
+def get_cen_latlon(curr_fdate, find_nearest_fdate=False, stormId=None):
+    """
+    Using the TC vitals path for the storm `stormId' (default: storm_id),
+    determine the center lat and lon,
+    interpolated between the fixes around `curr_fdate' (see
+    lib/track_cache.py; the vitals are only parsed once).
+    If find_nearest_fdate is True and the `curr_fdate' is outside of the
+    vitals, use the nearest date
+    :returns: 2-tuple consisting of center lat and lon
+    """
+    track = get_storm_track(curr_fdate, stormId)
+    return track.centre(curr_fdate, find_nearest_fdate)
 
-    return (cenlat,cenlon)
 
+def find_messages(catalog, fieldstr, count=1):
+    """
+    @return the last `count' messages of GribCatalog `catalog' whose
+            inventory line matches `fieldstr' (like
+            `wgrib2 -s | grep -E fieldstr | tail -n count')
+    """
+    messages = catalog.grep(fieldstr)[-count:]
+    if not messages:
+        raise Exception("No message matching '{0}' in {1}"
+                        .format(fieldstr, catalog.path))
+    return messages
 
-def subset_and_regrid(infile, outfile, fieldstr, latstr, lonstr):
+def regrid(infile, outfile, latstr, lonstr):
     """
-    Extract a field from infile according to `fieldstr' which can be
-    just the field pname or "pname:levValue" or "pname:levValue levUnit"
+    Regrid all the messages of `infile' to the lat/lon grid given by `latstr'
+    and `lonstr', writing them to `outfile'
+    NOTE : U must be adjacent to V and come first in `infile' for the
+    new_grid option of wgrib2 to work
     """
-    # winds must be subset/regridded together
-    #import pdb ; pdb.set_trace()
-    if fieldstr[0:4] == "UGRD":
-        #import pdb ; pdb.set_trace()
-        lev = fieldstr.split(":")[1]
-        fieldstr = fieldstr + "|" + fieldstr.replace("UGRD","VGRD")
-    # hack : combine input files for U/V
-    # assume file name for VGRD is same as UGRD with VGRD in name instead
-    infile2 = infile.replace("UGRD", "VGRD")
-    if infile != infile2:
-        infile_tmp = os.path.join(tmpdir, "tmp_winds.grb2")
-        if os.path.exists(infile_tmp): os.unlink(infile_tmp)
-        #import pdb ; pdb.set_trace()
-        for fld,fil in zip(["UGRD","VGRD"], [infile, infile2]): 
-            # NOTE : U must be adjacent to V and come first in the grib file 
-            # for the new_grid option of wgrib2 to work
-            fld = fld + ":" + lev
-            tmp_tmpfile = infile_tmp + ".tmp"
-            if os.path.exists(tmp_tmpfile): os.unlink(tmp_tmpfile)
-            inv = subprocess.Popen(["wgrib2", "-s", fil], stdout=subprocess.PIPE)
-            subset = subprocess.Popen(["grep", "-E", fld], stdout=subprocess.PIPE, stdin=inv.stdout)
-            # ensure there is only one grib entry per field/lev since U and V must
-            # be adjacent
-            subset = subprocess.Popen(["tail", "-n", "1"], stdout=subprocess.PIPE, stdin=subset.stdout)
-            new = subprocess.check_output(["wgrib2", "-i", fil, "-GRIB", tmp_tmpfile ], stdin=subset.stdout)
-            cat_file(tmp_tmpfile, infile_tmp)
-        #import pdb ; pdb.set_trace()
-        infile = infile_tmp
-    inv = subprocess.Popen(["wgrib2", "-s", infile], stdout=subprocess.PIPE)
-    subset = subprocess.Popen(["grep", "-E", fieldstr], stdout=subprocess.PIPE, stdin=inv.stdout)
-    # take out duplicates
-    if "|" in fieldstr:
-        subset = subprocess.Popen(["tail","-n", "2"], stdout=subprocess.PIPE, stdin=subset.stdout)
+    subprocess.check_output(["wgrib2", infile, "-new_grid_winds", "grid",
+                             "-new_grid", "latlon", lonstr, latstr, outfile])
+
+def get_source_file(specdata, fieldstr):
+    """
+    @return path of the UPP file containing the field `fieldstr', which can
+            be just the field pname or "pname:levValue" or
+            "pname:levValue levUnit"
+    """
+    if not ":" in fieldstr:
+        fieldName = pname_to_standard_name(fieldstr)
+        return specdata.get_filename(fieldName, "2d")
+    fieldName,lev = fieldstr.split(":")
+    fieldName = pname_to_standard_name(fieldName)
+    if " m " in lev:
+        levType = "sfcDelta"
     else:
-        subset = subprocess.Popen(["tail","-n", "1"], stdout=subprocess.PIPE, stdin=subset.stdout)
-    #import pdb ; pdb.set_trace()
-    new = subprocess.check_output(["wgrib2", "-i", infile, "-new_grid_winds","grid",
-                                   "-new_grid", "latlon", lonstr, latstr,
-                                    outfile], stdin=subset.stdout)
-    
+        levType = "isobaric"
+    return specdata.get_filename(fieldName, levType)
+
+def get_subset_messages(specdata, fieldstr):
+    """
+    @return list of (source file, GribMessage) for `fieldstr'. UGRD fields
+            are followed by the matching VGRD, since winds must be regridded
+            together
+    """
+    filename = get_source_file(specdata, fieldstr)
+    # only one grib entry per field/lev since U and V must be adjacent
+    entries = [(filename, find_messages(get_catalog(filename), fieldstr)[0])]
+    if fieldstr[0:4] == "UGRD":
+        # hack : assume file name for VGRD is same as UGRD with VGRD in
+        # name instead
+        filename2 = filename.replace("UGRD", "VGRD")
+        fieldstr2 = fieldstr.replace("UGRD", "VGRD")
+        entries.append((filename2,
+                        find_messages(get_catalog(filename2), fieldstr2)[0]))
+    return entries
+
+def read_entries(entries):
+    """
+    Read the messages of `entries', list of (source file, GribMessage), in
+    a single pass per file
+    @return list of their bytes, in the same order
+    """
+    byFile = {}
+    for (idx, (filename, message)) in enumerate(entries):
+        byFile.setdefault(filename, []).append((idx, message))
+    data = [None] * len(entries)
+    for (filename, fileEntries) in byFile.items():
+        log.debug("Reading {0} messages from {1}".format(len(fileEntries),
+                                                         filename))
+        messages = [message for (idx, message) in fileEntries]
+        buffers = get_catalog(filename).read_messages(messages)
+        for ((idx, message), buf) in zip(fileEntries, buffers):
+            data[idx] = buf
+    return data
+
+def get_field_key(group, targetGrid):
+    """
+    @return the field_cache key of the regridded messages of `group' (the
+            entries of a field from get_subset_messages())
+    """
+    sources = []
+    for (filename, message) in group:
+        catalog = get_catalog(filename)
+        sources.append((os.path.abspath(filename), catalog.size,
+                        catalog.mtime, message.offset, message.submsg))
+    return make_key(FIELD_CACHE_VERSION, tuple(sources), targetGrid.key())
+
+def extract_fields(specdata, fieldstrs, targetGrids, scratchDir):
+    """
+    Extract the fields `fieldstrs' of a forecast offset from the UPP files
+    of `specdata' and regrid them to each of the LatLonGrid `targetGrids'
+    (one per storm).
+    The messages are found with the catalogue of each file (see
+    lib/grib_catalog.py) and read in a single pass per file. With the
+    "numpy" regrid_engine, they are decoded once and regridded in-process
+    to all the grids (lib/regrid.py), reusing the interpolation weights
+    across fields, and only the fields missing from `field_cache' (if set)
+    are regridded and then cached.
+    Otherwise, or if the source grid or packing is not supported, the
+    fields are regridded by one wgrib2 invocation per grid, with its files
+    in `scratchDir'.
+    @return for each target grid, the list of the bytes of the regridded
+            messages, in the order of `fieldstrs'
+    """
+    groups = [get_subset_messages(specdata, fieldstr)
+              for fieldstr in fieldstrs]
+    if regrid_engine == "numpy":
+        results = [[None] * len(groups) for targetGrid in targetGrids]
+        keys = [[None] * len(groups) for targetGrid in targetGrids]
+        if field_cache is not None:
+            for (t, targetGrid) in enumerate(targetGrids):
+                keys[t] = [get_field_key(group, targetGrid) for group in groups]
+                results[t] = [field_cache.get(key) for key in keys[t]]
+        # regridded for all the grids if missing for any
+        missing = [i for i in range(len(groups))
+                   if any(result[i] is None for result in results)]
+        if field_cache is not None:
+            numCached = sum(len([r for r in result if r is not None])
+                            for result in results)
+            log.info("{0} of {1} fields are cached"
+                     .format(numCached, len(groups) * len(targetGrids)))
+        entries = [entry for i in missing for entry in groups[i]]
+        try:
+            data = read_entries(entries)
+            regridded = regrid_messages_multi(
+                         [(buf, message.submsg, message.name)
+                          for (buf, (filename, message)) in zip(data, entries)],
+                         targetGrids, log=log)
+            for (t, gridMessages) in enumerate(regridded):
+                pos = 0
+                for i in missing:
+                    blob = b"".join(gridMessages[pos:pos + len(groups[i])])
+                    pos += len(groups[i])
+                    if results[t][i] is None:
+                        results[t][i] = blob
+                        if field_cache is not None:
+                            field_cache.put(keys[t][i], blob)
+            return results
+        except UnsupportedGribError as e:
+            log.warn("Cannot regrid in-process ({0}). Using wgrib2"
+                     .format(e))
+    entries = [entry for group in groups for entry in group]
+    data = read_entries(entries)
+    infile_tmp = os.path.join(scratchDir, "tmp_subset.grb2")
+    with open(infile_tmp, "wb") as f:
+        for buf in data:
+            f.write(buf)
+    results = []
+    for (t, targetGrid) in enumerate(targetGrids):
+        outfile_tmp = os.path.join(scratchDir,
+                                   "tmp_regridded.{0}.grb2".format(t))
+        (lonstr, latstr) = targetGrid.wgrib2_args()
+        regrid(infile_tmp, outfile_tmp, latstr, lonstr)
+        with open(outfile_tmp, "rb") as f:
+            results.append([f.read()])
+        os.unlink(outfile_tmp)
+    os.unlink(infile_tmp)
+    return results
+
 def pname_to_standard_name(name):
     d = dict(HGT="geopotential_height", VGRD="y_wind",
              UGRD="x_wind", ABSV="atmosphere_absolute_vorticity", PRMSL="mslp",
              TMP="air_temperature")
     return d[name]
 
-##
-# MAIN
-##
-numTimesteps =  ((duration.total_seconds()-first_fhr*3600) / interval.total_seconds()) + 1
-offsets = np.linspace(first_fhr*3600, duration.total_seconds(), numTimesteps)
-for fcstOffset in offsets:
+def get_fhr_fmin(fcstOffset):
+    """ @return (hour, minute) of the forecast offset `fcstOffset' (s) """
     fhr = int(fcstOffset / 3600)
     fmin = int( round(int( fcstOffset / 60 ) % 60, 0) )
-    #import pdb ; pdb.set_trace()
-    log = _default_log()
+    return (fhr, fmin)
+
+def get_specdata(fcstOffset):
+    """ @return the SpecData of the UPP files of forecast offset `fcstOffset' """
+    (fhr, fmin) = get_fhr_fmin(fcstOffset)
     data_topdir = data_topdir_pattern.format(init_date=start_date)
     fcst_offset = tdelta(hours=fhr, minutes=fmin)
-    specdata = SpecData(inspec, data_topdir, start_date,
-                        fcst_offset=fcst_offset, domain=domain,)
-                       # inspecsTopdir=INSPECS_TOPDIR)
+    return SpecData(inspec, data_topdir, start_date,
+                    fcst_offset=fcst_offset, domain=domain,)
+                   # inspecsTopdir=INSPECS_TOPDIR)
+
+def get_needed_files(fcstOffset):
+    """
+    @return set of the UPP files needed for forecast offset `fcstOffset'
+    """
+    specdata = get_specdata(fcstOffset)
+    paths = set()
+    for fieldstr in TRACKER_SUBSET:
+        filename = get_source_file(specdata, fieldstr)
+        paths.add(filename)
+        if fieldstr[0:4] == "UGRD":
+            # see get_subset_messages()
+            paths.add(filename.replace("UGRD", "VGRD"))
+    return paths
+
+def get_outfile(fhr, fmin, stormId):
+    """
+    @return path of the GriB 2 tracker input file of storm `stormId' at the
+            given forecast hour and minute
+    """
     outfile = "nmbtrk.{init_date:%Y%m%d%H}.f{fhr:03d}.{fmin:02d}.grb2"
     outfile = outfile.format(init_date=start_date, fhr=fhr, fmin=fmin)
-    for fieldstr in TRACKER_SUBSET:
-        #print fieldstr
-        if not ":" in fieldstr:
-            fieldName = pname_to_standard_name(fieldstr)
-            filename = specdata.get_filename(fieldName, "2d")
-        else:
-            fieldName,lev = fieldstr.split(":")
-            fieldName = pname_to_standard_name(fieldName)
-            if " m " in lev: 
-                levType = "sfcDelta"
-                levVal = int(lev.split(" ")[0])
-            else:
-                levType = "isobaric"
-                levVal = int(lev)
-            filename = specdata.get_filename(fieldName, levType)
-        print 'filename = ', filename
-        
-        curr_fdate = start_date + fcst_offset
-        (cenlat,cenlon) = get_cen_latlon(curr_fdate, find_nearest_fdate)
+    if multi_storm:
+        outfile = os.path.join(stormId, outfile)
+    return outfile
+
+def process_offset(fcstOffset):
+    """
+    Create the tracker input file(s) of the forecast offset `fcstOffset'
+    (seconds) for each of `storm_ids', using a scratch directory of its own
+    under `tmpdir' so that offsets can be processed concurrently.
+    In multi-storm mode, storms whose vitals do not cover the offset are
+    skipped, unless `find_nearest_fdate' is set
+    @return list of the paths of the GriB 2 output files
+    """
+    (fhr, fmin) = get_fhr_fmin(fcstOffset)
+    fcst_offset = tdelta(hours=fhr, minutes=fmin)
+    specdata = get_specdata(fcstOffset)
+    curr_fdate = start_date + fcst_offset
+    stormIds = []
+    targetGrids = []
+    for stormId in storm_ids:
+        if multi_storm and not find_nearest_fdate \
+                and not get_storm_track(curr_fdate, stormId).covers(curr_fdate):
+            log.info("Storm {0} is not active at {1}. Skipping it"
+                     .format(stormId, curr_fdate))
+            continue
+        (cenlat,cenlon) = get_cen_latlon(curr_fdate, find_nearest_fdate,
+                                         stormId)
         south_lat = cenlat - ( (nlats/2) * dy ) 
         west_lon = cenlon - ( (nlons/2) * dx )
-        latstr = str(south_lat) + ":" + str(nlats) + ":" + str(dy)
-        lonstr = str(west_lon) + ":" + str(nlons) + ":" + str(dx)
-        outfile_tmp = outfile + ".tmp"
-        subset_and_regrid(filename, outfile_tmp, fieldstr, latstr, lonstr)
-        cat_file(outfile_tmp, outfile)
-        #output to merged outfile
-    if make_grib1:
-        subprocess.check_call([grib2_to_grib1_exe, outfile, outfile.replace("grb2","grb1")])
+        stormIds.append(stormId)
+        targetGrids.append(LatLonGrid(south_lat, nlats, dy, west_lon, nlons,
+                                      dx))
+    if not targetGrids:
+        return []
+    scratchDir = tempfile.mkdtemp(prefix="trk_f{0:03d}.{1:02d}.".format(fhr, fmin),
+                                  dir=tmpdir)
+    try:
+        # all the fields and storms in one go
+        stormMessages = extract_fields(specdata, TRACKER_SUBSET, targetGrids,
+                                       scratchDir)
+    finally:
+        shutil.rmtree(scratchDir, ignore_errors=True)
+    outfiles = []
+    for (stormId, messages) in zip(stormIds, stormMessages):
+        outfile = get_outfile(fhr, fmin, stormId)
+        if os.path.dirname(outfile) and not os.path.isdir(os.path.dirname(outfile)):
+            try:
+                os.makedirs(os.path.dirname(outfile))
+            except OSError:
+                # created by another worker in the meantime
+                if not os.path.isdir(os.path.dirname(outfile)):
+                    raise
+        write_messages(messages, outfile)
+        if make_grib1:
+            subprocess.check_call([grib2_to_grib1_exe, outfile, outfile.replace("grb2","grb1")])
+        outfiles.append(outfile)
+    return outfiles
+
+def _process_offset_safe(fcstOffset):
+    """
+    process_offset() for the worker processes
+    @return (fcstOffset, output files or None, error message or None)
+    """
+    try:
+        return (fcstOffset, process_offset(fcstOffset), None)
+    except Exception as e:
+        log.exception("Processing offset {0}s failed".format(fcstOffset))
+        return (fcstOffset, None, str(e))
+
+def process_offsets(offsets, pool=None):
+    """
+    Process the forecast `offsets', with the multiprocessing `pool' if
+    given; failures are logged
+    @return list of the offsets that failed
+    """
+    if pool is None:
+        results = (_process_offset_safe(fcstOffset) for fcstOffset in offsets)
+    else:
+        results = pool.imap_unordered(_process_offset_safe, offsets)
+    failed = []
+    for (fcstOffset, outfiles, error) in results:
+        if error is None:
+            log.info("Created {0}".format(", ".join(outfiles) or "nothing"))
+            if watch:
+                progress.mark_done(fcstOffset, outfiles)
+        else:
+            failed.append(fcstOffset)
+    return failed
+
+def watch_offsets(offsets, pool=None):
+    """
+    Process the forecast `offsets' as their UPP files are completed
+    @return list of the offsets that failed
+    """
+    data_topdir = data_topdir_pattern.format(init_date=start_date)
+    watcher = DirectoryWatcher(data_topdir, pollInterval=watch_poll_seconds,
+                               log=log)
+    stability = StableFiles(watch_settle_seconds)
+    pending = [o for o in offsets if not progress.is_done(o)]
+    neededFiles = dict((o, get_needed_files(o)) for o in pending)
+    failed = []
+    lastProgress = time.time()
+    try:
+        while pending:
+            ready = [o for o in pending
+                     if stability.all_stable(neededFiles[o])]
+            if ready:
+                log.info("UPP files of {0} forecast offsets are complete"
+                         .format(len(ready)))
+                failed.extend(process_offsets(ready, pool))
+                pending = [o for o in pending if o not in ready]
+                for o in ready:
+                    stability.forget(neededFiles.pop(o))
+                lastProgress = time.time()
+                continue
+            if time.time() - lastProgress > watch_timeout_hours * 3600:
+                raise Exception("No new UPP output in {0} hours; {1} forecast "
+                                "offsets left".format(watch_timeout_hours,
+                                                      len(pending)))
+            # wake up on a change, but come back to check the files that are
+            # settling
+            watcher.wait(min(watch_poll_seconds, watch_settle_seconds))
+    finally:
+        watcher.close()
+    return failed
+
+##
+# MAIN
+##
+log = _default_log()
+numTimesteps =  ((duration.total_seconds()-first_fhr*3600) / interval.total_seconds()) + 1
+offsets = np.linspace(first_fhr*3600, duration.total_seconds(), numTimesteps)
+pool = None
+if num_workers > 1:
+    # Each worker does whole offsets, including the GriB 1 conversion
+    log.info("Processing forecast offsets with {0} workers"
+             .format(num_workers))
+    pool = multiprocessing.Pool(num_workers)
+try:
+    if watch:
+        progress = ProgressState(watch_state_file,
+                                 runKey="{0:%Y%m%d%H%M}".format(start_date),
+                                 log=log)
+        failed = watch_offsets(offsets, pool)
+    elif pool is None:
+        for fcstOffset in offsets:
+            process_offset(fcstOffset)
+        failed = []
+    else:
+        failed = process_offsets(offsets, pool)
+finally:
+    if pool is not None:
+        pool.close()
+        pool.join()
+if failed:
+    raise Exception("Processing failed for forecast offsets (s): {0}"
+                    .format(sorted(failed)))
@@ -5,3 +5,5 @@ export PYTHONPATH=$PYTHONPATH:/home/Javier.Delgado/scratch/apps_tmp/pyhwrf/emc/d
 source ~/apps/pycane_dist/master/etc/env.sh
 # markup.py
 export PYTHONPATH=$PYTHONPATH:/home/Javier.Delgado/libs/third_party:$PYTHONPATH
+# nr_utils postprocessing libraries (grib_catalog, ...)
+export PYTHONPATH=$PYTHONPATH:$(cd $(dirname ${BASH_SOURCE[0]:-$0})/../lib && pwd)
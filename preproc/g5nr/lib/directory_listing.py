@@ -0,0 +1,174 @@
+"""
+Cache of remote directory listings, used to plan downloads.
+
+The collections are organized in one directory per day (see
+g5nr_collections.py), so instead of changing into the directory of every
+file and finding out that a file does not exist when RETR fails, the
+retrievers list each day directory once and look files up in the listing.
+The sizes in the listing are passed to the transfer functions, which saves
+the SIZE round trip too.
+
+Listings are obtained with MLSD. If the server does not support it, NLST is
+used instead; sizes are then unknown (None) and are queried when the file is
+transferred. A directory that does not exist has an empty listing.
+
+The cache may be shared by several threads.
+"""
+
+import ftplib
+import logging
+import threading
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='directory_listing'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+def _is_unsupported(e):
+    """ @return True if the error_perm `e' means the command is not supported """
+    return str(e)[:3] in ("500", "501", "502", "504")
+
+def parse_mlsd_line(line):
+    """
+    Parse a line of MLSD output, e.g.
+      type=file;size=1234;modify=20060910000000; c1440_NR.foo.nc4
+    @return (name, facts), where `facts' maps lower-case fact names to values
+    """
+    (factStr, name) = line.split(" ", 1)
+    facts = {}
+    for fact in factStr.split(";"):
+        if "=" in fact:
+            (key, value) = fact.split("=", 1)
+            facts[key.lower()] = value
+    return (name, facts)
+
+def list_directory_mlsd(ftp, remoteDir):
+    """
+    @return dict mapping the names of the files in `remoteDir' to their size
+            (None if not given)
+    @raise ftplib.error_perm if the directory does not exist or MLSD is not
+           supported
+    """
+    lines = []
+    ftp.retrlines("MLSD " + remoteDir, lines.append)
+    files = {}
+    for line in lines:
+        (name, facts) = parse_mlsd_line(line)
+        if facts.get("type", "file").lower() != "file":
+            continue
+        size = facts.get("size")
+        files[name] = int(size) if size is not None else None
+    return files
+
+def list_directory_nlst(ftp, remoteDir):
+    """
+    @return dict mapping the names of the entries in `remoteDir' to None
+    @raise ftplib.error_perm if the directory does not exist
+    """
+    lines = []
+    ftp.retrlines("NLST " + remoteDir, lines.append)
+    # some servers return full paths
+    return dict((line.rsplit("/", 1)[-1], None) for line in lines if line)
+
+
+class DirectoryListingCache(object):
+    """
+    Listings of remote directories, each retrieved once. See module
+    docstring.
+    """
+    def __init__(self, log=None):
+        self._log = log if log is not None else _default_log()
+        self._listings = {}
+        self._lock = threading.Lock()
+        # Directories being listed by some thread -> Event set when done
+        self._pending = {}
+        self.use_mlsd = True
+        self.num_listings = 0
+
+    def _retrieve(self, ftp, remoteDir):
+        if self.use_mlsd:
+            try:
+                return list_directory_mlsd(ftp, remoteDir)
+            except ftplib.error_perm as e:
+                if not _is_unsupported(e):
+                    raise
+                self._log.info("Server does not support MLSD ({0}). Using "
+                               "NLST".format(e))
+                self.use_mlsd = False
+        return list_directory_nlst(ftp, remoteDir)
+
+    def listing(self, ftp, remoteDir):
+        """
+        @return dict mapping the names of the files in `remoteDir' to their
+                size (or None if unknown). Empty if the directory does not
+                exist. The listing is retrieved over `ftp' the first time
+                `remoteDir' is requested.
+        Transient errors are propagated (and nothing is cached), so the call
+        can be retried, e.g. with FTPConnectionPool.run()
+        """
+        while True:
+            with self._lock:
+                if remoteDir in self._listings:
+                    return self._listings[remoteDir]
+                event = self._pending.get(remoteDir)
+                if event is None:
+                    event = self._pending[remoteDir] = threading.Event()
+                    break
+            # Another thread is listing this directory
+            event.wait()
+        try:
+            try:
+                files = self._retrieve(ftp, remoteDir)
+            except ftplib.error_perm as e:
+                self._log.info("Unable to list {0} ({1}). Assuming it does "
+                               "not exist".format(remoteDir, e))
+                files = {}
+            with self._lock:
+                self._listings[remoteDir] = files
+                self.num_listings += 1
+            return files
+        finally:
+            with self._lock:
+                del self._pending[remoteDir]
+            event.set()
+
+    def lookup(self, ftp, remoteDir, fileName):
+        """
+        @return (exists, size) of `fileName' in `remoteDir'. `size' is None if
+                the file does not exist or its size is unknown.
+        """
+        files = self.listing(ftp, remoteDir)
+        return (fileName in files, files.get(fileName))
+
+    def cached(self, remoteDir):
+        """ @return the cached listing of `remoteDir', or None """
+        with self._lock:
+            return self._listings.get(remoteDir)
+
+    def set(self, remoteDir, files):
+        """
+        Store the listing of `remoteDir' obtained by other means (e.g. by a
+        client that does not use ftplib)
+        """
+        with self._lock:
+            self._listings[remoteDir] = files
+            self.num_listings += 1
+
+    def invalidate(self, remoteDir=None):
+        """ Forget the listing of `remoteDir', or of all directories """
+        with self._lock:
+            if remoteDir is None:
+                self._listings.clear()
+            else:
+                self._listings.pop(remoteDir, None)
@@ -0,0 +1,252 @@
+"""
+Journal of the files downloaded by the collection retrievers.
+
+This replaces the pickled `already_there' list. Entries are kept in an
+indexed SQLite table, so membership checks do not depend on the number of
+files downloaded, and each entry is committed as soon as it is recorded
+(there is no need to re-write the whole database after every file, and a
+killed job loses at most the file being transferred).
+For every file, the name, size, modification time and (optionally) checksum
+are kept.
+
+The journal may be shared by several threads of the same process.
+
+To convert a "database" from the old retrievers:
+    journal = DownloadJournal("downloads.sqlite")
+    journal.import_pickle("already_there.pickle")
+or, from the command line:
+    python download_journal.py downloads.sqlite already_there.pickle
+The retrievers import it themselves (see open_journal()) when the pickle is
+passed as their second argument or in place of the journal, as long as the
+journal does not exist yet.
+"""
+
+import os
+import sys
+import time
+import pickle
+import hashlib
+import sqlite3
+import threading
+
+CHECKSUM_ALGORITHM = "md5"
+# First bytes of an SQLite database file
+SQLITE_HEADER = b"SQLite format 3\x00"
+JOURNAL_SUFFIX = ".sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    checksum TEXT,
+    recorded REAL
+)
+"""
+
+def file_checksum(path, algorithm=CHECKSUM_ALGORITHM, bufSize=4*1024*1024):
+    """
+    @return hex digest of the file at `path'
+    """
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(bufSize)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+class ChecksumWriter(object):
+    """
+    Wraps a file object so the checksum is computed as data are written,
+    i.e. without reading the file back. Pass its write() as the ftplib
+    callback.
+    """
+    def __init__(self, fileObj, algorithm=CHECKSUM_ALGORITHM):
+        self.file = fileObj
+        self._hash = hashlib.new(algorithm)
+        self.num_bytes = 0
+
+    def digest_existing(self, path, length):
+        """
+        Add the first `length' bytes of `path' (e.g. a partial download that
+        is being resumed) to the checksum, without writing them
+        """
+        with open(path, "rb") as f:
+            remaining = length
+            while remaining > 0:
+                buf = f.read(min(remaining, 4*1024*1024))
+                if not buf:
+                    break
+                self._hash.update(buf)
+                remaining -= len(buf)
+        self.num_bytes += length - remaining
+
+    def write(self, data):
+        self._hash.update(data)
+        self.num_bytes += len(data)
+        self.file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class JournalEntry(object):
+    def __init__(self, name, size, mtime, checksum, recorded):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.checksum = checksum
+        self.recorded = recorded
+
+
+class DownloadJournal(object):
+    """
+    Indexed, crash-safe record of downloaded files. See module docstring.
+    """
+    def __init__(self, path):
+        '''
+        @param path Path to the journal (an SQLite database). It is created
+               if it does not exist.
+        '''
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     timeout=60)
+        # WAL lets readers in other processes (e.g. ready-date checks) look
+        # at the journal while we are writing to it
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def __contains__(self, name):
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM files WHERE name=?",
+                                     (name,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def get(self, name):
+        """ @return the JournalEntry for `name', or None """
+        with self._lock:
+            row = self._conn.execute(
+                    "SELECT name, size, mtime, checksum, recorded FROM files "
+                    "WHERE name=?", (name,)).fetchone()
+        if row is None:
+            return None
+        return JournalEntry(*row)
+
+    def names(self):
+        """ @return set of all the file names in the journal """
+        with self._lock:
+            rows = self._conn.execute("SELECT name FROM files").fetchall()
+        return set(r[0] for r in rows)
+
+    def record(self, name, path=None, size=None, mtime=None, checksum=None):
+        """
+        Add (or update) the entry for `name'. If `path' is given, the size
+        and mtime are taken from the file unless they are passed in.
+        The entry is committed immediately.
+        """
+        if path is not None:
+            st = os.stat(path)
+            if size is None:
+                size = st.st_size
+            if mtime is None:
+                mtime = st.st_mtime
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (name, size, mtime, checksum, "
+                "recorded) VALUES (?, ?, ?, ?, ?)",
+                (name, size, mtime, checksum, time.time()))
+            self._conn.commit()
+
+    def remove(self, name):
+        with self._lock:
+            self._conn.execute("DELETE FROM files WHERE name=?", (name,))
+            self._conn.commit()
+
+    def import_pickle(self, picklePath):
+        """
+        Import the names in a pickled `already_there' list created by the
+        old retrievers. Size, mtime and checksum are unknown for these.
+        @return number of entries imported
+        """
+        names = pickle.load(open(picklePath, "rb"))
+        now = time.time()
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO files (name, recorded) VALUES (?, ?)",
+                ((name, now) for name in names))
+            self._conn.commit()
+            return self._conn.total_changes - before
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def is_journal_file(path):
+    """
+    @return True if `path' is an SQLite database, or does not exist yet (or
+            is empty), i.e. it can be opened as a DownloadJournal
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(len(SQLITE_HEADER))
+    except (IOError, OSError):
+        return True
+    return not header or header == SQLITE_HEADER
+
+def open_journal(path, picklePath=None):
+    """
+    @param path Journal to open. If it is a pickled `already_there' list
+           (the argument of the old retrievers), <path without
+           extension>.sqlite is opened instead, with the pickle as
+           `picklePath'.
+    @param picklePath Pickled `already_there' list to import, only if the
+           journal does not exist yet: once it does, it has the entries the
+           retrievers removed since (e.g. of corrupt files), which the
+           pickle would bring back
+    @return the DownloadJournal
+    """
+    if not is_journal_file(path):
+        if picklePath is not None:
+            raise Exception("{0} is not a download journal".format(path))
+        picklePath = path
+        path = os.path.splitext(path)[0] + JOURNAL_SUFFIX
+        print("{0} is not a download journal. Using {1}; pass that journal "
+              "from now on".format(picklePath, path))
+        if not is_journal_file(path):
+            raise Exception("{0} is not a download journal".format(path))
+    if picklePath is None:
+        return DownloadJournal(path)
+    if os.path.exists(path):
+        print("WARNING: journal {0} exists. Ignoring pickled 'database' {1}"
+              .format(path, picklePath))
+        return DownloadJournal(path)
+    try:
+        pickle.load(open(picklePath, "rb"))
+    except Exception as e:
+        raise Exception("{0} is not a pickled 'database': {1}"
+                        .format(picklePath, e))
+    journal = DownloadJournal(path)
+    num = journal.import_pickle(picklePath)
+    print("Imported {0} entries from pickled 'database' {1} into {2}"
+          .format(num, picklePath, path))
+    return journal
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("USAGE: {0} <journal> <pickle to import>".format(sys.argv[0]))
+        sys.exit(1)
+    journal = DownloadJournal(sys.argv[1])
+    num = journal.import_pickle(sys.argv[2])
+    print("Imported {0} entries; journal now has {1}".format(num, len(journal)))
+    journal.close()
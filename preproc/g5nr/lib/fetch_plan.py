@@ -0,0 +1,234 @@
+"""
+Determine which collection files to download from what the preprocessing
+needs, instead of from hand-maintained lists of datasets and dates.
+
+The needs are derived from the config file of nr_input_generator.py (and
+lis_input_combiner.py) and from params.py:
+ - nr_input_generator.py processes the fields of
+   NPS_Params.NPS_REQUIRED_MET_PARAMS and NPS_DIAGNOSTIC_MET_PARAMS for the
+   dates from start_date to start_date + duration (inclusive), every
+   `frequency' hours. It always reads DELP and PL too (for the vertical
+   coordinate, see get_g5nr_pressure_array()).
+ - lis_input_combiner.py merges LIS_Params.FORCING_FIELDS (plus
+   FORCING_DEPENDENCIES) for the dates from
+   start_date - lis_spinup_duration to start_date + duration (inclusive),
+   every lis_frequency hours.
+Fields are mapped to G5NR variables with G5NR_Params.NPS_2_G5NR (following
+DERIVED_VAR_DEPENDENCIES for the derived fields) and to their collections
+with G5NR_Params.VAR_2_COLLECTION. Only the collections needed at each date
+are planned, so e.g. the 3-D collections are not downloaded for the LIS
+spin-up dates.
+
+The result is a list of (fcstDate, [dataset, ...]), which
+g5nr_collections.get_files_for_dates() turns into file names (with the
+time-averaged offsets and the daily "const" files).
+
+Durations in the config are in (fractions of) hours, unless a unit is given
+(e.g. "3 months", "10 days").
+"""
+
+import logging
+from datetime import datetime as dtime
+from datetime import timedelta as tdelta
+try:
+    from ConfigParser import ConfigParser
+except ImportError:
+    from configparser import ConfigParser
+
+import g5nr_collections as collections
+from ready_dates import NR_INPUT_GENERATOR, LIS_INPUT_COMBINER
+
+# G5NR variables that nr_input_generator.generate_input() always reads
+NR_INPUT_GENERATOR_VARIABLES = ("DELP", "PL")
+
+_DURATION_UNITS = {"minute": tdelta(minutes=1), "hour": tdelta(hours=1),
+                   "day": tdelta(days=1), "week": tdelta(weeks=1)}
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='fetch_plan'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+def _strip_comment(value):
+    """ The config files have comments after some values """
+    return value.split("#")[0].strip()
+
+def parse_date(value):
+    """ @return datetime of `value', in `MM-DD-YYYY hh:mm' format """
+    try:
+        return dtime.strptime(_strip_comment(value), "%m-%d-%Y %H:%M")
+    except ValueError:
+        raise Exception("Date '{0}' does not match expected format "
+                        "MM-DD-YYYY hh:mm".format(value))
+
+def subtract_duration(date, value):
+    """
+    @return `date' minus duration `value', which is a number of hours or a
+            number followed by a unit (minutes, hours, days, weeks or
+            (calendar) months)
+    """
+    fields = _strip_comment(value).split()
+    if len(fields) == 1:
+        return date - tdelta(hours=float(fields[0]))
+    if len(fields) != 2:
+        raise Exception("Unable to parse duration '{0}'".format(value))
+    (count, unit) = (float(fields[0]), fields[1].lower().rstrip("s"))
+    if unit == "month":
+        if count != int(count):
+            raise Exception("Fractional months are not supported: '{0}'"
+                            .format(value))
+        months = date.year * 12 + date.month - 1 - int(count)
+        (year, month) = divmod(months, 12)
+        # e.g. 3 months before May 31 is Feb 28
+        day = date.day
+        while True:
+            try:
+                return date.replace(year=year, month=month + 1, day=day)
+            except ValueError:
+                day -= 1
+    if unit not in _DURATION_UNITS:
+        raise Exception("Unknown unit in duration '{0}'".format(value))
+    return date - _DURATION_UNITS[unit] * count
+
+def get_dates(startDate, endDate, frequency):
+    """
+    @return list of dates from `startDate' to `endDate' (inclusive), every
+            `frequency' (a timedelta)
+    """
+    dates = []
+    fcstDate = startDate
+    while fcstDate <= endDate:
+        dates.append(fcstDate)
+        fcstDate += frequency
+    return dates
+
+def get_required_variables(fieldNames, g5nr):
+    """
+    @param fieldNames Fields (names as in g5nr.NPS_2_G5NR)
+    @param g5nr params.G5NR_Params
+    @return set of the G5NR variables needed to create the `fieldNames',
+            following the dependencies of the derived fields
+    """
+    variables = set()
+    seen = set()
+    pending = list(fieldNames)
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        if name not in g5nr.NPS_2_G5NR:
+            raise Exception("{0} has no mapping in "
+                            "params.G5NR_Params.NPS_2_G5NR".format(name))
+        g5nrName = g5nr.NPS_2_G5NR[name]
+        if g5nrName is None:
+            if name not in g5nr.DERIVED_VAR_DEPENDENCIES:
+                raise Exception("Derived field {0} has no entry in params."
+                                "G5NR_Params.DERIVED_VAR_DEPENDENCIES"
+                                .format(name))
+            pending.extend(g5nr.DERIVED_VAR_DEPENDENCIES[name])
+        elif isinstance(g5nrName, (list, tuple)):
+            variables.update(g5nrName)
+        else:
+            variables.add(g5nrName)
+    return variables
+
+def get_required_collections(variables, g5nr):
+    """
+    @return sorted list of the collections containing the G5NR `variables'
+    """
+    datasets = set()
+    for var in variables:
+        if var not in g5nr.VAR_2_COLLECTION:
+            raise Exception("{0} has no mapping in "
+                            "params.G5NR_Params.VAR_2_COLLECTION".format(var))
+        datasets.add(g5nr.VAR_2_COLLECTION[var])
+    return sorted(datasets)
+
+
+class FetchPlan(object):
+    """
+    The collections needed at each date by the preprocessing configured in a
+    config file. See module docstring.
+    """
+    def __init__(self, configFile, includeMet=True, includeLis=False,
+                 log=None):
+        '''
+        @param configFile Config file of nr_input_generator.py
+        @param includeMet Plan what nr_input_generator.py needs
+        @param includeLis Plan what lis_input_combiner.py needs for the LIS
+               spin-up (requires the lis_* entries of the config)
+        '''
+        # params imports numpy and nwpy, so only do it when needed
+        from params import G5NR_Params, LIS_Params, NPS_Params
+        self._log = log if log is not None else _default_log()
+        conf = ConfigParser()
+        if not conf.read(configFile):
+            raise Exception("Unable to read config file {0}".format(configFile))
+        get = lambda param: _strip_comment(conf.get("BASIC", param))
+        self.output_directory = get("src_met_output_directory")
+        startDate = parse_date(get("start_date"))
+        endDate = startDate + tdelta(hours=float(get("duration")))
+        # fcstDate -> set of datasets
+        demand = {}
+        # fcstDate -> consumers of its files (see raw_cache.py)
+        self.consumers = {}
+        if includeMet:
+            fields = list(NPS_Params.NPS_REQUIRED_MET_PARAMS) + \
+                     list(NPS_Params.NPS_DIAGNOSTIC_MET_PARAMS)
+            variables = get_required_variables(fields, G5NR_Params)
+            variables.update(NR_INPUT_GENERATOR_VARIABLES)
+            datasets = get_required_collections(variables, G5NR_Params)
+            dates = get_dates(startDate, endDate,
+                              tdelta(hours=float(get("frequency"))))
+            self._log.info("nr_input_generator needs {0} for {1} dates"
+                           .format(", ".join(datasets), len(dates)))
+            for fcstDate in dates:
+                demand.setdefault(fcstDate, set()).update(datasets)
+                self.consumers.setdefault(fcstDate, set()).add(
+                    NR_INPUT_GENERATOR)
+        if includeLis:
+            fields = list(LIS_Params.FORCING_FIELDS) + \
+                     list(LIS_Params.FORCING_DEPENDENCIES)
+            datasets = get_required_collections(
+                           get_required_variables(fields, G5NR_Params),
+                           G5NR_Params)
+            dates = get_dates(subtract_duration(startDate,
+                                                get("lis_spinup_duration")),
+                              endDate,
+                              tdelta(hours=float(get("lis_frequency"))))
+            self._log.info("lis_input_combiner needs {0} for {1} dates"
+                           .format(", ".join(datasets), len(dates)))
+            for fcstDate in dates:
+                demand.setdefault(fcstDate, set()).update(datasets)
+                self.consumers.setdefault(fcstDate, set()).add(
+                    LIS_INPUT_COMBINER)
+        self.demand = [(fcstDate, sorted(demand[fcstDate]))
+                       for fcstDate in sorted(demand)]
+
+    def datasets(self):
+        """ @return sorted list of all the collections needed """
+        datasets = set()
+        for (fcstDate, dateDatasets) in self.demand:
+            datasets.update(dateDatasets)
+        return sorted(datasets)
+
+    def files_by_date(self, prefix=collections.FILE_PREFIX,
+                      tavgOffset=collections.TAVG_OFFSET):
+        """
+        @return list of (fcstDate, [(dataset, fileName), ...]); see
+                g5nr_collections.get_files_for_dates()
+        """
+        return collections.get_files_for_dates(self.demand, prefix,
+                                               tavgOffset)
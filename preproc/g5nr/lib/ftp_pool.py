@@ -0,0 +1,339 @@
+"""
+A thread-safe pool of FTP connections for the collection retrievers.
+
+Each ftplib.FTP object is only ever used by one thread at a time: workers
+check a connection out of the pool, use it, and check it back in. Idle
+connections are kept alive with NOOPs so the server does not drop them, and
+connections that fail with a transient error (error_temp, timeouts, dropped
+sockets) are discarded and replaced with a fresh login.
+
+Typical usage:
+    pool = FTPConnectionPool(ftp_host, ftp_user, numConnections=10)
+    pool.run(some_func, args=(arg1, arg2)) # some_func(ftp, arg1, arg2)
+    pool.close()
+"""
+
+import time
+import socket
+import ftplib
+import logging
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Exceptions that indicate the connection (or the server) is temporarily
+# unusable. Anything else (e.g. error_perm for a missing file) is not retried.
+TRANSIENT_ERRORS = (ftplib.error_temp, ftplib.error_reply, socket.timeout,
+                    socket.error, EOFError)
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='ftp_pool'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class PooledFTP(object):
+    """
+    Thin wrapper around an ftplib.FTP object that remembers when it was
+    last used, so the pool knows when it needs a keepalive NOOP.
+    """
+    def __init__(self, ftp, connId):
+        self.ftp = ftp
+        self.conn_id = connId
+        self.last_used = time.time()
+
+    def touch(self):
+        self.last_used = time.time()
+
+    def idle_time(self):
+        return time.time() - self.last_used
+
+
+class FTPConnectionPool(object):
+    """
+    Bounded pool of logged-in FTP connections. See module docstring.
+    """
+    def __init__(self, host, user, passwd='', port=21, numConnections=4,
+                 timeout=120,
+                 keepaliveInterval=60, maxConnectAttempts=10,
+                 connectRetryWait=300, maxTries=5, backoffBase=10,
+                 backoffMax=600, numInitial=None, errorCallback=None,
+                 log=None):
+        '''
+        @param host FTP host name
+        @param user FTP user
+        @param passwd FTP password (G5NR uses an anonymous-style login)
+        @param port FTP control port
+        @param numConnections Number of connections in the pool. This is the
+               upper bound on concurrent transfers
+        @param timeout Socket timeout (seconds) for each connection
+        @param keepaliveInterval Send a NOOP on connections that have been
+               idle for longer than this many seconds
+        @param maxConnectAttempts How many times to try to log in before
+               giving up on a connection
+        @param connectRetryWait Seconds to wait after a failed login (the
+               NCCS server answers error_temp when too many users are on)
+        @param maxTries Default number of attempts used by run()
+        @param backoffBase First wait (seconds) between attempts in run().
+               It doubles on every failed attempt...
+        @param backoffMax ...up to this many seconds
+        @param numInitial Number of connections to open right away (default:
+               all of them). The others are opened when first needed.
+        @param errorCallback Called with the exception on every transient
+               error (when logging in and in run()), e.g. to let a
+               concurrency controller back off
+        '''
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.port = port
+        self.num_connections = numConnections
+        self.timeout = timeout
+        self.keepalive_interval = keepaliveInterval
+        self.max_connect_attempts = maxConnectAttempts
+        self.connect_retry_wait = connectRetryWait
+        self.max_tries = maxTries
+        self.backoff_base = backoffBase
+        self.backoff_max = backoffMax
+        self.error_callback = errorCallback
+        if log is None:
+            log = _default_log()
+        self._log = log
+        self._idle = queue.Queue()
+        self._id_lock = threading.Lock()
+        self._next_id = 0
+        self._closed = threading.Event()
+        if numInitial is None:
+            numInitial = numConnections
+        self._num_open = numInitial
+        for i in range(numInitial):
+            self._idle.put(self._connect())
+        self._keepalive_thread = threading.Thread(target=self._keepalive_loop,
+                                                  name="ftp_keepalive")
+        self._keepalive_thread.daemon = True
+        self._keepalive_thread.start()
+
+    def _connect(self, maxAttempts=None):
+        """
+        Log in to the server, retrying on error_temp/timeouts.
+        @param maxAttempts Number of attempts (default: maxConnectAttempts).
+               If it is 1, the transient error is raised right away.
+        @return a PooledFTP
+        """
+        with self._id_lock:
+            connId = self._next_id
+            self._next_id += 1
+        if maxAttempts is None:
+            maxAttempts = self.max_connect_attempts
+        for attempt in range(maxAttempts):
+            try:
+                ftp = ftplib.FTP(timeout=self.timeout)
+                ftp.connect(self.host, self.port)
+                ftp.login(self.user, self.passwd)
+                self._log.debug("Established FTP connection {0}".format(connId))
+                return PooledFTP(ftp, connId)
+            except TRANSIENT_ERRORS as e:
+                self._transient_error(e)
+                if maxAttempts == 1:
+                    raise
+                self._log.warn("Error establishing FTP connection ({0}). Will "
+                               "retry in {1}s".format(e, self.connect_retry_wait))
+                time.sleep(self.connect_retry_wait)
+        raise Exception("Unable to establish FTP connection to {0} after {1} "
+                        "attempts. Giving up".format(self.host,
+                                                     self.max_connect_attempts))
+
+    def _transient_error(self, e):
+        if self.error_callback is not None:
+            try:
+                self.error_callback(e)
+            except Exception as cbErr:
+                self._log.error("Error callback failed: {0}".format(cbErr))
+
+    def _reconnect(self, conn):
+        """ Drop `conn' and return a freshly logged-in replacement """
+        self._discard(conn)
+        return self._connect()
+
+    def _discard(self, conn):
+        try:
+            conn.ftp.close()
+        except Exception:
+            pass
+
+    def _noop(self, conn):
+        """
+        Send a NOOP on `conn'.
+        @return `conn' if it is still alive, otherwise a new connection
+        """
+        try:
+            conn.ftp.voidcmd("NOOP")
+            conn.touch()
+            return conn
+        except TRANSIENT_ERRORS as e:
+            self._log.info("Connection {0} went stale ({1}). Reconnecting"
+                           .format(conn.conn_id, e))
+            return self._reconnect(conn)
+
+    def _keepalive_loop(self):
+        """
+        Periodically NOOP the connections sitting idle in the pool. Only
+        connections that are currently checked in are touched, so this never
+        interferes with a transfer.
+        """
+        while not self._closed.wait(self.keepalive_interval / 2.):
+            for i in range(self.num_connections):
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    if conn.idle_time() >= self.keepalive_interval:
+                        conn = self._noop(conn)
+                except Exception as e:
+                    self._log.error("Keepalive failed: {0}".format(e))
+                self._idle.put(conn)
+
+    def _open_or_wait(self):
+        """
+        Open one more connection if fewer than numConnections are open.
+        Otherwise, or if the server will not take one more, wait for an idle
+        one.
+        @return a PooledFTP
+        """
+        with self._id_lock:
+            grow = self._num_open < self.num_connections
+            if grow:
+                self._num_open += 1
+            numOpen = self._num_open
+        if not grow:
+            return self._idle.get()
+        # Only try once if there are other connections to fall back on
+        maxAttempts = None if numOpen == 1 else 1
+        try:
+            return self._connect(maxAttempts=maxAttempts)
+        except TRANSIENT_ERRORS as e:
+            self._log.info("Unable to open another connection ({0}). Waiting "
+                           "for an idle one".format(e))
+            with self._id_lock:
+                self._num_open -= 1
+            return self._idle.get()
+        except Exception:
+            with self._id_lock:
+                self._num_open -= 1
+            raise
+
+    def checkout(self):
+        """
+        Get an idle connection (or open a new one, if fewer than
+        numConnections are open), blocking until one is available.
+        Connections that have been idle for longer than keepaliveInterval
+        are checked with a NOOP first.
+        @return a PooledFTP. Return it with checkin() when done.
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open_or_wait()
+        try:
+            if conn.idle_time() >= self.keepalive_interval:
+                conn = self._noop(conn)
+        except Exception:
+            # could not even reconnect; keep the pool size constant
+            self._idle.put(conn)
+            raise
+        return conn
+
+    def checkin(self, conn, broken=False):
+        """
+        Return `conn' to the pool. If `broken' is True, the connection is
+        replaced by a new one before going back in the pool.
+        """
+        if broken:
+            try:
+                conn = self._reconnect(conn)
+            except Exception as e:
+                self._log.error("Unable to replace broken connection: {0}"
+                                .format(e))
+                # put the dead connection back; the next checkout will try
+                # to revive it
+                conn.last_used = 0
+        conn.touch()
+        self._idle.put(conn)
+
+    def run(self, func, args=(), kwargs=None, maxTries=None):
+        """
+        Call func(ftp, *args, **kwargs) with a pooled connection, retrying
+        with exponential backoff (on a fresh connection) if it fails with
+        one of the TRANSIENT_ERRORS.
+        @return whatever `func' returns
+        """
+        if kwargs is None:
+            kwargs = {}
+        if maxTries is None:
+            maxTries = self.max_tries
+        wait = self.backoff_base
+        for attempt in range(1, maxTries+1):
+            conn = self.checkout()
+            try:
+                ret = func(conn.ftp, *args, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                self._transient_error(e)
+                self.checkin(conn, broken=True)
+                if attempt == maxTries:
+                    raise
+                self._log.warn("Transient FTP error on attempt {0}/{1}: {2}. "
+                               "Retrying in {3}s".format(attempt, maxTries, e,
+                                                         wait))
+                time.sleep(wait)
+                wait = min(wait * 2, self.backoff_max)
+                continue
+            except Exception:
+                self.checkin(conn)
+                raise
+            self.checkin(conn)
+            return ret
+
+    def trim(self, numConnections):
+        """
+        Log out of idle connections until at most `numConnections' are open
+        (e.g. when the number of concurrent transfers goes down, so unused
+        connections do not count against the server's user limit). They are
+        opened again by checkout() if needed.
+        """
+        while True:
+            with self._id_lock:
+                if self._num_open <= numConnections:
+                    return
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return
+                self._num_open -= 1
+            self._log.debug("Closing idle connection {0}".format(conn.conn_id))
+            self._discard(conn)
+
+    def close(self):
+        """ Stop the keepalive thread and log out of all idle connections """
+        self._closed.set()
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.ftp.quit()
+            except Exception:
+                self._discard(conn)
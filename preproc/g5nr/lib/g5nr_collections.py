@@ -0,0 +1,155 @@
+"""
+Naming conventions of the G5NR collections on the NCCS servers.
+
+The data are organized as
+  <topdir>/<res>/<tag>/<dataset>/Y%Y/M%m/D%d/<prefix><dataset>.%Y%m%d_%H%Mz.nc4
+where <tag> is "inst", "tavg" or "const". Time-averaged collections are
+stamped at the middle of the averaging period (e.g. 15 and 45 minutes past
+the hour for the 30-minute collections), and the "const" collections only
+have one file per day (<prefix><dataset>.%Y%m%d.nc4).
+"""
+
+import posixpath
+from datetime import timedelta as tdelta
+
+FTP_HOST = 'ftp.nccs.nasa.gov'
+FTP_USER = "G5NR"
+FTP_TOPDIR = 'Ganymed/7km/c1440_NR/DATA/'
+# Note : Slight path difference with HTTP and FTP
+HTTP_HOST = "g5nr.nccs.nasa.gov"
+HTTP_TOPDIR = "data/DATA"
+
+FILE_PREFIX = "c1440_NR."
+# Offset of the time stamp of time-averaged files with respect to the
+# (instantaneous) date they are used for. Use 30 minutes for the hourly
+# (i.e. coarse) collections
+TAVG_OFFSET = tdelta(minutes=15)
+
+def get_collection_tag(dataset):
+    """
+    @return the tag ("inst", "tavg" or "const") of the given `dataset'
+    """
+    for tag in ("inst", "tavg", "const"):
+        if dataset.startswith(tag):
+            return tag
+    raise Exception("Unknown tag for dataset '{0}'".format(dataset))
+
+def get_file_date(dataset, fcstDate, tavgOffset=TAVG_OFFSET):
+    """
+    @return the date in the file name containing `dataset' data for
+            `fcstDate'. For time-averaged datasets, this is the middle of the
+            previous averaging period.
+    """
+    if get_collection_tag(dataset) == "tavg":
+        # Time-averaged data is at 15 and 45 passed the hour, as it
+        # reflects the average for the 30 minute period
+        return fcstDate - tavgOffset
+    return fcstDate
+
+def get_file_name(dataset, fcstDate, prefix=FILE_PREFIX, tavgOffset=TAVG_OFFSET):
+    """
+    @return the name of the file containing `dataset' data for `fcstDate'
+    """
+    if get_collection_tag(dataset) == 'const':
+        suffix = ".%Y%m%d.nc4"
+    else:
+        suffix = ".%Y%m%d_%H%Mz.nc4"
+    fileDate = get_file_date(dataset, fcstDate, tavgOffset)
+    return fileDate.strftime("{pfx}{ds}{sfx}".format(pfx=prefix, sfx=suffix,
+                                                     ds=dataset))
+
+def get_remote_dir(dataset, fcstDate, topdir, res, tavgOffset=TAVG_OFFSET):
+    """
+    @return the path, relative to the server root, of the day directory
+            containing the `dataset' file for `fcstDate'
+    """
+    fileDate = get_file_date(dataset, fcstDate, tavgOffset)
+    tag = get_collection_tag(dataset)
+    return fileDate.strftime("/{topdir}/{res}/{tag}/{ds}/Y%Y/M%m/D%d".format(
+                             topdir=topdir.strip("/"), res=res, tag=tag,
+                             ds=dataset))
+
+def get_remote_path(dataset, fcstDate, topdir, res, prefix=FILE_PREFIX,
+                    tavgOffset=TAVG_OFFSET):
+    """
+    @return the path, relative to the server root, of the file containing
+            `dataset' data for `fcstDate'
+    """
+    return posixpath.join(get_remote_dir(dataset, fcstDate, topdir, res,
+                                         tavgOffset),
+                          get_file_name(dataset, fcstDate, prefix, tavgOffset))
+
+def get_url(dataset, fcstDate, scheme, host, topdir, res, prefix=FILE_PREFIX,
+            tavgOffset=TAVG_OFFSET):
+    """
+    @return the URL of the file containing `dataset' data for `fcstDate'
+    """
+    return "{scheme}://{host}{path}".format(
+            scheme=scheme, host=host,
+            path=get_remote_path(dataset, fcstDate, topdir, res, prefix,
+                                 tavgOffset))
+
+def get_files_for_dates(demand, prefix=FILE_PREFIX, tavgOffset=TAVG_OFFSET):
+    """
+    @param demand List of (fcstDate, [dataset, ...]) with the collections
+           needed for each forecast date (e.g. from fetch_plan.py)
+    @return list of (fcstDate, [(dataset, fileName), ...]) with the files
+            containing the data of each collection for each date. Files
+            shared by several dates (i.e. the daily "const" files) are listed
+            for each of them.
+    """
+    return [(fcstDate,
+             [(dataset, get_file_name(dataset, fcstDate, prefix, tavgOffset))
+              for dataset in datasets])
+            for (fcstDate, datasets) in demand]
+
+def get_files_by_date(datasets, startDate, endDate, interval,
+                      prefix=FILE_PREFIX, tavgOffset=TAVG_OFFSET):
+    """
+    @return list of (fcstDate, [(dataset, fileName), ...]) with the files of
+            all the `datasets' needed for each forecast date from `startDate'
+            up to (but not including) `endDate', every `interval' (a
+            timedelta). See get_files_for_dates().
+    """
+    demand = []
+    fcstDate = startDate
+    while fcstDate < endDate:
+        demand.append((fcstDate, datasets))
+        fcstDate += interval
+    return get_files_for_dates(demand, prefix, tavgOffset)
+
+def plan_transfers(filesByDate, topdir, res, tavgOffset=TAVG_OFFSET):
+    """
+    @param filesByDate As returned by get_files_for_dates()
+    @return list of (dataset, fcstDate, remoteDir, fileName) with each of the
+            files of `filesByDate' once (so the daily "const" files only
+            appear for the first date of each day), in the order of the
+            dates. The list is date-major (all the collections of a date
+            come before the next date), so each date is complete as early as
+            possible and can be preprocessed while later dates are still
+            being downloaded (see ready_dates.py).
+    """
+    plan = []
+    seen = set()
+    for (fcstDate, files) in filesByDate:
+        for (dataset, fileName) in files:
+            if (dataset, fileName) in seen:
+                continue
+            seen.add((dataset, fileName))
+            plan.append((dataset, fcstDate,
+                         get_remote_dir(dataset, fcstDate, topdir, res,
+                                        tavgOffset),
+                         fileName))
+    return plan
+
+def get_transfer_plan(datasets, startDate, endDate, interval, topdir, res,
+                      prefix=FILE_PREFIX, tavgOffset=TAVG_OFFSET):
+    """
+    @return list of (dataset, fcstDate, remoteDir, fileName) for all the
+            files needed for the forecast dates from `startDate' up to (but
+            not including) `endDate', every `interval' (a timedelta).
+            See plan_transfers().
+    """
+    return plan_transfers(get_files_by_date(datasets, startDate, endDate,
+                                            interval, prefix, tavgOffset),
+                          topdir, res, tavgOffset)
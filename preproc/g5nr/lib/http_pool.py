@@ -0,0 +1,471 @@
+"""
+A thread-safe pool of persistent (keep-alive) HTTP connections for the
+collection retrievers, and segmented downloads on top of it.
+
+Like ftp_pool.FTPConnectionPool, each connection is only used by one thread
+at a time, and transient errors (dropped connections, timeouts, 5xx replies,
+interrupted bodies) are retried on a fresh connection with backoff. Requests
+are HTTP/1.1, so a connection is reused for many files instead of opening
+one (and, with wget, spawning one process) per file.
+
+retrieve_segmented() downloads large files as several byte ranges in
+parallel, each over its own pooled connection. Each segment is written to
+<destPath>.tmp.seg<n> and resumes from its current size if it is
+interrupted; once all of them are complete they are concatenated into
+<destPath>.tmp (computing the checksum on the way) and renamed as with the
+other transfers (see resumable_transfer.py). Smaller files, files the
+server will not serve ranges of and partial .tmp files left by a
+non-segmented attempt are downloaded as a single stream, resuming with a
+Range request.
+
+Typical usage:
+    pool = HTTPConnectionPool(http_host, numConnections=8)
+    checksum = retrieve_segmented(pool, "/data/DATA/.../file.nc4", destPath)
+    pool.close()
+"""
+
+import os
+import time
+import socket
+import ftplib
+import logging
+import threading
+try:
+    import Queue as queue
+    import httplib
+except ImportError:
+    import queue
+    import http.client as httplib
+
+from resumable_transfer import TMP_SUFFIX, IncompleteTransferError, \
+                               prepare_partial, open_partial, finish_partial, \
+                               _content_range_total
+
+SEGMENT_SUFFIX = TMP_SUFFIX + ".seg{0}"
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='http_pool'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class HTTPStatusError(Exception):
+    """ The server answered with an error status that will not go away """
+    def __init__(self, status, reason, path):
+        Exception.__init__(self, "{0} {1}: {2}".format(status, reason, path))
+        self.status = status
+
+
+class TransientHTTPStatusError(ftplib.error_temp):
+    """
+    The server answered with a status worth retrying (e.g. 503 when it has
+    too many connections). Like IncompleteTransferError, a subclass of
+    ftplib.error_temp, so the retrievers handle it like the FTP errors.
+    """
+    pass
+
+
+class RangeNotSupportedError(Exception):
+    """ The server ignored a Range request """
+    pass
+
+
+# Exceptions that indicate the connection (or the server) is temporarily
+# unusable. Anything else (e.g. a 404) is not retried.
+TRANSIENT_ERRORS = (ftplib.error_temp, httplib.HTTPException, socket.timeout,
+                    socket.error, EOFError)
+
+# Statuses that are retried
+TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class PooledHTTP(object):
+    """
+    An httplib.HTTPConnection and when it was last used, so the pool can
+    drop connections the server has probably closed.
+    """
+    def __init__(self, http, connId):
+        self.http = http
+        self.conn_id = connId
+        self.last_used = time.time()
+
+    def touch(self):
+        self.last_used = time.time()
+
+    def idle_time(self):
+        return time.time() - self.last_used
+
+
+class HTTPConnectionPool(object):
+    """
+    Bounded pool of persistent HTTP connections to one host. See module
+    docstring.
+    """
+    def __init__(self, host, port=80, numConnections=4, timeout=120,
+                 maxIdle=50, maxTries=5, backoffBase=10, backoffMax=600,
+                 errorCallback=None, log=None):
+        '''
+        @param host HTTP host name
+        @param port HTTP port
+        @param numConnections Number of connections in the pool. This is the
+               upper bound on concurrent requests (segments included)
+        @param timeout Socket timeout (seconds) for each connection
+        @param maxIdle Connections that have been idle for longer than this
+               many seconds are replaced before being used, since servers
+               close idle keep-alive connections (there is no NOOP in HTTP)
+        @param maxTries Default number of attempts used by run()
+        @param backoffBase First wait (seconds) between attempts in run().
+               It doubles on every failed attempt...
+        @param backoffMax ...up to this many seconds
+        @param errorCallback Called with the exception on every transient
+               error, e.g. to let a concurrency controller back off
+        '''
+        self.host = host
+        self.port = port
+        self.num_connections = numConnections
+        self.timeout = timeout
+        self.max_idle = maxIdle
+        self.max_tries = maxTries
+        self.backoff_base = backoffBase
+        self.backoff_max = backoffMax
+        self.error_callback = errorCallback
+        if log is None:
+            log = _default_log()
+        self._log = log
+        self._idle = queue.Queue()
+        self._id_lock = threading.Lock()
+        self._next_id = 0
+        self._num_open = 0
+        # requests made by run(), including the failed attempts
+        self.num_requests = 0
+
+    def _connect(self):
+        """
+        @return a new PooledHTTP. The socket is opened by the first request
+        """
+        with self._id_lock:
+            connId = self._next_id
+            self._next_id += 1
+        http = httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+        self._log.debug("New HTTP connection {0}".format(connId))
+        return PooledHTTP(http, connId)
+
+    def _transient_error(self, e):
+        if self.error_callback is not None:
+            try:
+                self.error_callback(e)
+            except Exception as cbErr:
+                self._log.error("Error callback failed: {0}".format(cbErr))
+
+    def _discard(self, conn):
+        try:
+            conn.http.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        """
+        Get an idle connection (or a new one, if fewer than numConnections
+        are open), blocking until one is available.
+        @return a PooledHTTP. Return it with checkin() when done.
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._id_lock:
+                grow = self._num_open < self.num_connections
+                if grow:
+                    self._num_open += 1
+            conn = self._connect() if grow else self._idle.get()
+        if conn.idle_time() >= self.max_idle:
+            self._discard(conn)
+            conn = self._connect()
+        return conn
+
+    def checkin(self, conn, broken=False):
+        """
+        Return `conn' to the pool. If `broken' is True, the connection is
+        replaced by a new one before going back in the pool.
+        """
+        if broken:
+            self._discard(conn)
+            conn = self._connect()
+        conn.touch()
+        with self._id_lock:
+            if self._num_open > self.num_connections:
+                # the pool was trimmed while it was checked out
+                self._num_open -= 1
+                self._discard(conn)
+                return
+        self._idle.put(conn)
+
+    def run(self, func, args=(), kwargs=None, maxTries=None):
+        """
+        Call func(http, *args, **kwargs) with a pooled
+        httplib.HTTPConnection, retrying with exponential backoff (on a
+        fresh connection) if it fails with one of the TRANSIENT_ERRORS.
+        @return whatever `func' returns
+        """
+        if kwargs is None:
+            kwargs = {}
+        if maxTries is None:
+            maxTries = self.max_tries
+        wait = self.backoff_base
+        for attempt in range(1, maxTries+1):
+            conn = self.checkout()
+            with self._id_lock:
+                self.num_requests += 1
+            try:
+                ret = func(conn.http, *args, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                self._transient_error(e)
+                self.checkin(conn, broken=True)
+                if attempt == maxTries:
+                    raise
+                self._log.warn("Transient HTTP error on attempt {0}/{1}: {2}. "
+                               "Retrying in {3}s".format(attempt, maxTries, e,
+                                                         wait))
+                time.sleep(wait)
+                wait = min(wait * 2, self.backoff_max)
+                continue
+            except Exception:
+                # e.g. a 404, after which the connection is still usable
+                self.checkin(conn)
+                raise
+            self.checkin(conn)
+            return ret
+
+    def trim(self, numConnections):
+        """
+        Change the number of connections of the pool (e.g. when the number
+        of concurrent transfers changes), closing idle ones if there are too
+        many. Connections that are checked out are closed when checked in.
+        """
+        with self._id_lock:
+            self.num_connections = numConnections
+        while True:
+            with self._id_lock:
+                if self._num_open <= numConnections:
+                    return
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return
+                self._num_open -= 1
+            self._log.debug("Closing idle connection {0}".format(conn.conn_id))
+            self._discard(conn)
+
+    def close(self):
+        """ Close all idle connections """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+def _request(http, method, path, headers=None):
+    """
+    Send a request on `http' and check the status
+    @return the httplib.HTTPResponse (200, 206 or 416), whose body must be
+            read before the connection is used again
+    @raise TransientHTTPStatusError or HTTPStatusError for error statuses
+    """
+    http.request(method, path, headers=headers or {})
+    response = http.getresponse()
+    if response.status in (200, 206, 416):
+        return response
+    # drain the body so the connection can be reused
+    response.read()
+    if response.status in TRANSIENT_STATUSES:
+        raise TransientHTTPStatusError("{0} {1}: {2}".format(
+                                       response.status, response.reason, path))
+    raise HTTPStatusError(response.status, response.reason, path)
+
+def http_size(http, path):
+    """
+    @return size of `path' according to a HEAD request, or None if the
+            server will not say
+    """
+    response = _request(http, "HEAD", path)
+    response.read()
+    length = response.getheader("Content-Length")
+    return int(length) if length is not None else None
+
+def _copy_body(response, write, bufSize, path):
+    """
+    Pass the body of `response' to `write'
+    @raise IncompleteTransferError if it is cut short
+    """
+    try:
+        while True:
+            buf = response.read(bufSize)
+            if not buf:
+                break
+            write(buf)
+    except (httplib.IncompleteRead, socket.error) as e:
+        raise IncompleteTransferError("Transfer of {0} interrupted: {1}"
+                                      .format(path, e))
+
+def retrieve_stream(http, path, destPath, expectedSize=None,
+                    bufSize=1024*1024, log=None):
+    """
+    Download (or finish downloading) `path' to `destPath' as a single
+    stream over `http', using a Range request to resume an existing partial
+    file, like resumable_transfer.retrieve_ftp() does for FTP.
+    @return the checksum (see download_journal) of the downloaded file
+    """
+    if log is None:
+        log = _default_log()
+    tempPath = destPath + TMP_SUFFIX
+    offset = prepare_partial(tempPath, expectedSize, log)
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes={0}-".format(offset)
+    response = _request(http, "GET", path, headers)
+    if response.status == 416:
+        response.read()
+        # Nothing past `offset', so the partial file must be complete
+        total = _content_range_total(response.getheader("Content-Range"))
+        if total is None or total != offset:
+            raise HTTPStatusError(416, response.reason, path)
+        log.info("{0} was already complete".format(tempPath))
+        (f, writer) = open_partial(tempPath, offset)
+        f.close()
+        finish_partial(tempPath, destPath, total)
+        return writer.hexdigest()
+    if response.status == 206:
+        total = _content_range_total(response.getheader("Content-Range"))
+        log.info("Resuming {0} at byte {1} of {2}"
+                 .format(os.path.basename(destPath), offset, total))
+    else:
+        # server ignored the Range header; start over
+        offset = 0
+        length = response.getheader("Content-Length")
+        total = int(length) if length is not None else None
+    if expectedSize is None:
+        expectedSize = total
+    (f, writer) = open_partial(tempPath, offset)
+    try:
+        _copy_body(response, writer.write, bufSize, path)
+    finally:
+        f.close()
+    finish_partial(tempPath, destPath, expectedSize)
+    return writer.hexdigest()
+
+def retrieve_range(http, path, segmentPath, first, last, bufSize=1024*1024):
+    """
+    Download (or finish downloading) bytes `first' to `last' (inclusive) of
+    `path' to `segmentPath'
+    @raise RangeNotSupportedError if the server sends the whole file
+    @raise IncompleteTransferError if the segment is short
+    """
+    length = last - first + 1
+    offset = prepare_partial(segmentPath, length)
+    if offset == length:
+        return
+    response = _request(http, "GET", path, {"Range": "bytes={0}-{1}".format(
+                                                     first + offset, last)})
+    if response.status != 206:
+        # do not read a whole file we cannot use
+        http.close()
+        raise RangeNotSupportedError("Server ignored range request for {0}"
+                                     .format(path))
+    with open(segmentPath, "ab") as f:
+        _copy_body(response, f.write, bufSize, path)
+    size = os.path.getsize(segmentPath)
+    if size != length:
+        raise IncompleteTransferError("Got {0} of {1} bytes of {2}"
+                                      .format(size, length,
+                                              os.path.basename(segmentPath)))
+
+def _segments(size, numSegments):
+    """ @return list of (first, last) byte ranges splitting `size' bytes """
+    step = -(-size // numSegments)
+    return [(first, min(first + step, size) - 1)
+            for first in range(0, size, step)]
+
+def retrieve_segmented(pool, path, destPath, expectedSize=None,
+                       maxSegments=4, minSegmentSize=64*1024*1024,
+                       maxTries=None, log=None):
+    """
+    Download (or finish downloading) `path' to `destPath' using connections
+    of the HTTPConnectionPool `pool', in up to `maxSegments' byte ranges of
+    at least `minSegmentSize' bytes transferred in parallel. See module
+    docstring.
+    @param expectedSize Size of the remote file, if already known. If None,
+           it is queried with HEAD.
+    @return the checksum (see download_journal) of the downloaded file
+    @raise IncompleteTransferError if a segment is still short after
+           `maxTries' attempts
+    @raise HTTPStatusError if the file does not exist
+    """
+    if log is None:
+        log = _default_log()
+    if expectedSize is None:
+        expectedSize = pool.run(http_size, args=(path,), maxTries=maxTries)
+    tempPath = destPath + TMP_SUFFIX
+    numSegments = 1
+    if expectedSize is not None and not os.path.exists(tempPath):
+        numSegments = min(maxSegments, expectedSize // minSegmentSize)
+    if numSegments <= 1:
+        return pool.run(retrieve_stream, args=(path, destPath),
+                        kwargs={"expectedSize": expectedSize, "log": log},
+                        maxTries=maxTries)
+    segments = _segments(expectedSize, numSegments)
+    segmentPaths = [destPath + SEGMENT_SUFFIX.format(i)
+                    for i in range(len(segments))]
+    errors = []
+    def fetch_segment(i):
+        try:
+            pool.run(retrieve_range, args=(path, segmentPaths[i]) + segments[i],
+                     maxTries=maxTries)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=fetch_segment, args=(i,))
+               for i in range(1, len(segments))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    fetch_segment(0)
+    for t in threads:
+        t.join()
+    if errors:
+        if all(isinstance(e, RangeNotSupportedError) for e in errors):
+            log.info("{0} does not support ranges. Downloading {1} as a "
+                     "single stream".format(pool.host, path))
+            for segmentPath in segmentPaths:
+                if os.path.exists(segmentPath):
+                    os.unlink(segmentPath)
+            return pool.run(retrieve_stream, args=(path, destPath),
+                            kwargs={"expectedSize": expectedSize, "log": log},
+                            maxTries=maxTries)
+        # the segments are kept, so the next attempt resumes them
+        raise errors[0]
+    (f, writer) = open_partial(tempPath, 0)
+    try:
+        for segmentPath in segmentPaths:
+            with open(segmentPath, "rb") as segment:
+                while True:
+                    buf = segment.read(4*1024*1024)
+                    if not buf:
+                        break
+                    writer.write(buf)
+    finally:
+        f.close()
+    for segmentPath in segmentPaths:
+        os.unlink(segmentPath)
+    finish_partial(tempPath, destPath, expectedSize)
+    return writer.hexdigest()
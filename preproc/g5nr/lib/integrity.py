@@ -0,0 +1,297 @@
+"""
+Integrity checks for downloaded collection files.
+
+A file is considered good if
+ - its size matches the size on the server (if known),
+ - it starts with an HDF5 (i.e. netCDF4) or netCDF3 signature, and
+ - it contains all the variables that G5NR_Params.VAR_2_COLLECTION (see
+   params.py) expects from its collection. This requires netCDF4 (and the
+   params module); if it cannot be imported, only the first two checks
+   are done.
+
+Files that pass are added to a checksum manifest (MANIFEST, in the directory
+of the file), so later runs do not verify them again as long as their size
+is unchanged. Each line of the manifest is
+    <md5 checksum> <size> <file name>
+and later lines take precedence over earlier ones.
+
+FileVerifier runs the checks in a pool of worker threads, so files can be
+submitted as they are downloaded without holding up the transfers. It can
+also post-process the files that pass (e.g. subset them, see subset.py)
+before they are added to the manifest, and report the good files to a
+callback (e.g. to mark the dates whose files are all ready, see
+ready_dates.py).
+"""
+
+import os
+import logging
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from download_journal import file_checksum
+
+try:
+    import netCDF4 as nc4
+except ImportError:
+    nc4 = None
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+NETCDF3_SIGNATURES = (b"CDF\x01", b"CDF\x02")
+MANIFEST_NAME = "MANIFEST"
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='integrity'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class IntegrityError(Exception):
+    """ The file is truncated or is not a valid collection file """
+    pass
+
+
+def check_header(path):
+    """
+    Make sure `path' is an HDF5 or netCDF3 file. The HDF5 superblock may be
+    at offset 0, 512, 1024, 2048, ...
+    @raise IntegrityError if it is neither
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if f.read(4) in NETCDF3_SIGNATURES:
+            return
+        offset = 0
+        while offset + len(HDF5_SIGNATURE) <= size:
+            f.seek(offset)
+            if f.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE:
+                return
+            offset = 512 if offset == 0 else offset * 2
+    raise IntegrityError("{0} is not an HDF5/netCDF file".format(path))
+
+def collection_variables(dataset):
+    """
+    @return sorted list of the G5NR variables that are taken from `dataset'
+            according to G5NR_Params.VAR_2_COLLECTION, or None if the params
+            module cannot be imported
+    """
+    try:
+        from params import G5NR_Params
+    except ImportError:
+        return None
+    return sorted(var for (var, coll) in G5NR_Params.VAR_2_COLLECTION.items()
+                  if coll == dataset)
+
+def check_variables(path, variables):
+    """
+    Make sure the netCDF file `path' can be opened and has all the
+    `variables'
+    @return False if netCDF4 is not available (nothing was checked)
+    @raise IntegrityError if the file cannot be read or variables are missing
+    """
+    if nc4 is None:
+        return False
+    try:
+        dataset = nc4.Dataset(path, "r")
+    except (IOError, OSError, RuntimeError) as e:
+        raise IntegrityError("Unable to open {0}: {1}".format(path, e))
+    try:
+        missing = [v for v in variables if v not in dataset.variables]
+    finally:
+        dataset.close()
+    if missing:
+        raise IntegrityError("{0} is missing variables {1}"
+                             .format(path, ", ".join(missing)))
+    return True
+
+def verify_file(path, expectedSize=None, variables=None):
+    """
+    Run the checks described in the module docstring on `path'
+    @param expectedSize Size of the file on the server, if known
+    @param variables Variables the file should have (e.g. from
+           collection_variables()). Not checked if None.
+    @raise IntegrityError if a check fails
+    """
+    size = os.path.getsize(path)
+    if expectedSize is not None and size != expectedSize:
+        raise IntegrityError("{0} has {1} bytes; expected {2}"
+                             .format(path, size, expectedSize))
+    check_header(path)
+    if variables:
+        check_variables(path, variables)
+
+
+class ChecksumManifest(object):
+    """
+    Checksums and sizes of the verified files of a directory. See module
+    docstring for the format.
+    """
+    def __init__(self, directory, fileName=MANIFEST_NAME):
+        self.path = os.path.join(directory, fileName)
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) != 3:
+                        continue
+                    (checksum, size, name) = fields
+                    self._entries[name] = (checksum, int(size))
+
+    def get(self, name):
+        """ @return (checksum, size) of `name', or None """
+        with self._lock:
+            return self._entries.get(name)
+
+    def is_verified(self, path):
+        """
+        @return True if the file at `path' is in the manifest with its
+                current size
+        """
+        entry = self.get(os.path.basename(path))
+        return entry is not None and entry[1] == os.path.getsize(path)
+
+    def add(self, name, checksum, size):
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write("{0} {1} {2}\n".format(checksum, size, name))
+            self._entries[name] = (checksum, size)
+
+
+class FileVerifier(object):
+    """
+    Verifies files (see verify_file()) and records the good ones in the
+    manifest of their directory. Files can be verified synchronously with
+    verify() or handed to a pool of worker threads with submit().
+    """
+    def __init__(self, numWorkers=4, checkVariables=True, postProcess=None,
+                 onVerified=None, log=None):
+        '''
+        @param numWorkers Number of threads used for submit()ted files
+        @param checkVariables Whether to check the variable list of the
+               files (requires netCDF4)
+        @param postProcess Called as postProcess(path, dataset) for the files
+               that pass, before they are added to the manifest. If it
+               changes the files, their size will no longer match the size
+               on the server, so this is not checked for files that are
+               already in the manifest.
+        @param onVerified Called with the path of every good file (including
+               those already in the manifest), from the thread that
+               verified it, e.g. ReadyDateTracker.file_ready
+        '''
+        self._log = log if log is not None else _default_log()
+        self.check_variables = checkVariables
+        self.post_process = postProcess
+        self.on_verified = onVerified
+        if checkVariables and nc4 is None:
+            self._log.warn("netCDF4 is not available; the variable list of "
+                           "the files will not be checked")
+        self._manifests = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.num_verified = 0
+        self.failed = []
+        self._workers = []
+        for i in range(numWorkers):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def manifest(self, directory):
+        """ @return the ChecksumManifest of `directory' """
+        with self._lock:
+            if directory not in self._manifests:
+                self._manifests[directory] = ChecksumManifest(directory)
+            return self._manifests[directory]
+
+    def verify(self, path, dataset=None, expectedSize=None, checksum=None):
+        """
+        Verify `path' unless it is already in its directory's manifest (with
+        the same size, and with `expectedSize' if given)
+        @param dataset Collection of the file, used to determine the
+               variables it should have
+        @param checksum Checksum of the file, if already known (e.g. computed
+               while downloading). Otherwise it is computed here.
+        @return True if the file is good
+        """
+        manifest = self.manifest(os.path.dirname(path))
+        name = os.path.basename(path)
+        if manifest.is_verified(path):
+            if expectedSize is None or self.post_process is not None \
+                    or expectedSize == manifest.get(name)[1]:
+                if self.on_verified is not None:
+                    self.on_verified(path)
+                return True
+        variables = None
+        if self.check_variables and dataset is not None:
+            variables = collection_variables(dataset)
+        try:
+            verify_file(path, expectedSize, variables)
+        except (IntegrityError, IOError, OSError) as e:
+            self._log.error("Verification of {0} failed: {1}".format(path, e))
+            with self._lock:
+                self.failed.append(path)
+            return False
+        if self.post_process is not None and dataset is not None:
+            try:
+                self.post_process(path, dataset)
+                checksum = None
+            except Exception as e:
+                self._log.error("Unable to post-process {0}: {1}. Keeping "
+                                "it as is".format(path, e))
+        if checksum is None:
+            checksum = file_checksum(path)
+        manifest.add(name, checksum, os.path.getsize(path))
+        with self._lock:
+            self.num_verified += 1
+        if self.on_verified is not None:
+            self.on_verified(path)
+        return True
+
+    def submit(self, path, dataset=None, expectedSize=None, checksum=None,
+               onFailure=None):
+        """
+        Queue `path' for verification by the worker threads.
+        @param onFailure Called with `path' if the file is bad, e.g. to
+               delete it and remove it from the download journal
+        """
+        self._queue.put((path, dataset, expectedSize, checksum, onFailure))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                (path, dataset, expectedSize, checksum, onFailure) = item
+                try:
+                    ok = self.verify(path, dataset, expectedSize, checksum)
+                except Exception as e:
+                    self._log.error("Unable to verify {0}: {1}".format(path, e))
+                    continue
+                if not ok and onFailure is not None:
+                    onFailure(path)
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """ Wait for all submitted files to be verified and stop the workers """
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
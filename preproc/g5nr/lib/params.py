@@ -170,6 +170,13 @@ class LIS_Params(object):
         "ST":"SoilTemp_tavg", # suffix will be set in nc2nps
         "SM":"SoilMoist_tavg" # ditto
                 }
+    # G5NR fields (names as in G5NR_Params.NPS_2_G5NR) that lis_input_combiner
+    # merges into the LIS forcing files
+    FORCING_FIELDS = ["SWLAND", 'TLML', 'QLML', 'SWGDN', "LWGAB", 'PS',
+                      "PRECTOT", "PRECSNO", "PRECCON", "HLML", "PARDR",
+                      "PARDF"]
+    # Fields it needs to derive other forcing fields (SPEEDLML)
+    FORCING_DEPENDENCIES = ["ULML", "VLML"]
 
 class NPS_Params(object):
     # Mandatory NPS atmospheric fields
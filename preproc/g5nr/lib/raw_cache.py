@@ -0,0 +1,293 @@
+"""
+Disk budget for the raw collection files.
+
+The raw collections take a lot of space, and once the preprocessing has
+turned a date into combined/nps_int files (or LIS forcing files), its raw
+files are no longer needed. RawCollectionCache keeps the space used by the
+output directory of a retriever under a budget:
+ - Before each transfer, the retriever reserves the size of the file with
+   reserve(). If it does not fit, the cache evicts (deletes) files whose
+   dates have all been consumed, least recently used first, until it does.
+ - A date is consumed when every consumer that needs it (by default only
+   nr_input_generator.py) has written its consumed marker (see
+   ready_dates.mark_consumed()).
+ - If evicting is not enough, reserve() blocks (i.e. the retriever is
+   throttled) until the consumers have caught up, checking every
+   `pollInterval' seconds. It only waits while some ready date (see
+   ready_dates.py) is still to be consumed: if the consumers are waiting for
+   files themselves, the transfer goes ahead over the budget, since waiting
+   would never end.
+Only files of the planned dates are evicted; other files in the directory
+count towards the budget but are left alone. Partial (.tmp) files count
+too.
+The download journal keeps the entries of evicted files, and the retrievers
+drop the consumed dates from their plan (see unconsumed()), so a rerun does
+not download the evicted files again.
+"""
+
+import os
+import logging
+import threading
+
+from ready_dates import READY_DIR_NAME, CONSUMED_DIR_NAME, NR_INPUT_GENERATOR, \
+                        get_ready_dir, is_ready, is_consumed
+from resumable_transfer import TMP_SUFFIX
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='raw_cache'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+def _last_use(path):
+    """ @return when `path' was last read or written """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 0
+    return max(st.st_atime, st.st_mtime)
+
+
+class RawCollectionCache(object):
+    """
+    Keeps the size of a directory of raw collection files under a budget.
+    See module docstring. Safe to use from several threads.
+    """
+    def __init__(self, outputDirectory, filesByDate, budget, consumers=None,
+                 defaultConsumers=(NR_INPUT_GENERATOR,), pollInterval=60,
+                 onEvict=None, log=None):
+        '''
+        @param outputDirectory Directory the collection files are downloaded
+               to (in a subdirectory per dataset)
+        @param filesByDate List of (fcstDate, [(dataset, fileName), ...]),
+               e.g. from g5nr_collections.get_files_by_date()
+        @param budget Maximum number of bytes to use
+        @param consumers Dictionary mapping dates to the consumers that need
+               them (e.g. FetchPlan.consumers). Dates that are not in it
+               need `defaultConsumers'.
+        @param pollInterval Seconds between checks for consumed dates while
+               throttled
+        @param onEvict Called with the path of each evicted file
+        '''
+        self._log = log if log is not None else _default_log()
+        self.output_directory = outputDirectory
+        self.budget = budget
+        self.poll_interval = pollInterval
+        self.on_evict = onEvict
+        self._consumers = consumers if consumers is not None else {}
+        self._default_consumers = defaultConsumers
+        self._ready_dir = get_ready_dir(outputDirectory)
+        self._cond = threading.Condition()
+        # path -> dates that need it
+        self._dates = {}
+        for (fcstDate, files) in filesByDate:
+            for (dataset, fileName) in files:
+                path = os.path.normpath(os.path.join(outputDirectory, dataset,
+                                                     fileName))
+                self._dates.setdefault(path, set()).add(fcstDate)
+        self._all_dates = sorted(set(fcstDate for (fcstDate, files)
+                                     in filesByDate))
+        self._consumed = set()
+        # path -> size of the files in the directory
+        self._sizes = {}
+        self._used = 0
+        self._reserved = 0
+        self._throttled = False
+        self._over_budget = False
+        self.num_evicted = 0
+        self.bytes_evicted = 0
+        self._scan()
+        self._log.info("Raw collections use {0:.1f} of {1:.1f} GB"
+                       .format(self._used / 1e9, budget / 1e9))
+
+    def _scan(self):
+        for (dirpath, dirnames, filenames) in os.walk(self.output_directory):
+            if os.path.normpath(dirpath) == \
+                    os.path.normpath(self.output_directory):
+                dirnames[:] = [d for d in dirnames
+                               if d not in (READY_DIR_NAME, CONSUMED_DIR_NAME)]
+            for fileName in filenames:
+                self._update(os.path.join(dirpath, fileName))
+
+    def _update(self, path):
+        """ Must be called with the lock held """
+        path = os.path.normpath(path)
+        self._used -= self._sizes.pop(path, 0)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self._sizes[path] = size
+        self._used += size
+
+    def update(self, path):
+        """
+        Re-read the size of `path', e.g. after it was downloaded or
+        replaced by a subset
+        """
+        with self._cond:
+            self._update(path)
+            self._cond.notify_all()
+
+    def usage(self):
+        """ @return bytes used (including the reservations) """
+        with self._cond:
+            return self._used
+
+    def _consumed_dates(self):
+        """ Must be called with the lock held """
+        for fcstDate in self._all_dates:
+            if fcstDate in self._consumed:
+                continue
+            consumers = self._consumers.get(fcstDate, self._default_consumers)
+            if all(is_consumed(self.output_directory, fcstDate, consumer)
+                   for consumer in consumers):
+                self._consumed.add(fcstDate)
+        return self._consumed
+
+    def unconsumed(self, filesByDate):
+        """
+        @return `filesByDate' without the dates that every consumer has
+                consumed, i.e. the dates whose files still need transferring
+        """
+        with self._cond:
+            consumed = set(self._consumed_dates())
+        pending = [(fcstDate, files) for (fcstDate, files) in filesByDate
+                   if fcstDate not in consumed]
+        if len(pending) < len(filesByDate):
+            self._log.info("Skipping {0} dates that have been consumed"
+                           .format(len(filesByDate) - len(pending)))
+        return pending
+
+    def _evictable(self):
+        """
+        Must be called with the lock held
+        @return the files whose dates have all been consumed, least recently
+                used first
+        """
+        consumed = self._consumed_dates()
+        paths = [path for (path, dates) in self._dates.items()
+                 if path in self._sizes and dates <= consumed]
+        return sorted(paths, key=_last_use)
+
+    def _evict(self, path):
+        """ Must be called with the lock held """
+        size = self._sizes.pop(path)
+        self._used -= size
+        try:
+            os.unlink(path)
+        except OSError as e:
+            self._log.warn("Unable to evict {0}: {1}".format(path, e))
+            return
+        self.num_evicted += 1
+        self.bytes_evicted += size
+        self._log.debug("Evicted {0} ({1:.1f} MB)".format(path, size / 1e6))
+        if self.on_evict is not None:
+            self.on_evict(path)
+
+    def _make_room(self, nbytes):
+        """
+        Must be called with the lock held
+        @return True if `nbytes' fit in the budget, after evicting what can be
+        """
+        if self._used + nbytes <= self.budget:
+            return True
+        evicted = self.num_evicted
+        for path in self._evictable():
+            self._evict(path)
+            if self._used + nbytes <= self.budget:
+                break
+        if self.num_evicted > evicted:
+            self._log.info("Evicted {0} consumed files; raw collections use "
+                           "{1:.1f} of {2:.1f} GB"
+                           .format(self.num_evicted - evicted, self._used / 1e9,
+                                   self.budget / 1e9))
+        return self._used + nbytes <= self.budget
+
+    def _consumers_busy(self):
+        """
+        Must be called with the lock held
+        @return True if some ready date has not been consumed yet, i.e. the
+                consumers will free space
+        """
+        consumed = self._consumed_dates()
+        return any(is_ready(self._ready_dir, fcstDate)
+                   for fcstDate in self._all_dates if fcstDate not in consumed)
+
+    def try_reserve(self, nbytes=None):
+        """
+        Reserve `nbytes' (by default, the mean size of the files) for a
+        transfer, evicting files if needed
+        @return the reservation, to pass to commit() once the transfer is
+                over, or None if the retriever should wait
+        """
+        with self._cond:
+            if nbytes is None:
+                nbytes = self._used // len(self._sizes) if self._sizes else 0
+            if self._make_room(nbytes):
+                self._over_budget = False
+            elif self._consumers_busy():
+                return None
+            elif not self._over_budget:
+                self._log.warn("Raw collections exceed their budget, but no "
+                               "ready date is waiting to be consumed. Not "
+                               "throttling")
+                self._over_budget = True
+            if self._throttled:
+                self._log.info("Resuming transfers; raw collections use "
+                               "{0:.1f} of {1:.1f} GB"
+                               .format(self._used / 1e9, self.budget / 1e9))
+                self._throttled = False
+            self._used += nbytes
+            self._reserved += nbytes
+            return nbytes
+
+    def reserve(self, nbytes=None):
+        """
+        Like try_reserve(), but wait (i.e. throttle the caller) until the
+        reservation can be made
+        """
+        while True:
+            reservation = self.try_reserve(nbytes)
+            if reservation is not None:
+                return reservation
+            with self._cond:
+                if not self._throttled:
+                    self._log.warn("Raw collections use {0:.1f} of {1:.1f} GB. "
+                                   "Waiting for the preprocessing to consume "
+                                   "dates".format(self._used / 1e9,
+                                                  self.budget / 1e9))
+                    self._throttled = True
+                self._cond.wait(self.poll_interval)
+
+    def commit(self, reservation, path=None):
+        """
+        Cancel a `reservation' and account for the actual size of `path' (and
+        of its partial .tmp file, if the transfer was interrupted)
+        """
+        with self._cond:
+            self._used -= reservation
+            self._reserved -= reservation
+            if path is not None:
+                self._update(path)
+                self._update(path + TMP_SUFFIX)
+            self._cond.notify_all()
+
+    def summary(self):
+        """ @return string with the usage and evictions """
+        with self._cond:
+            return ("raw collections use {0:.1f} of {1:.1f} GB; {2} files "
+                    "({3:.1f} GB) evicted".format(self._used / 1e9,
+                                                  self.budget / 1e9,
+                                                  self.num_evicted,
+                                                  self.bytes_evicted / 1e9))
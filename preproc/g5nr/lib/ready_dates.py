@@ -0,0 +1,209 @@
+"""
+Ready markers for forecast dates whose collection files are all downloaded.
+
+The retrievers transfer the files date-major (see
+g5nr_collections.get_transfer_plan()), and a ReadyDateTracker writes a
+marker for each forecast date as soon as the files of every collection for
+that date are present and verified:
+    <output directory>/ready/<%Y%m%d_%H%M>.ready
+The marker lists the paths of the files, one per line. It is written to a
+temporary file and renamed, so a marker that exists is always complete.
+
+The preprocessing (nr_input_generator.py) can then process the dates as
+they become ready (see wait_for_ready_dates()) instead of waiting for the
+whole download to finish.
+
+Conversely, once a consumer of the files (nr_input_generator.py,
+lis_input_combiner.py) is done with a date, it writes
+    <output directory>/consumed/<%Y%m%d_%H%M>.<consumer>
+(see mark_consumed()), so the files that are no longer needed can be
+evicted (see raw_cache.py).
+
+The files of the output directory are expected to be laid out as
+    <output directory>/<dataset>/<file name>
+which is where the retrievers put them and where nr_input_generator.py
+looks for them.
+"""
+
+import os
+import time
+import logging
+import threading
+
+READY_DIR_NAME = "ready"
+MARKER_FORMAT = "%Y%m%d_%H%M.ready"
+CONSUMED_DIR_NAME = "consumed"
+CONSUMED_FORMAT = "%Y%m%d_%H%M.{consumer}"
+# Names of the consumers, for mark_consumed()
+NR_INPUT_GENERATOR = "nr_input_generator"
+LIS_INPUT_COMBINER = "lis_input_combiner"
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='ready_dates'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+def get_ready_dir(outputDirectory):
+    """ @return the directory with the ready markers of `outputDirectory' """
+    return os.path.join(outputDirectory, READY_DIR_NAME)
+
+def get_marker_path(readyDir, fcstDate):
+    """ @return path of the ready marker of `fcstDate' """
+    return os.path.join(readyDir, fcstDate.strftime(MARKER_FORMAT))
+
+def is_ready(readyDir, fcstDate):
+    return os.path.exists(get_marker_path(readyDir, fcstDate))
+
+def _makedirs(directory):
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(directory):
+                raise
+
+def write_marker(readyDir, fcstDate, paths):
+    """ Atomically create the ready marker of `fcstDate', listing `paths' """
+    _makedirs(readyDir)
+    markerPath = get_marker_path(readyDir, fcstDate)
+    tempPath = markerPath + ".tmp"
+    with open(tempPath, "w") as f:
+        for path in paths:
+            f.write(path + "\n")
+    os.rename(tempPath, markerPath)
+    return markerPath
+
+def get_consumed_path(outputDirectory, fcstDate, consumer):
+    """ @return path of the marker of `consumer' being done with `fcstDate' """
+    return os.path.join(outputDirectory, CONSUMED_DIR_NAME,
+                        fcstDate.strftime(CONSUMED_FORMAT.format(
+                                          consumer=consumer)))
+
+def is_consumed(outputDirectory, fcstDate, consumer):
+    return os.path.exists(get_consumed_path(outputDirectory, fcstDate,
+                                            consumer))
+
+def mark_consumed(outputDirectory, fcstDate, consumer, log=None):
+    """
+    Record that `consumer' no longer needs the files of `fcstDate' in
+    `outputDirectory'. Failures are only logged, since the marker is just an
+    optimization (the files are kept longer without it).
+    """
+    if log is None:
+        log = _default_log()
+    path = get_consumed_path(outputDirectory, fcstDate, consumer)
+    try:
+        _makedirs(os.path.dirname(path))
+        open(path, "w").close()
+    except (IOError, OSError) as e:
+        log.warn("Unable to mark {0} as consumed by {1}: {2}"
+                 .format(fcstDate, consumer, e))
+
+def wait_for_ready_dates(readyDir, dates, pollInterval=60, timeout=None,
+                         log=None):
+    """
+    Generator of the `dates' whose ready marker exists, in the order they
+    become ready (and in the order of `dates' among those ready at the same
+    time). Waits for the markers that do not exist yet, checking every
+    `pollInterval' seconds.
+    @param timeout Stop waiting if no date has become ready in this many
+           seconds (None: wait forever). The dates that are not ready by
+           then are not generated.
+    """
+    if log is None:
+        log = _default_log()
+    pending = list(dates)
+    lastReady = time.time()
+    while pending:
+        ready = [d for d in pending if is_ready(readyDir, d)]
+        if ready:
+            for fcstDate in ready:
+                pending.remove(fcstDate)
+                yield fcstDate
+            lastReady = time.time()
+            continue
+        if timeout is not None and time.time() - lastReady >= timeout:
+            log.warn("No date became ready in {0}s. Giving up on {1}"
+                     .format(timeout, ", ".join(str(d) for d in pending)))
+            return
+        log.debug("Waiting for {0} dates (next: {1})".format(len(pending),
+                                                             pending[0]))
+        time.sleep(pollInterval)
+
+
+class ReadyDateTracker(object):
+    """
+    Keeps track of which files of each forecast date are still missing and
+    writes the ready marker of a date when none are. See module docstring.
+    Safe to use from several threads (e.g. as the `onVerified' callback of
+    integrity.FileVerifier).
+    """
+    def __init__(self, outputDirectory, filesByDate, log=None):
+        '''
+        @param outputDirectory Directory the collection files are downloaded
+               to (in a subdirectory per dataset)
+        @param filesByDate List of (fcstDate, [(dataset, fileName), ...]),
+               e.g. from g5nr_collections.get_files_by_date()
+        '''
+        self._log = log if log is not None else _default_log()
+        self.ready_dir = get_ready_dir(outputDirectory)
+        self._lock = threading.Lock()
+        # fcstDate -> paths of all its files, and of those still missing
+        self._files = {}
+        self._missing = {}
+        # path -> dates that need it
+        self._dates = {}
+        self.num_ready = 0
+        for (fcstDate, files) in filesByDate:
+            if is_ready(self.ready_dir, fcstDate):
+                continue
+            paths = [os.path.normpath(os.path.join(outputDirectory, dataset,
+                                                   fileName))
+                     for (dataset, fileName) in files]
+            self._files[fcstDate] = paths
+            self._missing[fcstDate] = set(paths)
+            for path in paths:
+                self._dates.setdefault(path, []).append(fcstDate)
+
+    def file_ready(self, path):
+        """
+        Report that the file at `path' is present and verified. Writes the
+        markers of the dates that no longer miss any file.
+        """
+        path = os.path.normpath(path)
+        readyDates = []
+        with self._lock:
+            for fcstDate in self._dates.pop(path, []):
+                missing = self._missing[fcstDate]
+                missing.discard(path)
+                if not missing:
+                    del self._missing[fcstDate]
+                    readyDates.append((fcstDate, self._files.pop(fcstDate)))
+        for (fcstDate, paths) in readyDates:
+            markerPath = write_marker(self.ready_dir, fcstDate, paths)
+            self._log.info("All files for {0} are ready: {1}"
+                           .format(fcstDate, markerPath))
+            with self._lock:
+                self.num_ready += 1
+
+    def pending_dates(self):
+        """ @return sorted list of the dates that still miss files """
+        with self._lock:
+            return sorted(self._missing.keys())
+
+    def missing_files(self, fcstDate):
+        """ @return sorted list of the files still missing for `fcstDate' """
+        with self._lock:
+            return sorted(self._missing.get(fcstDate, ()))
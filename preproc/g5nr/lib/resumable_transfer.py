@@ -0,0 +1,141 @@
+"""
+Resumable downloads for the collection retrievers.
+
+Data are written to <destPath>.tmp, which is only renamed to <destPath> once
+its size matches the size reported by the server. If a transfer is
+interrupted, the .tmp file is kept and the next attempt (in the same run or
+a later one) resumes from its current size, using REST for FTP (and a Range
+header for HTTP, see http_pool.py), instead of downloading the whole file
+again.
+
+Interrupted or short transfers raise IncompleteTransferError. It is a
+subclass of ftplib.error_temp, so FTPConnectionPool.run() treats it like any
+other transient error and retries on a fresh connection.
+"""
+
+import os
+import ftplib
+import logging
+
+from download_journal import ChecksumWriter
+
+TMP_SUFFIX = ".tmp"
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='resumable_transfer'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class IncompleteTransferError(ftplib.error_temp):
+    """ The transfer ended before the whole file was received """
+    pass
+
+
+def prepare_partial(tempPath, expectedSize=None, log=None):
+    """
+    @return the offset to resume from: the size of an existing partial
+            file, or 0 if there is none (or if it cannot be a prefix of the
+            remote file)
+    """
+    if not os.path.exists(tempPath):
+        return 0
+    if log is None:
+        log = _default_log()
+    offset = os.path.getsize(tempPath)
+    if expectedSize is not None and offset > expectedSize:
+        log.warn("Partial file {0} is larger than the remote file ({1} > {2})."
+                 " Starting over".format(tempPath, offset, expectedSize))
+        os.unlink(tempPath)
+        return 0
+    return offset
+
+def open_partial(tempPath, offset):
+    """
+    Open the temp file for appending at `offset' and prime the checksum
+    with the bytes already there
+    @return (file object, ChecksumWriter)
+    """
+    if offset:
+        f = open(tempPath, "r+b")
+        f.truncate(offset)
+        f.seek(offset)
+    else:
+        f = open(tempPath, "wb")
+    writer = ChecksumWriter(f)
+    if offset:
+        writer.digest_existing(tempPath, offset)
+    return (f, writer)
+
+def finish_partial(tempPath, destPath, expectedSize):
+    """
+    Make sure the temp file is complete and move it into place
+    @raise IncompleteTransferError if its size is not `expectedSize'
+    """
+    size = os.path.getsize(tempPath)
+    if expectedSize is not None and size != expectedSize:
+        raise IncompleteTransferError(
+                "Got {0} of {1} bytes of {2}".format(size, expectedSize,
+                                                     os.path.basename(destPath)))
+    os.rename(tempPath, destPath)
+
+def ftp_size(ftp, remotePath):
+    """
+    @return size of `remotePath' according to the server, or None if the
+            server will not say
+    """
+    try:
+        ftp.voidcmd("TYPE I")
+        size = ftp.size(remotePath)
+    except ftplib.error_perm:
+        return None
+    return size
+
+def retrieve_ftp(ftp, remotePath, destPath, expectedSize=None, log=None):
+    """
+    Download (or finish downloading) `remotePath' to `destPath' over the
+    logged-in connection `ftp'.
+    @param expectedSize Size of the remote file, if already known (e.g.
+           from a directory listing). If None, it is queried with SIZE.
+    @return the checksum (see download_journal) of the downloaded file
+    @raise IncompleteTransferError if the file is short
+    @raise ftplib.error_perm if the file does not exist
+    """
+    if log is None:
+        log = _default_log()
+    tempPath = destPath + TMP_SUFFIX
+    if expectedSize is None:
+        expectedSize = ftp_size(ftp, remotePath)
+    offset = prepare_partial(tempPath, expectedSize, log)
+    (f, writer) = open_partial(tempPath, offset)
+    try:
+        if offset and offset == expectedSize:
+            log.info("{0} was already complete".format(tempPath))
+        else:
+            if offset:
+                log.info("Resuming {0} at byte {1} of {2}"
+                         .format(os.path.basename(remotePath), offset,
+                                 expectedSize))
+            ftp.retrbinary("RETR " + remotePath, writer.write,
+                           rest=offset if offset else None)
+    finally:
+        f.close()
+    finish_partial(tempPath, destPath, expectedSize)
+    return writer.hexdigest()
+
+def _content_range_total(header):
+    """ @return the total size in a 'bytes a-b/total' header, or None """
+    if header is None or "/" not in header:
+        return None
+    total = header.rsplit("/", 1)[1].strip()
+    return None if total == "*" else int(total)
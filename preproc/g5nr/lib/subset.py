@@ -0,0 +1,188 @@
+"""
+Subsetting of downloaded G5NR collection files.
+
+The preprocessing only uses a few variables of each collection (those that
+G5NR_Params.NPS_2_G5NR and DERIVED_VAR_DEPENDENCIES refer to, see
+params.py, plus EXTRA_VARIABLES), and only over the regional domain. subset_file() copies the
+needed variables, plus the dimension variables, optionally restricted to a
+lat/lon box, to a new (compressed) netCDF4 file. Data are copied one
+horizontal slab at a time, so the whole variable is never in memory.
+
+The box is given as (latMin, latMax, lonMin, lonMax), in degrees. If
+lonMin > lonMax the box crosses the date line. Longitudes are assumed to be
+in the same convention as the file (-180 to 180 for G5NR).
+
+Requires numpy and netCDF4.
+"""
+
+import os
+import logging
+
+import numpy as np
+import netCDF4 as nc4
+
+from params import G5NR_Params
+
+DIM_VARIABLES = ("lon", "lat", "lev", "time")
+# Variables the preprocessing reads directly, i.e. that are in neither table
+# of params.py: PL is the hybrid level pressure (see
+# nr_input_generator.get_g5nr_pressure_array())
+EXTRA_VARIABLES = ("PL",)
+TMP_SUFFIX = ".subset"
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='subset'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+def needed_variables(dataset, g5nr=G5NR_Params):
+    """
+    @return sorted list of the variables of collection `dataset' that are
+            used, directly or to derive other fields, by the preprocessing
+    """
+    used = set(EXTRA_VARIABLES)
+    for value in list(g5nr.NPS_2_G5NR.values()) + \
+                 list(g5nr.DERIVED_VAR_DEPENDENCIES.values()):
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            used.update(value)
+        else:
+            used.add(value)
+    return sorted(var for var in used
+                  if g5nr.VAR_2_COLLECTION.get(var) == dataset)
+
+def _lat_selection(lats, bbox):
+    """ @return slice of the `lats' in the box """
+    if bbox is None:
+        return slice(None)
+    idx = np.nonzero((lats >= bbox[0]) & (lats <= bbox[1]))[0]
+    if len(idx) == 0:
+        raise Exception("No latitudes in [{0}, {1}]".format(bbox[0], bbox[1]))
+    return slice(idx[0], idx[-1] + 1)
+
+def _lon_selection(lons, bbox):
+    """
+    @return list of slices of the `lons' in the box, in west-to-east order.
+            There are two if the box crosses the date line.
+    """
+    if bbox is None:
+        return [slice(None)]
+    (lonMin, lonMax) = (bbox[2], bbox[3])
+    if lonMin <= lonMax:
+        ranges = [(lons >= lonMin) & (lons <= lonMax)]
+    else:
+        ranges = [lons >= lonMin, lons <= lonMax]
+    slices = []
+    for mask in ranges:
+        idx = np.nonzero(mask)[0]
+        if len(idx):
+            slices.append(slice(idx[0], idx[-1] + 1))
+    if not slices:
+        raise Exception("No longitudes in [{0}, {1}]".format(lonMin, lonMax))
+    return slices
+
+def _copy_data(srcVar, destVar, latSel, lonSels):
+    dims = srcVar.dimensions
+    if dims == ("lat",):
+        destVar[:] = srcVar[latSel]
+    elif dims == ("lon",):
+        destVar[:] = np.concatenate([srcVar[s] for s in lonSels])
+    elif dims[-2:] != ("lat", "lon"):
+        destVar[:] = srcVar[:]
+    else:
+        # one horizontal slab at a time
+        for idx in np.ndindex(*srcVar.shape[:-2]):
+            slab = np.concatenate([srcVar[idx + (latSel, s)] for s in lonSels],
+                                  axis=-1)
+            destVar[idx + (slice(None), slice(None))] = slab
+
+def subset_file(srcPath, destPath, variables, bbox=None, zlib=True, log=None):
+    """
+    Write the `variables' of `srcPath' (plus the dimension variables),
+    restricted to `bbox' if given, to netCDF4 file `destPath'
+    @raise Exception if a variable is not in `srcPath'
+    """
+    if log is None:
+        log = _default_log()
+    src = nc4.Dataset(srcPath, "r")
+    try:
+        missing = [v for v in variables if v not in src.variables]
+        if missing:
+            raise Exception("{0} does not have variables {1}"
+                            .format(srcPath, ", ".join(missing)))
+        # Copy the raw (packed, unmasked) values
+        src.set_auto_maskandscale(False)
+        latSel = slice(None)
+        lonSels = [slice(None)]
+        if bbox is not None:
+            latSel = _lat_selection(src.variables["lat"][:], bbox)
+            lonSels = _lon_selection(src.variables["lon"][:], bbox)
+        dest = nc4.Dataset(destPath, "w", format="NETCDF4")
+        try:
+            dest.set_auto_maskandscale(False)
+            dest.setncatts(dict((k, src.getncattr(k)) for k in src.ncattrs()))
+            for (name, dim) in src.dimensions.items():
+                if dim.isunlimited():
+                    size = None
+                elif name == "lat":
+                    size = len(range(*latSel.indices(len(dim))))
+                elif name == "lon":
+                    size = sum(len(range(*s.indices(len(dim)))) for s in lonSels)
+                else:
+                    size = len(dim)
+                dest.createDimension(name, size)
+            for name in [v for v in DIM_VARIABLES if v in src.variables] + \
+                        list(variables):
+                srcVar = src.variables[name]
+                attrs = dict((k, srcVar.getncattr(k)) for k in srcVar.ncattrs())
+                fillValue = attrs.pop("_FillValue", None)
+                log.debug("Copying {0} {1}".format(name, srcVar.dimensions))
+                destVar = dest.createVariable(name, srcVar.datatype,
+                                              srcVar.dimensions, zlib=zlib,
+                                              fill_value=fillValue)
+                destVar.setncatts(attrs)
+                _copy_data(srcVar, destVar, latSel, lonSels)
+        finally:
+            dest.close()
+    finally:
+        src.close()
+
+def subset_in_place(path, dataset, bbox=None, log=None):
+    """
+    Replace collection file `path' (of collection `dataset') by its subset
+    with the needed_variables() and `bbox'. The subset is written to a
+    temporary file that is renamed over the original.
+    @return (original size, new size)
+    """
+    if log is None:
+        log = _default_log()
+    variables = needed_variables(dataset)
+    if not variables:
+        raise Exception("No variables of {0} are used. Not subsetting {1}"
+                        .format(dataset, path))
+    origSize = os.path.getsize(path)
+    tempPath = path + TMP_SUFFIX
+    try:
+        subset_file(path, tempPath, variables, bbox, log=log)
+    except:
+        if os.path.exists(tempPath):
+            os.unlink(tempPath)
+        raise
+    os.rename(tempPath, path)
+    newSize = os.path.getsize(path)
+    log.info("Subset {0} to {1}: {2:.1f} -> {3:.1f} MB"
+             .format(os.path.basename(path), ", ".join(variables),
+                     origSize / 1e6, newSize / 1e6))
+    return (origSize, newSize)
@@ -0,0 +1,238 @@
+"""
+Throughput telemetry and adaptive concurrency for the collection retrievers.
+
+TelemetryLog appends one CSV line per event to a file:
+    time,event,name,bytes,seconds,MBps,limit,active,note
+where `event' is
+    transfer   - a file was transferred (`bytes' in `seconds')
+    error      - a transient server error (`note' has the message)
+    aggregate  - throughput of all the transfers over the last interval
+    limit      - the concurrency limit was changed (`note' says why)
+
+ConcurrencyController bounds the number of concurrent transfers and adjusts
+the bound at run time, AIMD-style:
+ - every `interval' seconds (or once a transfer completes, if none did
+   in that time), if there were no server errors, the limit is
+   increased by `increaseStep', unless the previous increase did not improve
+   the aggregate throughput by at least `minGain' (then it is undone);
+ - on a transient server error (e.g. error_temp when the server has too
+   many users), the limit is multiplied by `decreaseFactor' (at most once
+   per interval, since errors tend to come in bursts).
+The limit stays between `minLimit' and `maxLimit'.
+The aggregate throughput over an interval is estimated as the mean rate of
+the transfers that completed in it times the (time-averaged) number of
+active transfers. Unlike the number of bytes completed in the interval, this
+does not depend on when the transfers happen to end.
+
+Workers call acquire() before a transfer and release() after it, and report
+each transfer with record_transfer() and each server error with
+record_error().
+"""
+
+import os
+import time
+import logging
+import threading
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='throughput'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class TelemetryLog(object):
+    """ CSV log of transfer events. See module docstring """
+    HEADER = "time,event,name,bytes,seconds,MBps,limit,active,note\n"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        newFile = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "a")
+        if newFile:
+            self._file.write(self.HEADER)
+            self._file.flush()
+
+    def write(self, event, name="", nbytes="", seconds="", limit="", active="",
+              note=""):
+        rate = ""
+        if nbytes != "" and seconds:
+            rate = "{0:.3f}".format(nbytes / 1e6 / seconds)
+        if seconds != "":
+            seconds = "{0:.3f}".format(seconds)
+        note = str(note).replace(",", ";").replace("\n", " ")
+        line = ",".join(str(x) for x in (
+                   time.strftime("%Y-%m-%dT%H:%M:%S"), event, name, nbytes,
+                   seconds, rate, limit, active, note))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ConcurrencyController(object):
+    """
+    Adaptive bound on the number of concurrent transfers. See module
+    docstring.
+    """
+    def __init__(self, minLimit=1, maxLimit=16, initialLimit=None,
+                 increaseStep=1, decreaseFactor=0.5, interval=60.,
+                 minGain=0.05, telemetry=None, onLimitChange=None, log=None):
+        '''
+        @param minLimit Lower bound on the number of concurrent transfers
+        @param maxLimit Upper bound on the number of concurrent transfers
+        @param initialLimit Starting limit (default: `minLimit')
+        @param increaseStep How much to increase the limit every interval
+        @param decreaseFactor Multiply the limit by this on server errors
+        @param interval Seconds between adjustments (and between the
+               aggregate throughput measurements)
+        @param minGain Minimum relative throughput improvement for an
+               increase of the limit to be kept
+        @param telemetry TelemetryLog to write events to
+        @param onLimitChange Called with the new limit whenever it changes
+               (e.g. FTPConnectionPool.trim, to log out of the connections
+               that are no longer needed)
+        '''
+        self.min_limit = minLimit
+        self.max_limit = maxLimit
+        self.limit = initialLimit if initialLimit is not None else minLimit
+        self.limit = max(minLimit, min(maxLimit, self.limit))
+        self.increase_step = increaseStep
+        self.decrease_factor = decreaseFactor
+        self.interval = interval
+        self.min_gain = minGain
+        self.telemetry = telemetry
+        self.on_limit_change = onLimitChange
+        self._log = log if log is not None else _default_log()
+        self._cond = threading.Condition()
+        self.active = 0
+        self.total_bytes = 0
+        self.total_files = 0
+        self.total_errors = 0
+        self._start = time.time()
+        self._window_start = self._start
+        self._window_bytes = 0
+        self._window_seconds = 0.
+        self._window_errors = 0
+        # integral of `active' over time, since _window_start
+        self._active_time = 0.
+        self._active_since = self._start
+        self._last_rate = None
+        self._increased = False
+        self._last_decrease = 0
+
+    def _update_active_time(self, now):
+        """ Must be called with the lock held, before `active' changes """
+        self._active_time += self.active * (now - self._active_since)
+        self._active_since = now
+
+    def acquire(self):
+        """ Block until fewer than `limit' transfers are running """
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self._update_active_time(time.time())
+            self.active += 1
+
+    def release(self):
+        with self._cond:
+            self._update_active_time(time.time())
+            self.active -= 1
+            self._cond.notify_all()
+
+    def _set_limit(self, limit, reason):
+        """ Must be called with the lock held """
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        if limit == self.limit:
+            return
+        self._log.info("Concurrency limit {0} -> {1} ({2})"
+                       .format(self.limit, limit, reason))
+        self.limit = limit
+        if self.telemetry is not None:
+            self.telemetry.write("limit", limit=limit, active=self.active,
+                                 note=reason)
+        if self.on_limit_change is not None:
+            self.on_limit_change(limit)
+        self._cond.notify_all()
+
+    def _maybe_adjust(self, now):
+        """ Must be called with the lock held """
+        elapsed = now - self._window_start
+        if elapsed < self.interval or not self._window_seconds:
+            return
+        self._update_active_time(now)
+        meanActive = self._active_time / elapsed
+        rate = self._window_bytes / self._window_seconds * meanActive
+        if self.telemetry is not None:
+            self.telemetry.write("aggregate", nbytes=int(rate * elapsed),
+                                 seconds=elapsed, limit=self.limit,
+                                 active="{0:.2f}".format(meanActive))
+        if self._window_errors:
+            # already decreased in record_error()
+            self._increased = False
+        elif self._increased and self._last_rate is not None \
+                and rate < self._last_rate * (1 + self.min_gain):
+            self._set_limit(self.limit - self.increase_step,
+                            "no throughput gain: {0:.2f} -> {1:.2f} MB/s"
+                            .format(self._last_rate / 1e6, rate / 1e6))
+            self._increased = False
+        elif self.limit < self.max_limit:
+            self._set_limit(self.limit + self.increase_step,
+                            "{0:.2f} MB/s without errors".format(rate / 1e6))
+            self._increased = True
+        self._last_rate = rate
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_seconds = 0.
+        self._window_errors = 0
+        self._active_time = 0.
+
+    def record_transfer(self, name, nbytes, seconds):
+        """ Report that `nbytes' of file `name' were transferred in `seconds' """
+        with self._cond:
+            self.total_bytes += nbytes
+            self.total_files += 1
+            self._window_bytes += nbytes
+            self._window_seconds += seconds
+            if self.telemetry is not None:
+                self.telemetry.write("transfer", name=name, nbytes=nbytes,
+                                     seconds=seconds, limit=self.limit,
+                                     active=self.active)
+            self._maybe_adjust(time.time())
+
+    def record_error(self, error):
+        """ Report a transient server error """
+        now = time.time()
+        with self._cond:
+            self.total_errors += 1
+            self._window_errors += 1
+            if self.telemetry is not None:
+                self.telemetry.write("error", limit=self.limit,
+                                     active=self.active, note=error)
+            if now - self._last_decrease >= self.interval:
+                self._last_decrease = now
+                self._set_limit(int(self.limit * self.decrease_factor),
+                                "server error: {0}".format(error))
+            self._maybe_adjust(now)
+
+    def summary(self):
+        """ @return string with the overall throughput """
+        elapsed = time.time() - self._start
+        return ("{0} files, {1:.1f} MB in {2:.0f}s ({3:.2f} MB/s); {4} server "
+                "errors; final concurrency limit {5}"
+                .format(self.total_files, self.total_bytes / 1e6, elapsed,
+                        self.total_bytes / 1e6 / max(elapsed, 1e-6),
+                        self.total_errors, self.limit))
@@ -0,0 +1,735 @@
+#!/usr/bin/env python3
+"""
+Download a given set of g5nr data using a single asyncio event loop.
+This is an alternative to collection_retriever_threaded.py: instead of one
+thread per transfer, all transfers are coroutines multiplexed on one loop,
+so many more of them can be in flight at once. The number of simultaneous
+connections to each host is bounded by `connections_per_host', and
+control connections are reused between transfers.
+
+The data that is downloaded is specified via variables, like in the other
+retrievers, and the remote paths are built with lib/g5nr_collections.py.
+Each file is streamed to <dest>.tmp and atomically renamed when complete.
+An interrupted transfer resumes from the end of the .tmp file (REST for FTP,
+a Range request for HTTP) instead of starting over.
+With FTP, each day directory is listed once and files that are not in the
+listing are skipped without trying to retrieve them.
+Downloaded files are verified by a pool of threads (lib/integrity.py) while
+the transfers go on; bad files are removed so the next run gets them again.
+If `subset_files' is set, files that pass are then replaced by a subset with
+only the variables (and region) used by the preprocessing (lib/subset.py).
+Transfers are started date-major, and once the files of all the collections
+for a forecast date are present and verified, a marker is written to
+<output_directory>/ready (lib/ready_dates.py), so the preprocessing can
+start on that date while the download goes on.
+If `raw_cache_budget' is set, the space used by output_directory is kept
+under it (lib/raw_cache.py): files of dates that the preprocessing has
+consumed are deleted, least recently used first, and transfers wait for the
+preprocessing to catch up if that is not enough.
+Instead of editing `datasets' and the dates, `preproc_config' can be set to
+the config file of nr_input_generator.py. The collections and dates are then
+derived from it and from params.py (lib/fetch_plan.py), so only what the
+preprocessing needs is downloaded.
+
+NOTE: Unlike the other scripts, this one requires Python 3.7+ (asyncio).
+      lib/g5nr_collections.py is compatible with both.
+
+To try it out offline, start g5nr_standin_server.py and set ftp_host,
+ftp_port (and/or http_host, http_port) accordingly.
+
+USAGE:
+  collection_retriever_async.py <journal file> [<pickle to import>]
+  The journal (see lib/download_journal.py) is an SQLite database of files
+  that have already been downloaded. If the file does not exist, it will be
+  created. To carry over the pickled list of the old retrievers, pass it as
+  the second argument.
+"""
+
+import sys
+import os
+import time
+import functools
+import random
+import asyncio
+import logging
+from datetime import datetime as dtime
+from datetime import timedelta as tdelta
+
+import g5nr_collections as collections
+from download_journal import open_journal
+from directory_listing import parse_mlsd_line
+from integrity import FileVerifier
+from ready_dates import ReadyDateTracker
+from fetch_plan import FetchPlan
+from raw_cache import RawCollectionCache
+from resumable_transfer import prepare_partial, open_partial, \
+                               finish_partial, IncompleteTransferError
+
+http_host = collections.HTTP_HOST
+http_port = 80
+http_topdir = collections.HTTP_TOPDIR
+ftp_host = collections.FTP_HOST
+ftp_port = 21
+ftp_user = collections.FTP_USER
+ftp_topdir = collections.FTP_TOPDIR
+
+use_http = False
+
+output_directory = '/scratch4/NAGAPE/aoml-osse/Javier.Delgado/nems/g5nr/data/raw_collections'
+res = '0.0625_deg'
+prefix = collections.FILE_PREFIX
+year= 2006 #/Y2006/
+month= 9 #M09
+day= 1 #D10/
+start_time = 0
+interval = 1 * 3600
+end_time = 10 * 3600 * 24
+
+# Maximum number of simultaneous connections (i.e. transfers) to each host
+connections_per_host = {ftp_host: 16, http_host: 16}
+default_connections_per_host = 8
+# Size of the chunks read from the data connection and written to disk
+chunk_size = 1024 * 1024
+# Seconds without data before a transfer is considered hung
+io_timeout = 120
+# How many times to try each file and the first wait between tries (doubles
+# after every failure)
+max_tries = 5
+backoff_base = 10
+backoff_max = 600
+# Number of threads verifying the downloaded files (see lib/integrity.py)
+num_verify_threads = 4
+# Optionally replace the downloaded files by a subset (see lib/subset.py;
+# requires netCDF4): only the variables used by params.G5NR_Params and, if
+# `subset_bbox' is set, only the (lat_min, lat_max, lon_min, lon_max) box
+subset_files = False
+subset_bbox = None
+# Optionally keep the size of output_directory under this many bytes (e.g.
+# 2e12), by evicting the files that the preprocessing has consumed and
+# throttling the transfers (see lib/raw_cache.py)
+raw_cache_budget = None
+
+datasets = [
+            "inst30mn_3d_H_Nv",
+            "inst30mn_3d_T_Nv",
+            "inst30mn_3d_U_Nv",
+            "inst30mn_3d_V_Nv",
+            "inst30mn_3d_RH_Nv",
+            "inst30mn_3d_QL_Nv",
+            "inst30mn_3d_QV_Nv",
+            "inst30mn_2d_met1_Nx",
+            "inst30mn_3d_DELP_Nv",
+            "tavg30mn_2d_met2_Nx",
+            "tavg30mn_2d_met3_Nx",
+            "const_2d_asm_Nx",
+            "inst30mn_3d_PL_Nv",
+           ]
+
+# Config file of nr_input_generator.py. If set, the collections and dates
+# are derived from it (see lib/fetch_plan.py), and `datasets', the dates
+# above and `output_directory' are not used
+preproc_config = None
+# With `preproc_config', also get what lis_input_combiner.py needs for the
+# LIS spin-up (lis_spinup_duration and lis_frequency in the config)
+plan_lis_forcing = False
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='collection_retriever_async'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class TransferError(Exception):
+    """ Transient failure; the transfer may be retried """
+    pass
+
+class PermanentError(Exception):
+    """ The file cannot be retrieved (e.g. it does not exist) """
+    pass
+
+
+class _AsyncClient(object):
+    """ Common parts of the FTP and HTTP clients """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    def is_open(self):
+        return self._writer is not None
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class AsyncFTPClient(_AsyncClient):
+    """
+    Minimal asyncio FTP client: login, passive-mode RETR (with REST), SIZE,
+    MLSD/NLST, NOOP
+    """
+    # Cleared (for all clients) if the server does not support MLSD
+    use_mlsd = True
+
+    def __init__(self, host, port, user, passwd=''):
+        super(AsyncFTPClient, self).__init__(host, port)
+        self.user = user
+        self.passwd = passwd
+
+    async def connect(self):
+        (self._reader, self._writer) = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), io_timeout)
+        await self._expect(self._read_reply(), "2")
+        code = await self._expect(self.command("USER " + self.user), "23")
+        if code.startswith("3"):
+            await self._expect(self.command("PASS " + self.passwd), "2")
+        await self._expect(self.command("TYPE I"), "2")
+
+    async def _read_reply(self):
+        """ @return the (possibly multi-line) reply as (code, text) """
+        line = await asyncio.wait_for(self._reader.readline(), io_timeout)
+        if not line:
+            raise TransferError("Control connection closed by server")
+        line = line.decode("latin-1").rstrip("\r\n")
+        code = line[:3]
+        text = [line[4:]]
+        if line[3:4] == "-":
+            while True:
+                line = await asyncio.wait_for(self._reader.readline(),
+                                              io_timeout)
+                if not line:
+                    raise TransferError("Control connection closed by server")
+                line = line.decode("latin-1").rstrip("\r\n")
+                if line.startswith(code + " "):
+                    text.append(line[4:])
+                    break
+                text.append(line)
+        return (code, "\n".join(text))
+
+    async def command(self, line):
+        self._writer.write((line + "\r\n").encode("latin-1"))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _expect(self, coro, okPrefixes):
+        """
+        Await the reply of `coro' and make sure its code starts with one of
+        `okPrefixes'. 4xx replies are transient, 5xx are permanent.
+        @return the reply code
+        """
+        (code, text) = await coro
+        if code[0] in okPrefixes:
+            return code
+        if code.startswith("5"):
+            raise PermanentError("{0} {1}".format(code, text))
+        raise TransferError("{0} {1}".format(code, text))
+
+    async def noop(self):
+        await self._expect(self.command("NOOP"), "2")
+
+    async def size(self, path):
+        (code, text) = await self.command("SIZE " + path)
+        if code != "213":
+            return None
+        return int(text.strip())
+
+    async def _pasv(self):
+        (code, text) = await self.command("PASV")
+        if code != "227":
+            raise TransferError("PASV failed: {0} {1}".format(code, text))
+        nums = text[text.index("(")+1:text.index(")")].split(",")
+        port = (int(nums[4]) << 8) + int(nums[5])
+        # Use the control connection host, like ftplib does for NAT'ed servers
+        return await asyncio.wait_for(
+                   asyncio.open_connection(self.host, port), io_timeout)
+
+    async def _read_lines(self, command):
+        """
+        Send a command whose reply comes over a data connection (e.g. a
+        directory listing)
+        @return list of the lines received
+        """
+        (dataReader, dataWriter) = await self._pasv()
+        try:
+            await self._expect(self.command(command), "1")
+            data = b""
+            while True:
+                chunk = await asyncio.wait_for(dataReader.read(chunk_size),
+                                               io_timeout)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            dataWriter.close()
+        await self._expect(self._read_reply(), "2")
+        return [l for l in data.decode("latin-1").split("\r\n") if l]
+
+    async def listdir(self, path):
+        """
+        @return dict mapping the names of the files in `path' to their size
+                (None if unknown). Empty if `path' does not exist.
+        """
+        try:
+            if self.use_mlsd:
+                try:
+                    files = {}
+                    for line in await self._read_lines("MLSD " + path):
+                        (name, facts) = parse_mlsd_line(line)
+                        if facts.get("type", "file").lower() == "file":
+                            size = facts.get("size")
+                            files[name] = int(size) if size else None
+                    return files
+                except PermanentError as e:
+                    if not str(e).startswith(("500", "501", "502", "504")):
+                        raise
+                    AsyncFTPClient.use_mlsd = False
+            return dict((line.rsplit("/", 1)[-1], None)
+                        for line in await self._read_lines("NLST " + path))
+        except PermanentError:
+            return {}
+
+    async def retr(self, path, openOutput, offset=0, size=None):
+        """
+        Stream remote `path', starting at byte `offset', into the file
+        object returned by openOutput(offset). `offset' is ignored if it
+        is past the end of the remote file.
+        @param size Size of the remote file, if known. Otherwise it is
+               queried with SIZE.
+        @return (number of bytes written, size of the remote file or None)
+        """
+        total = size if size is not None else await self.size(path)
+        if total is not None and offset > total:
+            offset = 0
+        if offset and offset == total:
+            openOutput(offset)
+            return (0, total)
+        (dataReader, dataWriter) = await self._pasv()
+        try:
+            if offset:
+                await self._expect(self.command("REST {0}".format(offset)),
+                                   "3")
+            await self._expect(self.command("RETR " + path), "1")
+            outFile = openOutput(offset)
+            nbytes = 0
+            while True:
+                chunk = await asyncio.wait_for(dataReader.read(chunk_size),
+                                               io_timeout)
+                if not chunk:
+                    break
+                outFile.write(chunk)
+                nbytes += len(chunk)
+        finally:
+            dataWriter.close()
+        await self._expect(self._read_reply(), "2")
+        return (nbytes, total)
+
+
+class AsyncHTTPClient(_AsyncClient):
+    """
+    Minimal asyncio HTTP/1.1 client that keeps its connection alive between
+    GET requests
+    """
+
+    async def connect(self):
+        (self._reader, self._writer) = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), io_timeout)
+
+    async def noop(self):
+        pass
+
+    async def retr(self, path, openOutput, offset=0, size=None):
+        """
+        GET `path', using a Range request if `offset' is set, and stream the
+        body into the file object returned by openOutput(offset), where
+        `offset' is 0 if the server sends the whole file
+        @return (number of bytes written, size of the remote file)
+        """
+        rangeHeader = "Range: bytes={0}-\r\n".format(offset) if offset else ""
+        request = ("GET {path} HTTP/1.1\r\nHost: {host}\r\n{range}"
+                   "Connection: keep-alive\r\n\r\n"
+                   .format(path=path, host=self.host, range=rangeHeader))
+        self._writer.write(request.encode("latin-1"))
+        await self._writer.drain()
+        status = await asyncio.wait_for(self._reader.readline(), io_timeout)
+        if not status:
+            raise TransferError("Connection closed by server")
+        code = status.split()[1].decode("latin-1")
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(self._reader.readline(), io_timeout)
+            line = line.decode("latin-1").strip()
+            if not line:
+                break
+            (key, value) = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if code not in ("200", "206"):
+            # drain the body so the connection can be reused
+            await asyncio.wait_for(self._reader.readexactly(length), io_timeout)
+            if code == "416" and offset:
+                total = _content_range_total(headers.get("content-range"))
+                if total == offset:
+                    openOutput(offset)
+                    return (0, total)
+                # partial file does not match the remote one; start over
+                openOutput(0)
+                raise TransferError("HTTP 416 for {0} at offset {1}"
+                                    .format(path, offset))
+            if code.startswith("4"):
+                raise PermanentError("HTTP {0} for {1}".format(code, path))
+            raise TransferError("HTTP {0} for {1}".format(code, path))
+        if code == "206":
+            total = _content_range_total(headers.get("content-range"))
+        else:
+            # no Range request, or the server ignored it
+            (offset, total) = (0, length)
+        outFile = openOutput(offset)
+        nbytes = 0
+        while nbytes < length:
+            chunk = await asyncio.wait_for(
+                        self._reader.read(min(chunk_size, length - nbytes)),
+                        io_timeout)
+            if not chunk:
+                raise TransferError("Connection closed after {0} of {1} bytes"
+                                    .format(nbytes, length))
+            outFile.write(chunk)
+            nbytes += len(chunk)
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return (nbytes, total)
+
+
+def _content_range_total(header):
+    """ @return the total size in a 'bytes a-b/total' header, or None """
+    if header is None or "/" not in header:
+        return None
+    total = header.rsplit("/", 1)[1].strip()
+    return None if total == "*" else int(total)
+
+
+class HostConnections(object):
+    """
+    Per-host limit on concurrent connections plus a stack of idle, already
+    logged-in clients that are reused by later transfers
+    """
+    def __init__(self, factory, limit):
+        self._factory = factory
+        self._semaphore = asyncio.Semaphore(limit)
+        self._idle = []
+
+    async def acquire(self):
+        await self._semaphore.acquire()
+        try:
+            while self._idle:
+                client = self._idle.pop()
+                try:
+                    await client.noop()
+                    return client
+                except (TransferError, OSError, asyncio.TimeoutError):
+                    client.close()
+            client = self._factory()
+            await client.connect()
+            return client
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def release(self, client, broken=False):
+        if broken or not client.is_open():
+            client.close()
+        else:
+            self._idle.append(client)
+        self._semaphore.release()
+
+    def close(self):
+        for client in self._idle:
+            client.close()
+        self._idle = []
+
+
+class AsyncCollectionRetriever(object):
+    """
+    Runs all the transfers for a list of (fcstDate, dataset, out_dir) jobs
+    """
+    def __init__(self, journal, verifier, cache=None, log=None):
+        '''
+        @param cache RawCollectionCache in which to reserve space for each
+               file before it is transferred
+        '''
+        self.journal = journal
+        self.verifier = verifier
+        self.cache = cache
+        self.log = log if log is not None else _default_log()
+        self._hosts = {}
+        self.num_bytes = 0
+        self.num_files = 0
+        self.failed = []
+        # remote directory -> future of its listing (FTP only)
+        self._listings = {}
+
+    def _connections(self, host):
+        if host not in self._hosts:
+            limit = connections_per_host.get(host, default_connections_per_host)
+            if use_http:
+                factory = lambda: AsyncHTTPClient(host, http_port)
+            else:
+                factory = lambda: AsyncFTPClient(host, ftp_port, ftp_user)
+            self._hosts[host] = HostConnections(factory, limit)
+        return self._hosts[host]
+
+    def _discard_file(self, path):
+        """ Called (by a verifier thread) for files that fail verification """
+        self.log.error("Removing corrupt file {0}".format(path))
+        self.journal.remove(os.path.basename(path))
+        if os.path.exists(path):
+            os.unlink(path)
+
+    async def _listing(self, client, remoteDir):
+        """
+        @return the listing of `remoteDir' (see AsyncFTPClient.listdir()).
+        Each directory is only listed once; concurrent callers wait for the
+        first one.
+        """
+        listing = self._listings.get(remoteDir)
+        if listing is not None:
+            try:
+                return await asyncio.shield(listing)
+            except (TransferError, OSError, asyncio.TimeoutError):
+                # The failure was on the other caller's connection; list it
+                # again on ours
+                pass
+        listing = asyncio.ensure_future(client.listdir(remoteDir))
+        self._listings[remoteDir] = listing
+        try:
+            return await listing
+        except BaseException:
+            # let a later attempt list it again
+            if self._listings.get(remoteDir) is listing:
+                del self._listings[remoteDir]
+            raise
+
+    async def _reserve(self, nbytes):
+        """ Reserve space in the cache, waiting without blocking the loop """
+        while True:
+            reservation = self.cache.try_reserve(nbytes)
+            if reservation is not None:
+                return reservation
+            await asyncio.sleep(self.cache.poll_interval)
+
+    async def fetch_file(self, fcstDate, dataset, out_dir):
+        if use_http:
+            (host, topdir) = (http_host, http_topdir)
+        else:
+            (host, topdir) = (ftp_host, ftp_topdir)
+        path = collections.get_remote_path(dataset, fcstDate, topdir, res,
+                                           prefix)
+        src_fileName = os.path.basename(path)
+        dest_fileName = os.path.join(out_dir, src_fileName)
+        if src_fileName in self.journal:
+            self.log.debug("{0} already downloaded according to database. "
+                           "Skipping".format(src_fileName))
+            if os.path.exists(dest_fileName):
+                # Quick if it is in the manifest; needed for its ready marker
+                self.verifier.submit(dest_fileName, dataset,
+                                     onFailure=self._discard_file)
+            return
+        if os.path.exists(dest_fileName):
+            ok = await asyncio.get_event_loop().run_in_executor(
+                     None, self.verifier.verify, dest_fileName, dataset)
+            if ok:
+                self.log.info("{0} File exists. Adding to database and "
+                              "skipping".format(src_fileName))
+                self.journal.record(src_fileName, dest_fileName)
+                return
+            self.log.warning("{0} File exists but is corrupt. Downloading "
+                             "again".format(src_fileName))
+            os.unlink(dest_fileName)
+        conns = self._connections(host)
+        wait = backoff_base
+        size = None
+        listed = use_http
+        reservation = None
+        try:
+            for attempt in range(1, max_tries+1):
+                client = None
+                broken = True
+                try:
+                    if not listed:
+                        client = await conns.acquire()
+                        files = await self._listing(client,
+                                                    os.path.dirname(path))
+                        if src_fileName not in files:
+                            broken = False
+                            self.log.warning("{0} is not on the server. "
+                                             "Skipping".format(path))
+                            self.failed.append(path)
+                            return
+                        size = files[src_fileName]
+                        listed = True
+                    if self.cache is not None and reservation is None:
+                        if client is not None:
+                            # wait for space without holding the connection
+                            conns.release(client)
+                            client = None
+                        reservation = await self._reserve(size)
+                    if client is None:
+                        client = await conns.acquire()
+                    temp_fileName = dest_fileName + ".tmp"
+                    offset = prepare_partial(temp_fileName, log=self.log)
+                    if offset:
+                        self.log.info("get: {0} (resuming at byte {1})"
+                                      .format(path, offset))
+                    else:
+                        self.log.info("get: {0}".format(path))
+                    output = []
+                    def open_output(start):
+                        output.append(open_partial(temp_fileName, start))
+                        return output[-1][1]
+                    try:
+                        (nbytes, total) = await client.retr(path, open_output,
+                                                            offset, size)
+                    finally:
+                        for (tempFile, writer) in output:
+                            tempFile.close()
+                    broken = False
+                    finish_partial(temp_fileName, dest_fileName, total)
+                    self.num_bytes += nbytes
+                    self.num_files += 1
+                    self.journal.record(src_fileName, dest_fileName,
+                                        checksum=writer.hexdigest())
+                    self.verifier.submit(dest_fileName, dataset, total,
+                                         writer.hexdigest(),
+                                         onFailure=self._discard_file)
+                    return
+                except PermanentError as e:
+                    broken = False
+                    self.log.warning("Unable to retrieve {0}: {1}"
+                                     .format(path, e))
+                    self.failed.append(path)
+                    return
+                except (TransferError, IncompleteTransferError, OSError,
+                        asyncio.TimeoutError) as e:
+                    if attempt == max_tries:
+                        self.log.error("Giving up on {0} after {1} tries: {2}"
+                                       .format(path, attempt, e))
+                        self.failed.append(path)
+                        return
+                    self.log.warning("Transfer of {0} failed on try {1}/{2}: "
+                                     "{3}. Retrying in {4}s"
+                                     .format(path, attempt, max_tries, e, wait))
+                finally:
+                    if client is not None:
+                        conns.release(client, broken=broken)
+                await asyncio.sleep(wait * (0.5 + random.random()))
+                wait = min(wait * 2, backoff_max)
+        finally:
+            if reservation is not None:
+                self.cache.commit(reservation, dest_fileName)
+
+    async def run(self, jobs):
+        """
+        Run all `jobs' concurrently; the per-host limits do the throttling.
+        Duplicate jobs (e.g. the daily const files) are only run once.
+        """
+        seen = set()
+        tasks = []
+        for (fcstDate, dataset, out_dir) in jobs:
+            key = (dataset, collections.get_file_name(dataset, fcstDate, prefix))
+            if key in seen:
+                continue
+            seen.add(key)
+            tasks.append(self.fetch_file(fcstDate, dataset, out_dir))
+        start = time.time()
+        await asyncio.gather(*tasks)
+        elapsed = time.time() - start
+        for conns in self._hosts.values():
+            conns.close()
+        self.log.info("Retrieved {0} files ({1:.1f} MB) in {2:.1f}s; {3} failed"
+                      .format(self.num_files, self.num_bytes / 1e6, elapsed,
+                              len(self.failed)))
+
+def get_files_by_date():
+    """
+    @return (output directory, list of (fcstDate, [(dataset, fileName), ...]),
+            consumers of each date (None: the default, see
+            lib/raw_cache.py)) with the files to retrieve, from
+            `preproc_config' if set or else from `datasets' and the dates
+    """
+    if preproc_config is not None:
+        fetchPlan = FetchPlan(preproc_config, includeLis=plan_lis_forcing)
+        return (fetchPlan.output_directory, fetchPlan.files_by_date(prefix),
+                fetchPlan.consumers)
+    ymd = dtime(year=year, month=month, day=day)
+    return (output_directory,
+            collections.get_files_by_date(datasets,
+                                          ymd + tdelta(seconds=start_time),
+                                          ymd + tdelta(seconds=end_time),
+                                          tdelta(seconds=interval), prefix),
+            None)
+
+def get_jobs(outputDirectory, filesByDate):
+    """ @return date-major list of (fcstDate, dataset, out_dir) to retrieve """
+    plan = collections.plan_transfers(filesByDate, ftp_topdir, res)
+    jobs = []
+    for (dataset, fcstDate, remoteDir, fileName) in plan:
+        out_dir = os.path.join(outputDirectory, dataset)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        jobs.append((fcstDate, dataset, out_dir))
+    return jobs
+
+if __name__ == "__main__":
+    # make sure database file was passed in
+    if len(sys.argv) < 2:
+        print("USAGE: {} <journal file> [<pickle to import>]".format(sys.argv[0]))
+        sys.exit(1)
+    db_file = sys.argv[1]
+    pickle_file = sys.argv[2] if len(sys.argv) > 2 else None
+
+    journal = open_journal(db_file, pickle_file)
+    postProcess = None
+    if subset_files:
+        import subset
+        postProcess = functools.partial(subset.subset_in_place,
+                                        bbox=subset_bbox)
+    # Writes the ready marker of each date once all its files are verified
+    (out_dir, files_by_date, consumers) = get_files_by_date()
+    tracker = ReadyDateTracker(out_dir, files_by_date)
+    cache = None
+    if raw_cache_budget is not None:
+        cache = RawCollectionCache(out_dir, files_by_date, raw_cache_budget,
+                                   consumers=consumers)
+    def file_verified(path):
+        tracker.file_ready(path)
+        if cache is not None:
+            # it may have been subset
+            cache.update(path)
+    verifier = FileVerifier(numWorkers=num_verify_threads,
+                            postProcess=postProcess,
+                            onVerified=file_verified)
+    retriever = AsyncCollectionRetriever(journal, verifier, cache)
+    # Dates that have been consumed (and maybe evicted) are not fetched again
+    jobs = get_jobs(out_dir, files_by_date if cache is None
+                             else cache.unconsumed(files_by_date))
+    asyncio.run(retriever.run(jobs))
+    verifier.close()
+    journal.close()
+    for fcstDate in tracker.pending_dates():
+        retriever.log.warning("Not ready: {0} (missing {1})".format(
+            fcstDate, ", ".join(tracker.missing_files(fcstDate))))
+    if cache is not None:
+        retriever.log.info("Cache: {0}".format(cache.summary()))
+    if retriever.failed:
+        sys.exit(1)
@@ -1,25 +1,50 @@
 #!/usr/bin/env python
 """
 Download a given set of g5nr data. The data that is downloaded is specified
-via variables. To minimize hits to the file system, a "database" is used to
-keep track of files that have been successfully downloaded on previous runs.
+via variables. To minimize hits to the file system, a journal (see
+lib/download_journal.py) is used to keep track of files that have been
+successfully downloaded on previous runs.
 Also, the script will check if a file to be downloaded already exists and if so,
 skips it. Therefore, if you want to overwrite files, you must delete them 
 first.
+Files are downloaded to <name>.tmp and only renamed once their size matches
+the size on the server. Interrupted transfers are retried (up to `max_tries'
+times) and resume from the end of the .tmp file, also across runs (see
+lib/resumable_transfer.py).
 
-HTTP and FTP are supported, although HTTP has not been tested in a while.
+HTTP and FTP are supported. Over HTTP, connections are kept alive and
+reused (see lib/http_pool.py), and files larger than `http_min_segment_size'
+are downloaded as up to `http_segments' byte ranges in parallel.
 
 NOTE: The directory structure is organized into year/month/day
 
 USAGE: 
-  collection_retriever.py <database file>. The database file is a pickled List
-  containing files that have already been downloaded. This is done to reduce
-  the queries to the filesystem. If the file does not exist, it will be created.
+  collection_retriever_coarse.py <journal file> [<pickle to import>]
+  The journal is an SQLite database of files that have already been
+  downloaded. This is done to reduce the queries to the filesystem. If the
+  file does not exist, it will be created. To carry over the pickled list of
+  the old retrievers, pass it as the second argument.
 
 
-KNOWN ISSUES
-- The 'const' datasets are only provided once a day. The current code
-  does not work around this, which results in a  lot of "skipping..." messages
+The list of files is built up front (see get_transfer_plan() in
+lib/g5nr_collections.py), so the daily 'const' files are only requested once
+per day. With FTP, each day directory is listed once (lib/directory_listing.py)
+and files that are not in the listing are skipped without trying to
+retrieve them.
+
+Downloaded files are verified in the background (lib/integrity.py): size,
+HDF5 header and the variables expected by params.G5NR_Params.VAR_2_COLLECTION.
+Bad files are removed (and so downloaded again by the next run). Existing
+files are verified before being skipped, and good files are added to a
+checksum MANIFEST in their directory so they are not verified again.
+If `subset_files' is set, files that pass verification are replaced by a
+compact subset with only the variables (and region) used by the
+preprocessing (lib/subset.py).
+
+Files are transferred date-major, and once the files of all the collections
+for a forecast date are present and verified, a marker is written to
+<output_directory>/ready (lib/ready_dates.py), so the preprocessing can
+start on that date while the download goes on.
 """
 
 import sys
@@ -27,22 +52,50 @@ import os
 from datetime import datetime as dtime
 from datetime import timedelta as tdelta
 from urlparse import urlparse
+import posixpath
 import time
+import functools
 import ftplib
-import pickle
+
+from download_journal import open_journal
+from ftp_pool import FTPConnectionPool
+from directory_listing import DirectoryListingCache
+from integrity import FileVerifier
+from ready_dates import ReadyDateTracker
+import g5nr_collections as collections
+from http_pool import HTTPConnectionPool, HTTPStatusError, retrieve_segmented
+from resumable_transfer import retrieve_ftp
 
 # Note : Slight path difference with HTTP and FTP
 http_host = "g5nr.nccs.nasa.gov"
 http_topdir = "data/DATA"
 ftp_host = 'ftp.nccs.nasa.gov'
 ftp_user = "G5NR"
+ftp_port = 21
 ftp_topdir = 'Ganymed/7km/c1440_NR/DATA/'
 
 use_http = False
+# Over HTTP, files are split in up to this many byte ranges of at least
+# `http_min_segment_size' bytes, downloaded in parallel over keep-alive
+# connections (see lib/http_pool.py)
+http_segments = 4
+http_min_segment_size = 64 * 1024 * 1024
+# Number of attempts for each file before giving up on it
+max_tries = 5
+# Number of threads verifying the downloaded files (see lib/integrity.py)
+num_verify_threads = 2
+# Optionally replace the downloaded files by a subset (see lib/subset.py;
+# requires netCDF4): only the variables used by params.G5NR_Params and, if
+# `subset_bbox' is set, only the (lat_min, lat_max, lon_min, lon_max) box
+subset_files = False
+subset_bbox = None
 
 output_directory = '/scratch4/NAGAPE/aoml-osse/Javier.Delgado/nems/g5nr/data/coarse_collections'
 res = '0.5000_deg'
 prefix = "c1440_NR."
+# Time-averaged data is at 30 passed the hour, as it
+# reflects the average for the 60 minute period
+tavg_offset = tdelta(minutes=30)
 #ftp://G5NR@ftp.nccs.nasa.gov/Ganymed/7km/c1440_NR/DATA/0.5000_deg/inst/inst01hr_3d_T_Cp/Y2006/M01/D01/c1440_NR.inst01hr_3d_T_Cp.20060101_0000z.nc4
 # -> Use "Cp" for pressure-level, "Cv" for model-layer centers, "Ce" for model-layer edges
 
@@ -93,105 +146,122 @@ datasets = [
 
 # make sure database file was passed in
 if len(sys.argv) < 2:
-    print "USAGE: {} <database (hint: pickle file)>".format(sys.argv[0])
+    print "USAGE: {} <journal file> [<pickle to import>]".format(sys.argv[0])
     sys.exit(1)
 db_file = sys.argv[1]
+pickle_file = sys.argv[2] if len(sys.argv) > 2 else None
 
+pool = None
 if use_http is False: # assume FTP
-    for i in range(10):
-        ftp = None
-        try:    
-            ftp = ftplib.FTP(ftp_host, user=ftp_user)
-            break
-        except ftplib.error_temp:
-            print 'Error establishing FTP connection. Will retry in 5 mins'
-            time.sleep(300)
-    if ftp is None:
-        print 'Unable to establish FTP connection. Giving up'
-        sys.exit(1)
-
-already_there = []
-if os.path.exists(db_file):
-    print "Loading 'database' of downloaded datasets"
-    already_there = pickle.load(open(db_file, 'rb'))
+    # A single connection; the pool takes care of reconnecting and of
+    # retrying transient errors
+    pool = FTPConnectionPool(ftp_host, ftp_user, port=ftp_port,
+                             numConnections=1, maxTries=max_tries)
+    listings = DirectoryListingCache()
+else:
+    # A connection per segment; the pool takes care of retrying transient
+    # errors, and transfers resume where the failed attempt stopped
+    pool = HTTPConnectionPool(http_host, numConnections=http_segments,
+                              maxTries=max_tries)
+
+journal = open_journal(db_file, pickle_file)
 ymd = dtime(year=year, month=month, day=day)
-for dataset in datasets:
-    if dataset.startswith("inst"):
-        tag = "inst"
-    elif dataset.startswith("tavg"):
-        tag = "tavg"
-    elif dataset.startswith("const"):
-        tag = "const"
-    else:
-        print 'unknown tag'
-        sys.exit(3)
-    
+start_date = ymd + tdelta(seconds=start_time)
+end_date = ymd + tdelta(seconds=end_time)
+# Writes the ready marker of each date once all its files are verified
+tracker = ReadyDateTracker(output_directory,
+                           collections.get_files_by_date(datasets,
+                               start_date, end_date, tdelta(seconds=interval),
+                               prefix, tavg_offset))
+# Downloaded files are verified in the background while the next ones are
+# transferred
+postProcess = None
+if subset_files:
+    import subset
+    postProcess = functools.partial(subset.subset_in_place,
+                                    bbox=subset_bbox)
+verifier = FileVerifier(numWorkers=num_verify_threads,
+                        postProcess=postProcess,
+                        onVerified=tracker.file_ready)
+def discard_file(path):
+    print 'Removing corrupt file {0}'.format(path)
+    journal.remove(os.path.basename(path))
+    if os.path.exists(path):
+        os.unlink(path)
+if use_http:
+    host=http_host
+    topdir=http_topdir
+    scheme = "http"
+else:
+    host = ftp_host
+    topdir = ftp_topdir
+    scheme = "ftp"
+# Each file is listed once - i.e. the daily const files are only requested
+# for the first date of each day
+plan = collections.get_transfer_plan(datasets, start_date, end_date,
+                                     tdelta(seconds=interval),
+                                     topdir, res, prefix, tavg_offset)
+for (dataset, fcstDate, remoteDir, fileName) in plan:
     out_dir = os.path.join(output_directory, dataset)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-
-    for t in range(start_time, end_time, interval):
-        fcstDate = ymd + tdelta(seconds=t)
-        if tag == "tavg":
-	    # Time-averaged data is at 30 passed the hour, as it 
-	    # reflects the average for the 60 minute period
-	    # TODO : Do we need to adjust the values to account for the 
-	    # fact that it it is an average?
-    	    fcstDate = fcstDate - tdelta(minutes=30)
-
-    	if tag == 'const':
-            suffix = ".%Y%m%d.nc4"
-        else:
-            suffix = ".%Y%m%d_%H%Mz.nc4"
-
-        fileName = fcstDate.strftime("{pfx}{ds}{sfx}".format(pfx=prefix, sfx=suffix, ds=dataset))
-        if use_http:
-            host=http_host
-            topdir=http_topdir
-            scheme = "http"
-        else:
-            host = ftp_host
-            topdir = ftp_topdir
-            scheme = "ftp"
-        url = fcstDate.strftime("{scheme}://{host}/{topdir}/{res}/{tag}/{ds}/Y%Y/M%m/D%d/{fileName}".format(
-                                 scheme=scheme, host=host, topdir=topdir, 
-                                 res=res, tag=tag, ds=dataset, fileName=fileName))
-        parsed = urlparse(url)
-        src_fileName  = os.path.basename(parsed.path)
-        dest_fileName = os.path.join(out_dir, src_fileName)
-        
-        if src_fileName in already_there:
-            print '%s already downloaded according to database. Skipping' %fileName
-            continue
-        elif os.path.exists(dest_fileName):
-            print '%s File exists. Adding to database and skipping' %fileName
-            already_there.append(src_fileName)
-            continue
-        else:
+    url = "{scheme}://{host}{path}".format(scheme=scheme, host=host,
+                                path=posixpath.join(remoteDir, fileName))
+    parsed = urlparse(url)
+    src_fileName  = os.path.basename(parsed.path)
+    dest_fileName = os.path.join(out_dir, src_fileName)
+    
+    if src_fileName in journal:
+        print '%s already downloaded according to database. Skipping' %fileName
+        if os.path.exists(dest_fileName):
+            # Quick if it is in the manifest; needed for its ready marker
+            verifier.submit(dest_fileName, dataset, onFailure=discard_file)
+        continue
+    else:
+        try:
+            size = None
+            if not use_http:
+                # The day directory is listed once, and files missing
+                # from it are skipped without trying RETR
+                (exists, size) = pool.run(listings.lookup,
+                                          args=(remoteDir, fileName))
+                if not exists:
+                    print '%s is not on the server. Skipping' %fileName
+                    continue
+            if os.path.exists(dest_fileName):
+                if verifier.verify(dest_fileName, dataset, size):
+                    print '%s File exists. Adding to database and skipping' %fileName
+                    journal.record(src_fileName, dest_fileName)
+                    continue
+                print '%s File exists but is corrupt. Downloading again' %fileName
+                os.unlink(dest_fileName)
             if use_http:
-                os.system("wget -P {} {}".format(out_dir, url))
+                checksum = retrieve_segmented(pool, parsed.path, dest_fileName,
+                                    maxSegments=http_segments,
+                                    minSegmentSize=http_min_segment_size)
             else:
-                #p = parsed.path
-
                 sys.stdout.write('get: {}\n'.format(parsed.path))
-                #import pdb ; pdb.set_trace()
-                try:
-                    ftp.cwd(os.path.dirname(parsed.path))
-                    #'/Ganymed/7km/c1440_NR/DATA/0.5000_deg/inst/inst01hr_3d_T_Cv/Y2006/M09/D18')
-                    #'250 OK. Current directory is /Ganymed/7km/c1440_NR/DATA/0.5000_deg/inst/inst01hr_3d_T_Cv/Y2006/M09/D18'
-                    #>>> ftp.retrlines("LIST")
-                    cmd = 'RETR {srcFile}'.format(srcFile=src_fileName)
-                    #temp_fileName = '.tmp_{}'.format(src_fileName)
-                    temp_fileName = dest_fileName + ".tmp"
-                    callback = open(temp_fileName, 'wb').write
-                    ftp.retrbinary(cmd, callback)
-                    os.rename(temp_fileName, dest_fileName)
-                    already_there.append(src_fileName)
-                except Exception as e:
-                    print 'Exception occurred: {}'.format(e) #.strerror)
-                    print 'dumping database'
-                    pickle.dump(already_there, open(db_file, 'wb'))
-                    sys.exit(1)
-                    #raise e
-            # Dump the database - in case lightning strikes
-            pickle.dump(already_there, open(db_file, 'wb'))
+                checksum = pool.run(retrieve_ftp,
+                                    args=(parsed.path, dest_fileName),
+                                    kwargs={'expectedSize': size})
+        except (ftplib.error_perm, HTTPStatusError) as e:
+            print 'Unable to retrieve {0}: {1}'.format(url, e)
+            continue
+        except Exception as e:
+            # The partial .tmp file is kept, so the next run resumes it
+            print 'Giving up on {0}: {1}'.format(url, e)
+            continue
+        # The entry is committed right away - in case lightning strikes
+        journal.record(src_fileName, dest_fileName, checksum=checksum)
+        verifier.submit(dest_fileName, dataset, size, checksum,
+                        onFailure=discard_file)
+if pool is not None:
+    pool.close()
+verifier.close()
+if verifier.failed:
+    print '{0} files failed verification (see above)'.format(
+            len(verifier.failed))
+for fcstDate in tracker.pending_dates():
+    print 'Not ready: {0} (missing {1})'.format(fcstDate,
+            ", ".join(tracker.missing_files(fcstDate)))
+journal.close()
@@ -1,25 +1,70 @@
 #!/usr/bin/env python
 """
 Download a given set of g5nr data. The data that is downloaded is specified
-via variables. To minimize hits to the file system, a "database" is used to
-keep track of files that have been successfully downloaded on previous runs.
+via variables. To minimize hits to the file system, a journal (see
+lib/download_journal.py) is used to keep track of files that have been
+successfully downloaded on previous runs.
 Also, the script will check if a file to be downloaded already exists and if so,
 skips it. Therefore, if you want to overwrite files, you must delete them 
 first.
+Files are downloaded to <name>.tmp and only renamed once their size matches
+the size on the server. If a transfer is interrupted, the next attempt
+resumes from the end of the .tmp file (see lib/resumable_transfer.py), so
+delete stale .tmp files too if the remote files have changed.
 
-HTTP and FTP are supported, although HTTP has not been tested in a while.
+HTTP and FTP are supported. Over HTTP, connections are kept alive and
+reused from an HTTPConnectionPool (see lib/http_pool.py), and files larger
+than `http_min_segment_size' are downloaded as up to `http_segments' byte
+ranges in parallel.
+
+Transfers are done by a bounded pool of worker threads. Each FTP transfer
+checks a connection out of an FTPConnectionPool (see lib/ftp_pool.py), so no
+two threads share an ftplib.FTP object, and transient errors are retried on
+a fresh connection with backoff.
+The number of concurrent transfers is adjusted at run time between
+`min_concurrent_transfers' and `max_concurrent_transfers', based on the
+achieved throughput and on server errors (see lib/throughput.py), and the
+throughput of every transfer is logged to `telemetry_file'.
 
 NOTE: The directory structure is organized into year/month/day
 
+Instead of editing `datasets' and the dates below, `preproc_config' can be
+set to the config file of nr_input_generator.py. The collections and dates
+are then derived from it and from params.py (lib/fetch_plan.py), so only
+what the preprocessing needs is downloaded.
+
 USAGE: 
-  collection_retriever.py <database file>. The database file is a pickled List
-  containing files that have already been downloaded. This is done to reduce
-  the queries to the filesystem. If the file does not exist, it will be created.
+  collection_retriever_threaded.py <journal file> [<pickle to import>]
+  The journal is an SQLite database of files that have already been
+  downloaded. This is done to reduce the queries to the filesystem. If the
+  file does not exist, it will be created. To carry over the pickled list of
+  the old retrievers, pass it as the second argument.
+
 
+The list of files is built up front (see get_transfer_plan() in
+lib/g5nr_collections.py), so the daily 'const' files are only requested once
+per day. With FTP, each day directory is listed once (lib/directory_listing.py)
+and files that are not in the listing are skipped without trying to
+retrieve them.
 
-KNOWN ISSUES
-- The 'const' datasets are only provided once a day. The current code
-  does not work around this, which results in a  lot of "skipping..." messages
+Downloaded files are verified in the background by a pool of
+`num_verify_threads' threads (lib/integrity.py): size, HDF5 header and
+the variables expected by params.G5NR_Params.VAR_2_COLLECTION. Bad files are
+removed (and so downloaded again by the next run). Existing files are
+verified before being skipped, and good files are added to a checksum
+MANIFEST in their directory so they are not verified again.
+If `subset_files' is set, files that pass verification are replaced by a
+compact subset with only the variables (and region) used by the
+preprocessing (lib/subset.py).
+
+Files are transferred date-major, and once the files of all the collections
+for a forecast date are present and verified, a marker is written to
+<output_directory>/ready (lib/ready_dates.py), so the preprocessing can
+start on that date while the download goes on.
+If `raw_cache_budget' is set, the space used by output_directory is kept
+under it (lib/raw_cache.py): files of dates that the preprocessing has
+consumed are deleted, least recently used first, and transfers wait for the
+preprocessing to catch up if that is not enough.
 """
 
 import sys
@@ -28,19 +73,39 @@ from datetime import datetime as dtime
 from datetime import timedelta as tdelta
 from urlparse import urlparse
 import time
+import functools
 import ftplib
-import pickle
 import threading
+import Queue
+
+from ftp_pool import FTPConnectionPool
+from directory_listing import DirectoryListingCache
+from integrity import FileVerifier
+from ready_dates import ReadyDateTracker
+from fetch_plan import FetchPlan
+from raw_cache import RawCollectionCache
+from throughput import TelemetryLog, ConcurrencyController
+from download_journal import open_journal
+from http_pool import HTTPConnectionPool, HTTPStatusError, retrieve_segmented
+from resumable_transfer import retrieve_ftp
+import g5nr_collections as collections
 
 
 # Note : Slight path difference with HTTP and FTP
 http_host = "g5nr.nccs.nasa.gov"
 http_topdir = "data/DATA"
+http_port = 80
 ftp_host = 'ftp.nccs.nasa.gov'
 ftp_user = "G5NR"
+ftp_port = 21
 ftp_topdir = 'Ganymed/7km/c1440_NR/DATA/'
 
 use_http = False
+# Over HTTP, files are split in up to this many byte ranges of at least
+# `http_min_segment_size' bytes, downloaded in parallel. Each transfer may
+# then use up to `http_segments' connections
+http_segments = 4
+http_min_segment_size = 64 * 1024 * 1024
 
 output_directory = '/scratch4/NAGAPE/aoml-osse/Javier.Delgado/nems/g5nr/data/raw_collections'
 res = '0.0625_deg'
@@ -57,8 +122,27 @@ interval = 1 * 3600
 end_time = 10 * 3600 * 24
 end_time = 26 * 3600 * 24
 
-num_concurrent_threads = 10
-db_lock = False
+# Bounds on the number of concurrent transfers. The limit starts at the
+# lower bound and is adjusted every `concurrency_interval' seconds
+min_concurrent_transfers = 2
+max_concurrent_transfers = 16
+concurrency_interval = 60
+# CSV log of the throughput of each transfer and of the aggregate throughput
+telemetry_file = "retriever_telemetry.csv"
+# How many times to retry a transfer (on a fresh connection) after a
+# transient FTP error before giving up on the file
+max_tries = 5
+# Number of threads verifying the downloaded files (see lib/integrity.py)
+num_verify_threads = 4
+# Optionally replace the downloaded files by a subset (see lib/subset.py;
+# requires netCDF4): only the variables used by params.G5NR_Params and, if
+# `subset_bbox' is set, only the (lat_min, lat_max, lon_min, lon_max) box
+subset_files = False
+subset_bbox = None
+# Optionally keep the size of output_directory under this many bytes (e.g.
+# 2e12), by evicting the files that the preprocessing has consumed and
+# throttling the transfers (see lib/raw_cache.py)
+raw_cache_budget = None
 ## !!
 # tavg30mn_2d_met2_Nx/ only available at 15 and 45 passed the hour
 # There is no hour on the const_2d_asm_Nx - e.g. c1440_NR.const_2d_asm_Nx.20060910.nc4  
@@ -88,50 +172,37 @@ datasets =  [
     "inst30mn_3d_DELP_Nv",
             ]
 
-def create_ftp_connections(num_connections):
-    """
-    Create a list of `num_connections' ftp_connections
-    """
-    ftp_connections = []
-    for i in range(num_connections):
-        for i in range(10):
-            ftp = None
-            try:    
-                ftp = ftplib.FTP(ftp_host, user=ftp_user)
-                break
-            except ftplib.error_temp:
-                print 'Error establishing FTP connection. Will retry in 5 mins'
-                time.sleep(300)
-        if ftp is None:
-            print 'Unable to establish FTP connection. Giving up'
-            sys.exit(1)
-        ftp_connections.append(ftp)
-    return ftp_connections
-
-def fetch_file(ftp, fcstDate,  dataset, already_there):
-
-    if dataset.startswith("inst"):
-        tag = "inst"
-    elif dataset.startswith("tavg"):
-        tag = "tavg"
-    elif dataset.startswith("const"):
-        tag = "const"
-    else:
-        print 'unknown tag'
-        sys.exit(3)
-    if tag == "tavg":
-        # Time-averaged data is at 15 and 45 passed the hour, as it 
-        # reflects the average for the 30 minute period
-        # TODO : Do we need to adjust the values to account for the 
-        # fact that it it is an average?
-    	fcstDate = fcstDate - tdelta(minutes=15)
-
-    if tag == 'const':
-        suffix = ".%Y%m%d.nc4"
-    else:
-        suffix = ".%Y%m%d_%H%Mz.nc4"
+# Config file of nr_input_generator.py. If set, the collections and dates
+# are derived from it (see lib/fetch_plan.py), and `datasets', the dates
+# above and `output_directory' are not used
+preproc_config = None
+# With `preproc_config', also get what lis_input_combiner.py needs for the
+# LIS spin-up (lis_spinup_duration and lis_frequency in the config)
+plan_lis_forcing = False
+
+def discard_file(journal, path):
+    '''
+    Remove a file that failed verification (and its journal entry), so
+    it is downloaded again by the next run
+    '''
+    print 'Removing corrupt file {0}'.format(path)
+    journal.remove(os.path.basename(path))
+    if os.path.exists(path):
+        os.unlink(path)
 
-    fileName = fcstDate.strftime("{pfx}{ds}{sfx}".format(pfx=prefix, sfx=suffix, ds=dataset))
+def plan_file(pool, fcstDate, dataset, out_dir, journal, listings=None,
+              verifier=None):
+    '''
+    Decide whether the file for the given `dataset' and `fcstDate' needs
+    transferring to `out_dir'.
+    If a DirectoryListingCache `listings' is passed, files that are not in
+    the listing of their day directory (obtained with a connection of the
+    FTPConnectionPool `pool') are skipped without trying RETR.
+    If a FileVerifier `verifier' is passed, existing files are verified
+    before being skipped (and downloaded again if they are bad).
+    @return (remote path, destination file, expected size or None) if the
+            file needs transferring, otherwise None
+    '''
     if use_http:
         host=http_host
         topdir=http_topdir
@@ -140,86 +211,220 @@ def fetch_file(ftp, fcstDate,  dataset, already_there):
         host = ftp_host
         topdir = ftp_topdir
         scheme = "ftp"
-    url = fcstDate.strftime("{scheme}://{host}/{topdir}/{res}/{tag}/{ds}/Y%Y/M%m/D%d/{fileName}".format(
-                             scheme=scheme, host=host, topdir=topdir, 
-                             res=res, tag=tag, ds=dataset, fileName=fileName))
+    url = collections.get_url(dataset, fcstDate, scheme, host, topdir, res,
+                              prefix)
+    fileName = collections.get_file_name(dataset, fcstDate, prefix)
     parsed = urlparse(url)
     src_fileName  = os.path.basename(parsed.path)
     dest_fileName = os.path.join(out_dir, src_fileName)
     
-    if src_fileName in already_there:
+    if src_fileName in journal:
         print '%s already downloaded according to database. Skipping' %fileName
-        return
-    elif os.path.exists(dest_fileName):
-        print '%s File exists. Adding to database and skipping' %fileName
-        already_there.append(src_fileName)
-        return
+        if verifier is not None and os.path.exists(dest_fileName):
+            # Quick if it is in the manifest; needed for its ready marker
+            verifier.submit(dest_fileName, dataset,
+                            onFailure=lambda path: discard_file(journal, path))
+        return None
+    size = None
+    if listings is not None and not use_http:
+        (exists, size) = pool.run(listings.lookup,
+                                  args=(os.path.dirname(parsed.path),
+                                        src_fileName),
+                                  maxTries=max_tries)
+        if not exists:
+            print '%s is not on the server. Skipping' %fileName
+            return None
+    if os.path.exists(dest_fileName):
+        if verifier is None or verifier.verify(dest_fileName, dataset, size):
+            print '%s File exists. Adding to database and skipping' %fileName
+            journal.record(src_fileName, dest_fileName)
+            return None
+        print '%s File exists but is corrupt. Downloading again' %fileName
+        os.unlink(dest_fileName)
+    return (parsed.path, dest_fileName, size)
+
+def fetch_file(pool, remotePath, dest_fileName, size, dataset, journal,
+               verifier=None):
+    '''
+    Download `remotePath' to `dest_fileName' with connections of `pool'
+    (an FTPConnectionPool, or an HTTPConnectionPool if use_http is set).
+    Transient errors are retried by the pool; a retry resumes from the
+    partial .tmp file left by the failed attempt.
+    If a FileVerifier `verifier' is passed, the downloaded file is
+    submitted to it for verification.
+    @return (file name, bytes transferred, seconds)
+    '''
+    src_fileName = os.path.basename(remotePath)
+    temp_fileName = dest_fileName + ".tmp"
+    offset = os.path.getsize(temp_fileName) if os.path.exists(temp_fileName) else 0
+    start = time.time()
+    if use_http:
+        checksum = retrieve_segmented(pool, remotePath, dest_fileName,
+                                      maxSegments=http_segments,
+                                      minSegmentSize=http_min_segment_size,
+                                      maxTries=max_tries)
     else:
-        if use_http:
-            os.system("wget -P {} {}".format(out_dir, url))
-        else:
-            #p = parsed.path
+        sys.stdout.write('get: {}\n'.format(remotePath))
+        checksum = pool.run(retrieve_ftp, args=(remotePath, dest_fileName),
+                            kwargs={'expectedSize': size},
+                            maxTries=max_tries)
+    elapsed = time.time() - start
+    nbytes = max(os.path.getsize(dest_fileName) - offset, 0)
+    # The entry is committed right away - in case lightning strikes
+    journal.record(src_fileName, dest_fileName, checksum=checksum)
+    if verifier is not None:
+        verifier.submit(dest_fileName, dataset, size, checksum,
+                        onFailure=lambda path: discard_file(journal, path))
+    return (src_fileName, nbytes, elapsed)
 
-            sys.stdout.write('get: {}\n'.format(parsed.path))
-            #import pdb ; pdb.set_trace()
+def worker(pool, jobs, journal, listings, verifier, controller, cache):
+    """
+    Process (fcstDate, dataset, out_dir) entries from the `jobs' queue until
+    a None entry is found. Each transfer gets its own connection from `pool'
+    (or, over HTTP, a connection per segment) and only starts when the
+    ConcurrencyController `controller' allows it.
+    If a RawCollectionCache `cache' is passed, space for the file is
+    reserved in it first (which may wait for space), without holding a
+    connection or a transfer slot meanwhile.
+    """
+    while True:
+        job = jobs.get()
+        try:
+            if job is None:
+                return
+            (fcstDate, dataset, out_dir) = job
+            reservation = None
             try:
-                ftp.cwd(os.path.dirname(parsed.path))
-                #'/Ganymed/7km/c1440_NR/DATA/0.5000_deg/inst/inst01hr_3d_T_Cv/Y2006/M09/D18')
-                #'250 OK. Current directory is /Ganymed/7km/c1440_NR/DATA/0.5000_deg/inst/inst01hr_3d_T_Cv/Y2006/M09/D18'
-                #>>> ftp.retrlines("LIST")
-                cmd = 'RETR {srcFile}'.format(srcFile=src_fileName)
-                #temp_fileName = '.tmp_{}'.format(src_fileName)
-                temp_fileName = dest_fileName + ".tmp"
-                callback = open(temp_fileName, 'wb').write
-                ftp.retrbinary(cmd, callback)
-                os.rename(temp_fileName, dest_fileName)
-                already_there.append(src_fileName)
+                needed = plan_file(pool, fcstDate, dataset, out_dir, journal,
+                                   listings, verifier)
+                if needed is None:
+                    continue
+                (remotePath, dest_fileName, size) = needed
+                if cache is not None:
+                    # waits if the budget is used up
+                    reservation = cache.reserve(size)
+                controller.acquire()
+                try:
+                    transfer = fetch_file(pool, remotePath, dest_fileName,
+                                          size, dataset, journal, verifier)
+                finally:
+                    controller.release()
+                controller.record_transfer(*transfer)
+            except (ftplib.error_perm, HTTPStatusError) as e:
+                print 'Unable to retrieve {0} for {1}: {2}'.format(dataset,
+                                                                   fcstDate, e)
             except Exception as e:
-                print 'Exception occurred: {}'.format(e) #.strerror)
-                print 'dumping database'
-                pickle.dump(already_there, open('already_there.pickle', 'wb'))
-                sys.exit(1)
-                #raise e
-        # Dump the database - in case lightning strikes
-        while db_lock:
-            time.sleep(1)
-        db_lock = True
-        pickle.dump(already_there, open('already_there.pickle', 'wb'))
-        db_lock = False
+                print 'Giving up on {0} for {1}: {2}'.format(dataset, fcstDate, e)
+            finally:
+                if reservation is not None:
+                    cache.commit(reservation, dest_fileName)
+        finally:
+            jobs.task_done()
 
 if __name__ == "__main__":
     # make sure database file was passed in
     if len(sys.argv) < 2:
-        print "USAGE: {} <database (hint: pickle file)>".format(sys.argv[0])
+        print "USAGE: {} <journal file> [<pickle to import>]".format(sys.argv[0])
         sys.exit(1)
+    db_file = sys.argv[1]
+    pickle_file = sys.argv[2] if len(sys.argv) > 2 else None
 
+    telemetry = TelemetryLog(telemetry_file)
+    controller = ConcurrencyController(minLimit=min_concurrent_transfers,
+                                       maxLimit=max_concurrent_transfers,
+                                       interval=concurrency_interval,
+                                       telemetry=telemetry)
+    pool = None
+    listings = None
     if use_http is False: # assume FTP
-        ftp_connections = create_ftp_connections(num_concurrent_threads)
-
-    already_there = []
-    if os.path.exists('already_there.pickle'):
-        print "Loading 'database' of downloaded datasets"
-        already_there = pickle.load(open('already_there.pickle', 'rb'))
-    ymd = dtime(year=year, month=month, day=day)
-    active_threads = 0
-    varLock = False
-    for dataset in datasets:
+        # Connections are opened as the concurrency limit goes up, and
+        # server errors make it go down
+        pool = FTPConnectionPool(ftp_host, ftp_user, port=ftp_port,
+                                 numConnections=max_concurrent_transfers,
+                                 numInitial=min_concurrent_transfers,
+                                 errorCallback=controller.record_error)
+        controller.on_limit_change = pool.trim
+        # Each day directory is listed once, by whichever worker needs it
+        # first
+        listings = DirectoryListingCache()
+    else:
+        # Each transfer may use up to http_segments connections
+        pool = HTTPConnectionPool(http_host, http_port,
+                                  numConnections=min_concurrent_transfers *
+                                                 http_segments,
+                                  maxTries=max_tries,
+                                  errorCallback=controller.record_error)
+        controller.on_limit_change = \
+            lambda limit: pool.trim(limit * http_segments)
+    if preproc_config is not None:
+        fetch_plan = FetchPlan(preproc_config, includeLis=plan_lis_forcing)
+        output_directory = fetch_plan.output_directory
+        files_by_date = fetch_plan.files_by_date(prefix)
+    else:
+        ymd = dtime(year=year, month=month, day=day)
+        files_by_date = collections.get_files_by_date(datasets,
+                            ymd + tdelta(seconds=start_time),
+                            ymd + tdelta(seconds=end_time),
+                            tdelta(seconds=interval), prefix)
+    # Writes the ready marker of each date once all its files are verified
+    tracker = ReadyDateTracker(output_directory, files_by_date)
+    postProcess = None
+    if subset_files:
+        import subset
+        postProcess = functools.partial(subset.subset_in_place,
+                                        bbox=subset_bbox)
+    cache = None
+    if raw_cache_budget is not None:
+        consumers = fetch_plan.consumers if preproc_config is not None else None
+        cache = RawCollectionCache(output_directory, files_by_date,
+                                   raw_cache_budget, consumers=consumers)
+    def file_verified(path):
+        tracker.file_ready(path)
+        if cache is not None:
+            # it may have been subset
+            cache.update(path)
+    verifier = FileVerifier(numWorkers=num_verify_threads,
+                            postProcess=postProcess,
+                            onVerified=file_verified)
+
+    journal = open_journal(db_file, pickle_file)
+
+    # Bounded pool of workers: the queue is bounded too, so we never get
+    # more than a few dates ahead of the transfers
+    jobs = Queue.Queue(maxsize=2*max_concurrent_transfers)
+    workers = []
+    for i in range(max_concurrent_transfers):
+        t = threading.Thread(target=worker,
+                             args=(pool, jobs, journal, listings, verifier,
+                                   controller, cache))
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    # Date-major, so dates become ready one after the other. Dates that
+    # have been consumed (and maybe evicted) are not fetched again
+    if cache is not None:
+        files_by_date = cache.unconsumed(files_by_date)
+    plan = collections.plan_transfers(files_by_date, ftp_topdir, res)
+    for (dataset, fcstDate, remoteDir, fileName) in plan:
         out_dir = os.path.join(output_directory, dataset)
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
-        for t in range(start_time, end_time, interval):
-            while active_threads >= num_concurrent_threads:
-                time.sleep(1)
-            fcstDate = ymd + tdelta(seconds=t)
-            while varLock: time.sleep(1)
-            varLock = True
-            ftp = ftp_connections[active_threads]
-            active_threads += 1
-            varLock = False
-            t = threading.Thread(target=fetch_file, 
-                                 args=(ftp, fcstDate,  dataset, already_there))
-            t.start()
-            while varLock: time.sleep(1)
-            varLock = True
-            active_threads -= 1
-            varLock = False
+        jobs.put((fcstDate, dataset, out_dir))
+    for t in workers:
+        jobs.put(None)
+    jobs.join()
+    if pool is not None:
+        pool.close()
+    print 'Transferred {0}'.format(controller.summary())
+    telemetry.close()
+    verifier.close()
+    if verifier.failed:
+        print '{0} files failed verification (see above)'.format(
+                len(verifier.failed))
+    for fcstDate in tracker.pending_dates():
+        print 'Not ready: {0} (missing {1})'.format(fcstDate,
+                ", ".join(tracker.missing_files(fcstDate)))
+    if cache is not None:
+        print 'Cache: {0}'.format(cache.summary())
+    journal.close()
@@ -4,3 +4,6 @@
 
 source /home/Javier.Delgado/libs/nwpy/etc/env.sh
 #source /home/Javier.Delgado/apps/pycane_dist/trunk/scripts/env.sh
+
+# nr_utils libraries (params, field_types, ftp_pool, ...)
+export PYTHONPATH=$PYTHONPATH:$(cd $(dirname ${BASH_SOURCE[0]:-$0})/../lib && pwd)
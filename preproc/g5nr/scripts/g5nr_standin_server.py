@@ -0,0 +1,652 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the NCCS G5NR FTP and HTTP servers. It serves a synthetic
+collection tree laid out like the real one (see g5nr_collections), so that
+the collection retrievers can be exercised offline: throughput, connection
+limits, dropped transfers, "421 too many users" replies, idle timeouts, etc.
+
+The files are generated on the fly, so no disk space is needed. Their content
+is deterministic (it only depends on the file name), starts with the HDF5
+signature and has a configurable size.
+
+USAGE:
+  g5nr_standin_server.py [options]
+  e.g. to serve two days of two collections with 1 MB files and make 5% of
+  the transfers fail midway:
+    g5nr_standin_server.py --ftp-port 2121 --http-port 8080 \\
+        --datasets inst30mn_3d_T_Nv,tavg30mn_2d_met2_Nx \\
+        --start "09-10-2006 00:00" --days 2 --file-size 1048576 \\
+        --fail-rate 0.05
+  Then point ftp_host/http_host of the retriever at localhost:<port>.
+
+The servers can also be started from Python with start_standin_servers(),
+which returns the server objects (their `stats' attribute keeps count of
+connections, transfers and bytes sent).
+"""
+
+import time
+import random
+import socket
+import hashlib
+import logging
+import posixpath
+import threading
+from datetime import datetime as dtime
+from datetime import timedelta as tdelta
+from optparse import OptionParser
+try:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler
+except ImportError:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler
+
+import g5nr_collections as collections
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+BLOCK_SIZE = 65536
+# Modification time reported for all the synthetic files
+FILE_MTIME = dtime(2015, 1, 1)
+
+_logger = None
+
+def _default_log(log2stdout=logging.INFO, name='g5nr_standin_server'):
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger(name)
+        _logger.setLevel(log2stdout)
+        msg_str = '%(asctime)s::%(funcName)s::%(filename)s:%(lineno)s::%(levelname)s - %(message)s'
+        formatter = logging.Formatter(msg_str, datefmt="%H:%M:%S")
+        ch = logging.StreamHandler()
+        ch.setLevel(log2stdout)
+        ch.setFormatter(formatter)
+        _logger.addHandler(ch)
+    return _logger
+
+
+class SyntheticCollectionTree(object):
+    """
+    Virtual, read-only directory tree containing the files of the given
+    datasets for every `interval' between `startDate' and `endDate'
+    """
+    def __init__(self, topdir, res, datasets, startDate, endDate,
+                 interval=tdelta(minutes=30), fileSize=BLOCK_SIZE,
+                 prefix=collections.FILE_PREFIX,
+                 tavgOffset=collections.TAVG_OFFSET, missing=()):
+        '''
+        @param topdir Top-level directory (e.g. collections.FTP_TOPDIR)
+        @param res Resolution directory (e.g. "0.0625_deg")
+        @param datasets List of collection names to serve
+        @param startDate, endDate datetime objects delimiting the files
+        @param interval timedelta between files
+        @param fileSize Size, in bytes, of each file. May also be a dict
+               mapping dataset names to sizes
+        @param missing Names of files to leave out of the tree, to emulate
+               holes in the nature run output
+        '''
+        self._files = {}
+        self._dirs = {"/": {}}
+        currDate = startDate
+        while currDate <= endDate:
+            for ds in datasets:
+                path = collections.get_remote_path(ds, currDate, topdir, res,
+                                                   prefix, tavgOffset)
+                if posixpath.basename(path) in missing:
+                    continue
+                if isinstance(fileSize, dict):
+                    self._add_file(path, fileSize[ds])
+                else:
+                    self._add_file(path, fileSize)
+            currDate += interval
+
+    def _add_file(self, path, size):
+        self._files[path] = size
+        child = posixpath.basename(path)
+        parent = posixpath.dirname(path)
+        isdir = False
+        while True:
+            entries = self._dirs.setdefault(parent, {})
+            entries[child] = None if isdir else self._files[path]
+            if parent == "/":
+                break
+            isdir = True
+            child = posixpath.basename(parent)
+            parent = posixpath.dirname(parent)
+
+    def file_paths(self):
+        return sorted(self._files.keys())
+
+    def isdir(self, path):
+        return path in self._dirs
+
+    def isfile(self, path):
+        return path in self._files
+
+    def listdir(self, path):
+        """
+        @return dict mapping the entries of directory `path' to their size
+                (None for subdirectories)
+        """
+        return self._dirs[path]
+
+    def size(self, path):
+        return self._files[path]
+
+    def read(self, path, offset=0, length=None):
+        """
+        Generator of the chunks of file `path' starting at byte `offset'
+        """
+        size = self._files[path]
+        if length is None:
+            length = size - offset
+        end = min(offset + length, size)
+        block = self.block(path)
+        pos = offset
+        while pos < end:
+            blockOffset = pos % BLOCK_SIZE
+            chunk = block[blockOffset:blockOffset + (end - pos)]
+            pos += len(chunk)
+            yield chunk
+
+    def block(self, path):
+        """
+        @return the BLOCK_SIZE bytes that are repeated to form file `path'
+        """
+        seed = hashlib.md5(posixpath.basename(path).encode("utf-8")).digest()
+        block = (seed * (BLOCK_SIZE // len(seed) + 1))[:BLOCK_SIZE]
+        return HDF5_SIGNATURE + block[len(HDF5_SIGNATURE):]
+
+    def content(self, path):
+        """ @return the whole content of file `path' (for verification) """
+        return b"".join(self.read(path))
+
+
+class _StandinServerMixin(object):
+    """
+    State shared by the FTP and HTTP stand-ins: the tree, fault injection
+    settings and transfer statistics
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def setup_standin(self, tree, maxConnections=None, failRate=0.,
+                      busyRate=0., rateLimit=None, idleTimeout=None,
+                      latency=0., log=None):
+        self.tree = tree
+        self.max_connections = maxConnections
+        self.fail_rate = failRate
+        self.busy_rate = busyRate
+        self.rate_limit = rateLimit
+        self.idle_timeout = idleTimeout
+        self.latency = latency
+        self.log = log if log is not None else _default_log()
+        self.stats = dict(connections=0, active=0, max_active=0, rejected=0,
+                          transfers=0, failed_transfers=0, bytes_sent=0,
+                          commands=0)
+        self._stats_lock = threading.Lock()
+
+    def count(self, key, incr=1):
+        with self._stats_lock:
+            self.stats[key] += incr
+            if key == "active":
+                self.stats["max_active"] = max(self.stats["max_active"],
+                                               self.stats["active"])
+
+    def admit(self):
+        """
+        @return False if the new connection should be turned away, either
+                because there are too many or because of busyRate
+        """
+        with self._stats_lock:
+            self.stats["connections"] += 1
+            tooMany = self.max_connections is not None \
+                      and self.stats["active"] >= self.max_connections
+            if tooMany or random.random() < self.busy_rate:
+                self.stats["rejected"] += 1
+                return False
+            self.stats["active"] += 1
+            self.stats["max_active"] = max(self.stats["max_active"],
+                                           self.stats["active"])
+            return True
+
+    def send_file(self, write, path, offset=0, length=None):
+        """
+        Send `path' from `offset' with `write', honoring the rate limit and
+        failure rate.
+        @return True if the whole range was sent, False if the transfer was
+                deliberately aborted midway
+        """
+        self.count("transfers")
+        if length is None:
+            length = self.tree.size(path) - offset
+        failAt = None
+        if random.random() < self.fail_rate:
+            failAt = random.randint(0, max(length - 1, 0))
+        sent = 0
+        start = time.time()
+        for chunk in self.tree.read(path, offset, length):
+            if failAt is not None and sent + len(chunk) > failAt:
+                write(chunk[:failAt - sent])
+                self.count("bytes_sent", failAt - sent)
+                self.count("failed_transfers")
+                return False
+            write(chunk)
+            sent += len(chunk)
+            self.count("bytes_sent", len(chunk))
+            if self.rate_limit:
+                ahead = sent / float(self.rate_limit) - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return True
+
+
+class FTPStandinHandler(socketserver.StreamRequestHandler):
+    """
+    Implements the subset of RFC 959/3659 used by ftplib and the retrievers:
+    USER PASS SYST FEAT TYPE PWD CWD CDUP PASV EPSV NLST LIST MLSD SIZE MDTM
+    REST RETR NOOP QUIT
+    """
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("latin-1"))
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        if not server.admit():
+            self.reply("421 Too many users are connected, please try later.")
+            return
+        try:
+            self.cwd = "/"
+            self.rest = 0
+            self.pasv_sock = None
+            if server.idle_timeout:
+                self.request.settimeout(server.idle_timeout)
+            self.reply("220 G5NR stand-in FTP server ready")
+            while True:
+                try:
+                    line = self.rfile.readline()
+                except socket.timeout:
+                    self.reply("421 Idle timeout, closing control connection")
+                    break
+                if not line:
+                    break
+                line = line.decode("latin-1").rstrip("\r\n")
+                server.count("commands")
+                if server.latency:
+                    time.sleep(server.latency)
+                (cmd, arg) = (line.split(" ", 1) + [""])[:2]
+                func = getattr(self, "ftp_" + cmd.upper(), None)
+                if func is None:
+                    self.reply("502 Command not implemented")
+                    continue
+                if func(arg) is False:
+                    break
+        except socket.error as e:
+            server.log.debug("Control connection dropped: {0}".format(e))
+        finally:
+            self._close_pasv()
+            server.count("active", -1)
+
+    def _resolve(self, arg):
+        if not arg:
+            return self.cwd
+        return posixpath.normpath(posixpath.join(self.cwd, arg))
+
+    def _close_pasv(self):
+        if self.pasv_sock is not None:
+            self.pasv_sock.close()
+            self.pasv_sock = None
+
+    def _open_data(self):
+        """ Accept the data connection on the passive socket """
+        if self.pasv_sock is None:
+            self.reply("425 Use PASV first")
+            return None
+        self.pasv_sock.settimeout(30)
+        try:
+            (conn, addr) = self.pasv_sock.accept()
+        except socket.timeout:
+            self.reply("425 Can't open data connection")
+            return None
+        finally:
+            self._close_pasv()
+        return conn
+
+    def _send_lines(self, lines):
+        conn = self._open_data()
+        if conn is None:
+            return
+        self.reply("150 Here comes the listing")
+        conn.sendall("".join(l + "\r\n" for l in lines).encode("latin-1"))
+        conn.close()
+        self.reply("226 Transfer complete")
+
+    def ftp_USER(self, arg):
+        self.reply("331 Please specify the password")
+
+    def ftp_PASS(self, arg):
+        self.reply("230 Login successful")
+
+    def ftp_SYST(self, arg):
+        self.reply("215 UNIX Type: L8")
+
+    def ftp_FEAT(self, arg):
+        self.reply("211-Features:")
+        for feat in ("MLSD", "SIZE", "MDTM", "REST STREAM", "PASV", "EPSV"):
+            self.reply(" " + feat)
+        self.reply("211 End")
+
+    def ftp_TYPE(self, arg):
+        self.reply("200 Switching to Binary mode")
+
+    def ftp_NOOP(self, arg):
+        self.reply("200 NOOP ok")
+
+    def ftp_QUIT(self, arg):
+        self.reply("221 Goodbye")
+        return False
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "{0}" is the current directory'.format(self.cwd))
+
+    def ftp_CWD(self, arg):
+        path = self._resolve(arg)
+        if self.server.tree.isdir(path):
+            self.cwd = path
+            self.reply("250 OK. Current directory is {0}".format(path))
+        else:
+            self.reply("550 Can't change directory to {0}".format(arg))
+
+    def ftp_CDUP(self, arg):
+        return self.ftp_CWD("..")
+
+    def ftp_PASV(self, arg):
+        self._close_pasv()
+        host = self.request.getsockname()[0]
+        self.pasv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.pasv_sock.bind((host, 0))
+        self.pasv_sock.listen(1)
+        port = self.pasv_sock.getsockname()[1]
+        self.reply("227 Entering Passive Mode ({0},{1},{2})".format(
+                   host.replace(".", ","), port >> 8, port & 0xFF))
+
+    def ftp_EPSV(self, arg):
+        self.ftp_PASV(arg)
+
+    def ftp_SIZE(self, arg):
+        path = self._resolve(arg)
+        if self.server.tree.isfile(path):
+            self.reply("213 {0}".format(self.server.tree.size(path)))
+        else:
+            self.reply("550 Could not get file size")
+
+    def ftp_MDTM(self, arg):
+        path = self._resolve(arg)
+        if self.server.tree.isfile(path):
+            self.reply("213 {0:%Y%m%d%H%M%S}".format(FILE_MTIME))
+        else:
+            self.reply("550 Could not get modification time")
+
+    def ftp_REST(self, arg):
+        try:
+            self.rest = int(arg)
+        except ValueError:
+            self.reply("501 REST requires a byte offset")
+            return
+        self.reply("350 Restart position accepted ({0})".format(self.rest))
+
+    def ftp_NLST(self, arg):
+        path = self._resolve(arg)
+        if not self.server.tree.isdir(path):
+            self.reply("550 No such directory")
+            return
+        self._send_lines(sorted(self.server.tree.listdir(path).keys()))
+
+    def ftp_LIST(self, arg):
+        path = self._resolve(arg)
+        if not self.server.tree.isdir(path):
+            self.reply("550 No such directory")
+            return
+        lines = []
+        for (name, size) in sorted(self.server.tree.listdir(path).items()):
+            if size is None:
+                lines.append("drwxr-xr-x 2 g5nr g5nr 4096 Jan 01 2015 " + name)
+            else:
+                lines.append("-rw-r--r-- 1 g5nr g5nr {0} Jan 01 2015 {1}"
+                             .format(size, name))
+        self._send_lines(lines)
+
+    def ftp_MLSD(self, arg):
+        path = self._resolve(arg)
+        if not self.server.tree.isdir(path):
+            self.reply("550 No such directory")
+            return
+        lines = []
+        modify = "{0:%Y%m%d%H%M%S}".format(FILE_MTIME)
+        for (name, size) in sorted(self.server.tree.listdir(path).items()):
+            if size is None:
+                lines.append("type=dir;modify={0}; {1}".format(modify, name))
+            else:
+                lines.append("type=file;size={0};modify={1}; {2}"
+                             .format(size, modify, name))
+        self._send_lines(lines)
+
+    def ftp_RETR(self, arg):
+        path = self._resolve(arg)
+        offset = self.rest
+        self.rest = 0
+        tree = self.server.tree
+        if not tree.isfile(path):
+            self._close_pasv()
+            self.reply("550 Failed to open file")
+            return
+        conn = self._open_data()
+        if conn is None:
+            return
+        self.reply("150 Opening BINARY mode data connection for {0} ({1} bytes)"
+                   .format(posixpath.basename(path), tree.size(path) - offset))
+        try:
+            complete = self.server.send_file(conn.sendall, path, offset)
+        except socket.error:
+            complete = False
+        conn.close()
+        if complete:
+            self.reply("226 Transfer complete")
+        else:
+            self.reply("426 Connection closed; transfer aborted")
+
+
+class FTPStandinServer(_StandinServerMixin, socketserver.ThreadingTCPServer):
+    def __init__(self, address, tree, **kwargs):
+        socketserver.ThreadingTCPServer.__init__(self, address,
+                                                 FTPStandinHandler)
+        self.setup_standin(tree, **kwargs)
+
+
+class HTTPStandinHandler(BaseHTTPRequestHandler):
+    """
+    Serves GET/HEAD requests (with single byte-range support) over
+    persistent HTTP/1.1 connections
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        self.server.log.debug(fmt % args)
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self._admitted = self.server.admit()
+
+    def finish(self):
+        BaseHTTPRequestHandler.finish(self)
+        if self._admitted:
+            self.server.count("active", -1)
+
+    def _parse_range(self, size):
+        """
+        @return (offset, length) requested by the Range header, or None.
+                Only single "bytes=a-b", "bytes=a-" and "bytes=-n" ranges
+                are supported
+        """
+        header = self.headers.get("Range")
+        if not header or not header.startswith("bytes=") or "," in header:
+            return None
+        (first, last) = header[len("bytes="):].split("-")
+        if first == "":
+            length = min(int(last), size)
+            return (size - length, length)
+        first = int(first)
+        last = size - 1 if last == "" else min(int(last), size - 1)
+        return (first, last - first + 1)
+
+    def do_HEAD(self):
+        self.do_GET(sendBody=False)
+
+    def do_GET(self, sendBody=True):
+        server = self.server
+        if not self._admitted:
+            self.send_error(503, "Too many connections")
+            self.close_connection = True
+            return
+        server.count("commands")
+        if server.latency:
+            time.sleep(server.latency)
+        path = posixpath.normpath(self.path.split("?")[0])
+        tree = server.tree
+        if tree.isdir(path):
+            body = "".join('<a href="{0}">{0}</a>\n'.format(name)
+                           for name in sorted(tree.listdir(path).keys()))
+            body = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if sendBody:
+                self.wfile.write(body)
+            return
+        if not tree.isfile(path):
+            self.send_error(404, "Not found")
+            return
+        size = tree.size(path)
+        byteRange = self._parse_range(size)
+        if byteRange is None:
+            (offset, length) = (0, size)
+            self.send_response(200)
+        elif byteRange[0] >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{0}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        else:
+            (offset, length) = byteRange
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(
+                             offset, offset + length - 1, size))
+        self.send_header("Content-Type", "application/x-netcdf")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not sendBody:
+            return
+        try:
+            complete = server.send_file(self.wfile.write, path, offset, length)
+        except socket.error:
+            complete = False
+        if not complete:
+            self.close_connection = True
+
+
+class HTTPStandinServer(_StandinServerMixin, socketserver.ThreadingTCPServer):
+    def __init__(self, address, tree, **kwargs):
+        socketserver.ThreadingTCPServer.__init__(self, address,
+                                                 HTTPStandinHandler)
+        self.setup_standin(tree, **kwargs)
+
+
+def start_standin_servers(datasets, startDate, endDate, ftpPort=0,
+                          httpPort=None, host="127.0.0.1", res="0.0625_deg",
+                          interval=tdelta(minutes=30), fileSize=BLOCK_SIZE,
+                          tavgOffset=collections.TAVG_OFFSET, missing=(),
+                          **faultArgs):
+    """
+    Start the FTP (and optionally HTTP) stand-ins in background threads.
+    Port 0 picks a free port; use server.server_address to find out which.
+    @param faultArgs Passed to the servers: maxConnections, failRate,
+           busyRate, rateLimit (bytes/s per transfer), idleTimeout (seconds),
+           latency (seconds added to each command)
+    @return list of the started servers (FTP first). Stop them with
+            server.shutdown()
+    """
+    servers = []
+    for (port, cls, topdir) in ((ftpPort, FTPStandinServer,
+                                 collections.FTP_TOPDIR),
+                                (httpPort, HTTPStandinServer,
+                                 collections.HTTP_TOPDIR)):
+        if port is None:
+            continue
+        tree = SyntheticCollectionTree(topdir, res, datasets, startDate,
+                                       endDate, interval=interval,
+                                       fileSize=fileSize,
+                                       tavgOffset=tavgOffset, missing=missing)
+        server = cls((host, port), tree, **faultArgs)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        servers.append(server)
+    return servers
+
+def _parse_args():
+    parser = OptionParser()
+    parser.add_option("--host", dest="host", default="127.0.0.1")
+    parser.add_option("--ftp-port", dest="ftp_port", type="int", default=2121)
+    parser.add_option("--http-port", dest="http_port", type="int", default=None)
+    parser.add_option("--datasets", dest="datasets",
+                      default="inst30mn_3d_T_Nv,tavg30mn_2d_met2_Nx,const_2d_asm_Nx",
+                      help="Comma-separated list of collections to serve")
+    parser.add_option("--res", dest="res", default="0.0625_deg")
+    parser.add_option("--start", dest="start", default="09-10-2006 00:00",
+                      help="First date served (MM-DD-YYYY hh:mm)")
+    parser.add_option("--days", dest="days", type="float", default=1)
+    parser.add_option("--interval-minutes", dest="interval", type="int",
+                      default=30)
+    parser.add_option("--file-size", dest="file_size", type="int",
+                      default=BLOCK_SIZE)
+    parser.add_option("--max-connections", dest="max_connections", type="int",
+                      default=None)
+    parser.add_option("--fail-rate", dest="fail_rate", type="float", default=0.,
+                      help="Probability that a transfer is aborted midway")
+    parser.add_option("--busy-rate", dest="busy_rate", type="float", default=0.,
+                      help="Probability that a connection gets a 421 reply")
+    parser.add_option("--rate-limit", dest="rate_limit", type="int",
+                      default=None, help="Bytes/s per transfer")
+    parser.add_option("--idle-timeout", dest="idle_timeout", type="float",
+                      default=None)
+    parser.add_option("--latency", dest="latency", type="float", default=0.)
+    (options, args) = parser.parse_args()
+    return options
+
+if __name__ == "__main__":
+    opts = _parse_args()
+    log = _default_log()
+    start = dtime.strptime(opts.start, "%m-%d-%Y %H:%M")
+    end = start + tdelta(days=opts.days)
+    servers = start_standin_servers(
+                  opts.datasets.split(","), start, end, ftpPort=opts.ftp_port,
+                  httpPort=opts.http_port, host=opts.host, res=opts.res,
+                  interval=tdelta(minutes=opts.interval),
+                  fileSize=opts.file_size, maxConnections=opts.max_connections,
+                  failRate=opts.fail_rate, busyRate=opts.busy_rate,
+                  rateLimit=opts.rate_limit, idleTimeout=opts.idle_timeout,
+                  latency=opts.latency, log=log)
+    for server in servers:
+        log.info("{0} listening on {1}:{2}".format(type(server).__name__,
+                                                  *server.server_address))
+    try:
+        while True:
+            time.sleep(60)
+            for server in servers:
+                log.info("{0}: {1}".format(type(server).__name__, server.stats))
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
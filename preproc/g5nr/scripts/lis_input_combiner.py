@@ -50,6 +50,8 @@ import netCDF4 as nc4
 
 from field_types import MetField, SoilField
 from field_types import get_met_field, get_soil_field
+from params import LIS_Params as lis
+from ready_dates import mark_consumed, LIS_INPUT_COMBINER
 
 
 #
@@ -262,9 +264,8 @@ def _parse_args():
 ##
 if __name__ == '__main__':
 
-    input_fields = ["SWLAND", 'TLML', 'QLML', 'SWGDN', "LWGAB", 'PS', 
-                    "PRECTOT", "PRECSNO", "PRECCON", "HLML", "PARDR", 
-                    "PARDF"]
+    # (also used by lib/fetch_plan.py to determine what to download)
+    input_fields = lis.FORCING_FIELDS
 
     confbasic = lambda param: conf.get("BASIC", param)
     confbasicbool = lambda param: conf.getboolean("BASIC", param)
@@ -335,6 +336,8 @@ if __name__ == '__main__':
         outfile_path = os.path.join(outdir, outFileName)
         if os.path.exists(outfile_path):
             logger.info("Skipping existing file '{}'".format(outfile_path))
+            mark_consumed(metInputTopdir, currDate, LIS_INPUT_COMBINER,
+                          log=logger)
             continue
         temp_outfile_path = outfile_path + '.tmp'
         logger.info("Populating output file {}".format(temp_outfile_path))
@@ -370,3 +373,6 @@ if __name__ == '__main__':
             inDataset.close()
         rootgrp.close()
         os.rename(temp_outfile_path, outfile_path)
+        # The raw collection files of this date are no longer needed by us
+        # (see lib/raw_cache.py)
+        mark_consumed(metInputTopdir, currDate, LIS_INPUT_COMBINER, log=logger)
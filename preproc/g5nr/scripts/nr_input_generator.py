@@ -33,6 +33,10 @@ USAGE:
 ADDITIONAL NOTES:
  - This program can be run in parallel using MPI. If it is, it will distribute
    the dates to process evenly among all workers (including rank 0)
+ - If watch_ready_dates is set in the config, dates are processed as the
+   collection retrievers finish downloading them, i.e. once their ready
+   marker exists in <src_met_output_directory>/ready (see lib/ready_dates.py),
+   so this can run while the download is still going on.
  - Since LIS netCDF files are available separately and have a different
    structure for the lat and lon dimensions, they are not merged with the
    rest of the fields. They are used directly when generating the nps_int files.
@@ -73,6 +77,8 @@ from params import LIS_Params as lis
 from params import NPS_Params as nps_params
 from nps import nps_utils
 from nps import nps_int_utils
+from ready_dates import get_ready_dir, wait_for_ready_dates, mark_consumed, \
+                        NR_INPUT_GENERATOR
 
 #
 # Globals
@@ -763,7 +769,8 @@ def generate_input(startDate, duration, frequency, outFilePattern, npsIntOutDir,
                    makeIsobaric=True, createNpsInt=True, pLevs=None, 
                    metInputDir=None, lsmInputDir=None,
                    metVars=[], lsmVars=[], log=None, extraNpsInt=False,
-                   geos2wrf_utils_path=None):
+                   geos2wrf_utils_path=None, watchReadyDates=False,
+                   readyPollInterval=60, readyTimeout=None):
     """
     This is the main method for generating input files compatible with Metgrid
     and NemsInterp, given a given set of meteorological and land surface 
@@ -791,6 +798,14 @@ def generate_input(startDate, duration, frequency, outFilePattern, npsIntOutDir,
            separate nps_int files for each field/level (e.g. for debugging)
     @param geos2wrf_utils_path Path to the geos2wrf utilities. This is needed
            if the utilities will be used to create derived fields
+    @param watchReadyDates If True, wait for the ready marker of each date
+           (written by the collection retrievers to <metInputDir>/ready once
+           all its files are downloaded) and process the dates in the order
+           they become ready
+    @param readyPollInterval How often (in seconds) to check for new ready
+           markers if watchReadyDates is True
+    @param readyTimeout Give up on the remaining dates if none became ready
+           in this many seconds (None: wait forever)
     """
 
     # determine subset of dates to process by this rank
@@ -803,6 +818,12 @@ def generate_input(startDate, duration, frequency, outFilePattern, npsIntOutDir,
         log.debug("Global list of dates to be processed: {}".format(all_dates))
     local_date_range = comm.partition(all_dates, func=partition.EqualLength(), involved=True)
     log.info("List of dates to be processed by this process: {}".format(local_date_range))
+    if watchReadyDates:
+        readyDir = get_ready_dir(metInputDir)
+        log.info("Processing dates as they become ready in {}".format(readyDir))
+        local_date_range = wait_for_ready_dates(readyDir, local_date_range,
+                                                pollInterval=readyPollInterval,
+                                                timeout=readyTimeout, log=log)
     
     for currDate in local_date_range:
 
@@ -1057,6 +1078,10 @@ def generate_input(startDate, duration, frequency, outFilePattern, npsIntOutDir,
                     log.info("Units/description not returned from function {f}"
                              .format(f=func))
             #create_ght_geos2wrf(inPrefix, outPath, currDate, createHGTexePath, inDir=".", modelTop=1.0):
+
+        # The raw collection files of this date are no longer needed by us
+        # (see lib/raw_cache.py)
+        mark_consumed(metInputDir, currDate, NR_INPUT_GENERATOR, log=log)
         #dest_dataset = nc4.Dataset(outFileName, 'r')
         #print 'after re-opening', dest_dataset.variables['TT'][0,:,100,100]
         #print 'v_isobaric, ', v_isobaric[0,:,100,100]
@@ -1153,6 +1178,16 @@ if __name__ == '__main__':
     make_isobaric = confbasicbool('make_isobaric')
     extra_nps_int = confbasicbool('create_separate_nps_int')
     geos2wrf_utils_path = confbasic("geos2wrf_utils_path")
+    # Optionally process the dates as they are downloaded
+    watch_ready_dates = False
+    ready_poll_interval = 60
+    ready_timeout = None
+    if conf.has_option("BASIC", "watch_ready_dates"):
+        watch_ready_dates = confbasicbool("watch_ready_dates")
+    if conf.has_option("BASIC", "ready_poll_interval"):
+        ready_poll_interval = float(confbasic("ready_poll_interval"))
+    if conf.has_option("BASIC", "ready_timeout"):
+        ready_timeout = float(confbasic("ready_timeout")) * 3600
     # Set up parallelization and logging
     run_parallel = True
     rank = 0
@@ -1208,4 +1243,7 @@ if __name__ == '__main__':
                    metInputDir=metInputTopdir, lsmInputDir=lsmInputTopdir, 
                    metVars=met_vars, lsmVars=lsm_vars, makeIsobaric=make_isobaric,
                    extraNpsInt=extra_nps_int, log=logger, 
-                   geos2wrf_utils_path=geos2wrf_utils_path)
+                   geos2wrf_utils_path=geos2wrf_utils_path,
+                   watchReadyDates=watch_ready_dates,
+                   readyPollInterval=ready_poll_interval,
+                   readyTimeout=ready_timeout)